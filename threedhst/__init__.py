@@ -189,6 +189,9 @@ defaultOptions()
     options['MAKE_WEBPAGE'] = True
     ## Image format for webpage
     options['WEB_IMAGE_FORMAT'] = 'png'
+    ## Number of worker processes for the thumbnails, spectra and map 
+    ## tiles of the webpage
+    options['PROCESSES'] = 1
     
     #### Path to WFC3-IR Persistence files
     options['FLT_PERSISTENCE_PATH'] = '/3DHST/Spectra/Work/PERSISTENCE/All'
@@ -86,31 +86,46 @@ class FilterDefinition:
         oab = S.Observation(abmag, bp)
         return -2.5*np.log10(ovega.integrate()/oab.integrate())
     
+    def _precomputed(self, key):
+        """
+        Value of `key` precomputed by `FilterFile`, or None if the 
+        wavelength or transmission arrays have been replaced since.
+        """
+        cache = getattr(self, '_cache', None)
+        if cache is None:
+            return None
+        
+        if ((cache['wavelength'] is not self.wavelength) | 
+            (cache['transmission'] is not self.transmission)):
+            return None
+            
+        return cache[key]
+        
     def pivot(self):
         """
-        PySynphot pivot wavelength
+        Pivot wavelength, as defined in (py)synphot.
+        
+        sqrt(integral(T*lambda) / integral(T/lambda))
         """
-        try:
-            import pysynphot as S
-        except:
-            print 'Failed to import "pysynphot"'
-            return False
+        value = self._precomputed('pivot')
+        if value is not None:
+            return value
             
-        self.bp = S.ArrayBandpass(wave=self.wavelength, throughput=self.transmission, name='')
-        return self.bp.pivot()
+        num = np.trapz(self.transmission*self.wavelength, self.wavelength)
+        den = np.trapz(self.transmission/self.wavelength, self.wavelength)
+        return np.sqrt(num/den)
         
     def rectwidth(self):
         """
         Synphot filter rectangular width
+        
+        integral(T) / max(T)
         """
-        try:
-            import pysynphot as S
-        except:
-            print 'Failed to import "pysynphot"'
-            return False
+        value = self._precomputed('rectwidth')
+        if value is not None:
+            return value
             
-        self.bp = S.ArrayBandpass(wave=self.wavelength, throughput=self.transmission, name='')
-        return self.bp.rectwidth()
+        return np.trapz(self.transmission, self.wavelength)/self.transmission.max()
 
     #
     def ctw95(self):
@@ -126,43 +141,236 @@ class FilterDefinition:
         return np.diff(ctw95)
             
         
+class ExtinctionCorrection():
+    """
+    Milky Way extinction corrections for a list of `FilterDefinition` filters
+    for many objects at once.
+    
+    For each filter the integral of `FilterDefinition.extinction_correction`, 
+    
+        delta(A_V) = trapz(T*S*10**(-0.4*A_lambda*A_V)) / trapz(T*S)
+    
+    is tabulated on a grid of A_V at initialization.  Since ln(delta) is 
+    nearly linear in A_V, linear interpolation of ln(delta) on the 
+    fine grid reproduces the direct integrals to well below 1e-4 mag.  
+    Values with A_V > `Av_max` are extrapolated linearly.  The optional source spectrum S(lambda) (`source_lam`, `source_flux`) 
+    weights the correction by the template shape.
+    
+    >>> res = FilterFile('FILTER.RES.latest')
+    >>> ext = ExtinctionCorrection([res.filters[i-1] for i in [153, 155, 161]])
+    >>> dmag = ext.correction(cat['ebv'])  # [NOBJ, NFILT]
+    
+    """
+    def __init__(self, filters, Rv=3.1, source_lam=None, source_flux=None, Av_max=10., dAv=0.01):
+        self.filters = filters
+        self.NFILT = len(filters)
+        self.Rv = Rv
+        self.dAv = dAv
+        self.Av_grid = np.arange(0, Av_max+dAv/2., dAv)
+        
+        self.lndelta = np.zeros((self.NFILT, len(self.Av_grid)))
+        for i, filter in enumerate(filters):
+            if source_flux is None:
+                weight = filter.transmission*1.
+            else:
+                weight = filter.transmission*np.interp(filter.wavelength, source_lam, source_flux, left=0, right=0)
+            
+            Alambda = milkyway_extinction(lamb = filter.wavelength, Rv=Rv)
+            atten = 10**(-0.4*np.outer(self.Av_grid, Alambda))
+            delta = np.trapz(weight*atten, filter.wavelength, axis=1) / np.trapz(weight, filter.wavelength)
+            self.lndelta[i,:] = np.log(delta)
+        
+        self.slope = np.diff(self.lndelta, axis=1)/dAv
+        
+    def correction(self, EBV, mag=True):
+        """
+        Extinction corrections for an array of E(B-V) values.
+        
+        Returns an [NOBJ, NFILT] array of magnitude corrections, 
+        2.5*log10(delta), or flux factors, 1/delta, if `mag` is False, 
+        as in `FilterDefinition.extinction_correction`.
+        """
+        Av = np.atleast_1d(np.asarray(EBV, dtype=np.double))*self.Rv
+        iA = np.clip(np.cast[int](np.floor(Av/self.dAv)), 0, len(self.Av_grid)-2)
+        dA = (Av-self.Av_grid[iA]).reshape((-1,1))
+        
+        lndelta = self.lndelta[:,iA].T + self.slope[:,iA].T*dA
+        
+        if mag:
+            return 2.5/np.log(10)*lndelta
+        else:
+            return np.exp(-lndelta)
+            
 class FilterFile:
-    def __init__(self, file='FILTER.RES.v8.R300'):
+    def __init__(self, file='FILTER.RES.v8.R300', cache=True):
         """
         Read a EAZY (HYPERZ) filter file.
+        
+        If `cache` is set, the parsed filters are stored in a packed binary 
+        file, `file`+'.cache', next to the source file.  It is used instead of 
+        the text file as long as it is newer than it.  The wavelength and 
+        transmission arrays of the cache are memory-mapped read-only, so the 
+        individual filter curves are only read when they are used.  Assign 
+        copies of the arrays to modify a filter.
+        """
+        self.file = file
+        cache_file = file+'.cache'
+        
+        if cache and os.path.exists(cache_file):
+            if os.path.getmtime(cache_file) >= os.path.getmtime(file):
+                try:
+                    self._read_cache(cache_file)
+                    return None
+                except:
+                    pass
+        
+        self._read_text(file)
+        if cache:
+            try:
+                self._write_cache(cache_file)
+            except (IOError, OSError):
+                pass
+        
+    def __setattr__(self, name, value):
+        """
+        Rebuild the search index when the list of filters is replaced.
+        """
+        self.__dict__[name] = value
+        if name == 'filters':
+            self.update_index()
+            
+    def _read_text(self, file):
+        """
+        Parse the filter text file.  The data lines are converted all at 
+        once with `np.fromstring`.
         """
         fp = open(file)
         lines = fp.readlines()
         fp.close()
         
-        filters = []
-        wave = []
+        headers, starts = [], []
+        data_lines = []
         for line in lines:
             if 'lambda_c' in line:
-                if len(wave) > 0:
-                    new_filter = FilterDefinition()
-                    new_filter.name = header
-                    new_filter.wavelength = np.cast[float](wave)
-                    new_filter.transmission = np.cast[float](trans)
-                    filters.append(new_filter)
-                    
-                header = ' '.join(line.split()[1:])
-                wave = []
-                trans = []
+                headers.append(' '.join(line.split()[1:]))
+                starts.append(len(data_lines))
             else:
-                lspl = np.cast[float](line.split())
-                wave.append(lspl[1])
-                trans.append(lspl[2])
-        # last one
-        new_filter = FilterDefinition()
-        new_filter.name = header
-        new_filter.wavelength = np.cast[float](wave)
-        new_filter.transmission = np.cast[float](trans)
-        filters.append(new_filter)
+                data_lines.append(line)
+        
+        starts.append(len(data_lines))
+        data = np.fromstring(' '.join(data_lines), sep=' ')
+        if data.size == 3*len(data_lines):
+            data = data.reshape((-1,3))
+        else:
+            data = np.array([np.cast[float](line.split()[:3]) for line in data_lines])
+        
+        filters = []
+        for i in range(len(headers)):
+            ### Skip empty filters, except the last one
+            if (starts[i+1] == starts[i]) & (i < len(headers)-1):
+                continue
+                
+            new_filter = FilterDefinition()
+            new_filter.name = headers[i]
+            new_filter.wavelength = data[starts[i]:starts[i+1],1]*1
+            new_filter.transmission = data[starts[i]:starts[i+1],2]*1
+            filters.append(new_filter)
            
         self.filters = filters
         self.NFILT = len(filters)
     
+    def _write_cache(self, cache_file):
+        """
+        Write the packed binary cache:
+        
+            4s    magic 'FRES'
+            int32 NFILT
+            int64 offsets[NFILT+1]
+            f8    pivot[NFILT], rectwidth[NFILT]
+            f8    wavelength[N], transmission[N]
+            names, newline-separated
+        """
+        npts = np.array([len(filter.wavelength) for filter in self.filters])
+        offsets = np.append(0, np.cumsum(npts))
+        
+        fp = open(cache_file,'wb')
+        fp.write('FRES')
+        np.array([self.NFILT], dtype='<i4').tofile(fp)
+        np.cast[np.int64](offsets).astype('<i8').tofile(fp)
+        np.array([filter.pivot() for filter in self.filters], dtype='<f8').tofile(fp)
+        np.array([filter.rectwidth() for filter in self.filters], dtype='<f8').tofile(fp)
+        for attr in ['wavelength', 'transmission']:
+            for filter in self.filters:
+                np.asarray(getattr(filter, attr), dtype='<f8').tofile(fp)
+        
+        fp.write('\n'.join([filter.name for filter in self.filters]))
+        fp.close()
+        
+    def _read_cache(self, cache_file):
+        """
+        Read the packed binary cache written by `_write_cache`.
+        """
+        fp = open(cache_file,'rb')
+        if fp.read(4) != 'FRES':
+            fp.close()
+            raise IOError('%s is not a filter cache file' %(cache_file))
+            
+        NFILT = np.fromfile(fp, dtype='<i4', count=1)[0]
+        offsets = np.fromfile(fp, dtype='<i8', count=NFILT+1)
+        pivot = np.fromfile(fp, dtype='<f8', count=NFILT)
+        rectwidth = np.fromfile(fp, dtype='<f8', count=NFILT)
+        data_start = fp.tell()
+        fp.seek(data_start+2*8*offsets[-1])
+        names = fp.read().split('\n')
+        fp.close()
+        
+        data = np.memmap(cache_file, dtype='<f8', mode='r', offset=data_start, shape=(2, offsets[-1]))
+        
+        filters = []
+        for i in range(NFILT):
+            new_filter = FilterDefinition()
+            new_filter.name = names[i]
+            new_filter.wavelength = data[0, offsets[i]:offsets[i+1]]
+            new_filter.transmission = data[1, offsets[i]:offsets[i+1]]
+            new_filter._cache = {'wavelength':new_filter.wavelength,
+                                 'transmission':new_filter.transmission,
+                                 'pivot':pivot[i], 'rectwidth':rectwidth[i]}
+            filters.append(new_filter)
+        
+        self.filters = filters
+        self.NFILT = NFILT
+        
+    def update_index(self):
+        """
+        Precompute the name lists used by `search` and a keyword index 
+        {lowercase word of the filter name: [indices]} in `self.keywords`.
+        
+        The sorted suffixes of the keywords are stored with their keyword in 
+        `self._suffixes`, so that the keywords containing a string are found 
+        with a binary search for the suffixes that start with it.
+        
+        The index is updated when `filters` is assigned.  Call it 
+        explicitly after adding, removing or renaming filters in place.
+        """
+        self._names = [filter.name for filter in self.filters]
+        self._names_upper = [name.upper() for name in self._names]
+        
+        self.keywords = {}
+        for i, name in enumerate(self._names):
+            for word in name.lower().replace('/',' ').split():
+                if word not in self.keywords:
+                    self.keywords[word] = []
+                    
+                self.keywords[word].append(i)
+        
+        suffixes = set()
+        for word in self.keywords:
+            for j in range(len(word)):
+                suffixes.add((word[j:], word))
+        
+        self._suffixes = sorted(suffixes)
+        self._suffix_keys = [suffix[0] for suffix in self._suffixes]
+        
     def names(self, verbose=True):
         """
         Print the filter names.
@@ -198,23 +406,40 @@ class FilterFile:
         """ 
         Search filter names for `search_string`.  If `case` is True, then
         match case.
+        
+        Plain words (letters, digits and underscores) are looked up in the 
+        keyword index, since they can only match within a single word of a
+        filter name.  Anything else is treated as a regular expression.
+        See `update_index` for filters changed in place.
         """
         import re
+        import bisect
         
-        if not case:
+        if case:
+            names = self._names
+        else:
             search_string = search_string.upper()
+            names = self._names_upper
+        
+        if re.match(r'^\w+$', search_string) is not None:
+            word = search_string.lower()
+            candidates = set()
+            j = bisect.bisect_left(self._suffix_keys, word)
+            while (j < len(self._suffix_keys)) and \
+                  self._suffix_keys[j].startswith(word):
+                candidates.update(self.keywords[self._suffixes[j][1]])
+                j += 1
+            
+            matched = [i for i in sorted(candidates) 
+                       if search_string in names[i]]
+        else:
+            regex = re.compile(search_string)
+            matched = [i for i in range(len(names)) 
+                       if regex.search(names[i]) is not None]
         
-        matched = []
-        
-        for i in range(len(self.filters)):
-            filt_name = self.filters[i].name
-            if not case:
-                filt_name = filt_name.upper()
-                
-            if re.search(search_string, filt_name) is not None:
-                if verbose:
-                    print '%5d %s' %(i+1, self.filters[i].name)
-                matched.append(i)
+        if verbose:
+            for i in matched:
+                print '%5d %s' %(i+1, self.filters[i].name)
         
         return np.array(matched)
         
@@ -652,13 +877,7 @@ def getAllPz(MAIN_OUTPUT_FILE='photz', OUTPUT_DIRECTORY='./OUTPUT', CACHE_FILE='
     
     tempfilt, coeffs, temp_seds, pz = eazy.readEazyBinary(MAIN_OUTPUT_FILE=MAIN_OUTPUT_FILE, OUTPUT_DIRECTORY=OUTPUT_DIRECTORY, CACHE_FILE = CACHE_FILE)
     
-    full_pz = np.zeros((pz['NZ'], pz['NOBJ']))
-    for i in xrange(pz['NOBJ']):
-        #print i
-        zz, pzi = eazy.getEazyPz(i, MAIN_OUTPUT_FILE=MAIN_OUTPUT_FILE, OUTPUT_DIRECTORY=OUTPUT_DIRECTORY, CACHE_FILE=CACHE_FILE, binaries=(tempfilt, pz))
-        full_pz[:,i] = pzi
-    
-    return zz, full_pz
+    return eazy.convert_chi_to_pdf(tempfilt, pz)
             
 def getEazyPz(idx, MAIN_OUTPUT_FILE='photz', OUTPUT_DIRECTORY='./OUTPUT', CACHE_FILE='Same', binaries=None, get_prior=False):
     """
@@ -702,6 +921,175 @@ zgrid, pz = getEazyPz(idx, \
     else:
         return tempfilt['zgrid'], pzi
         
+#### Compact, quantized p(z) archive
+PZ_ARCHIVE_MAGIC = 'PZQ1'
+
+def write_pz_archive(file, zgrid, pz, bits=8, lnrange=20., chunk_size=20000):
+    """
+    Write a [NZ, NOBJ] p(z) matrix to a compact archive that can be read with
+    `PzArchive`.
+    
+    For each object only the window of the redshift grid where 
+    p(z) > max(p(z))*exp(-`lnrange`) is stored, with ln(p/max(p)) quantized 
+    to unsigned integers of `bits` (8 or 16) bits.  The largest integer 
+    value is reserved for p(z)=0.
+    
+    File layout (little-endian):
+    
+        4s    magic 'PZQ1'
+        int32 NZ, NOBJ, bits
+        f8    lnrange
+        f8    zgrid[NZ]
+        index[NOBJ]: (int64 offset, int32 i0, int32 n, f8 ln(max p))
+        uint8/uint16 data
+    
+    where object `i` has p(z) values in zgrid[i0:i0+n] stored at 
+    data[offset:offset+n].
+    """
+    NZ, NOBJ = pz.shape
+    qtype = {8:np.uint8, 16:np.uint16}[bits]
+    qmax = 2**bits-1
+    
+    index = np.zeros(NOBJ, dtype=PzArchive.index_dtype)
+    
+    fp = open(file,'wb')
+    fp.write(PZ_ARCHIVE_MAGIC)
+    np.array([NZ, NOBJ, bits], dtype='<i4').tofile(fp)
+    np.array([lnrange], dtype='<f8').tofile(fp)
+    np.asarray(zgrid, dtype='<f8').tofile(fp)
+    
+    #### Reserve space for the index, written after the data
+    index_start = fp.tell()
+    index.tofile(fp)
+    
+    offset = 0
+    cols = np.arange(NZ)
+    for i0 in range(0, NOBJ, chunk_size):
+        pzi = np.asarray(pz[:,i0:i0+chunk_size], dtype=np.double).T
+        N = pzi.shape[0]
+        pmax = pzi.max(axis=1)
+        ok = pmax > 0
+        
+        with np.errstate(divide='ignore'):
+            lnp = np.log(pzi/np.where(ok, pmax, 1).reshape((-1,1)))
+            
+        above = (lnp >= -lnrange) & ok.reshape((-1,1))
+        first = np.argmax(above, axis=1)
+        last = NZ-1-np.argmax(above[:,::-1], axis=1)
+        n = (last-first+1)*ok
+        
+        window = (cols >= first.reshape((-1,1))) & (cols <= last.reshape((-1,1))) & ok.reshape((-1,1))
+        q = np.round(-lnp/lnrange*(qmax-1))
+        q[~np.isfinite(q) | (q > qmax-1)] = qmax
+        q[pzi <= 0] = qmax
+        
+        sub = index[i0:i0+N]
+        sub['i0'] = first*ok
+        sub['n'] = n
+        sub['offset'] = offset + np.cumsum(n) - n
+        sub['lnpmax'] = np.where(ok, np.log(np.where(ok, pmax, 1)), -np.inf)
+        offset += n.sum()
+        
+        np.cast[qtype](q[window]).astype(np.dtype(qtype).newbyteorder('<')).tofile(fp)
+    
+    fp.seek(index_start)
+    index.tofile(fp)
+    fp.close()
+
+def pz_to_archive(file=None, MAIN_OUTPUT_FILE='photz', OUTPUT_DIRECTORY='./OUTPUT', CACHE_FILE='Same', **kwargs):
+    """
+    Convert the p(z) of an EAZY .pz binary file to a `PzArchive` file, 
+    by default OUTPUT_DIRECTORY/MAIN_OUTPUT_FILE.pzq
+    """
+    tempfilt, coeffs, temp_seds, pz = readEazyBinary(MAIN_OUTPUT_FILE=MAIN_OUTPUT_FILE, OUTPUT_DIRECTORY=OUTPUT_DIRECTORY, CACHE_FILE = CACHE_FILE)
+    
+    if file is None:
+        file = OUTPUT_DIRECTORY+'/'+MAIN_OUTPUT_FILE+'.pzq'
+    
+    zgrid, full_pz = convert_chi_to_pdf(tempfilt, pz)
+    write_pz_archive(file, zgrid, full_pz, **kwargs)
+    return file
+    
+class PzArchive():
+    """
+    Random access to a p(z) archive written by `write_pz_archive`.  
+    
+    The index and the quantized data are memory-mapped, so reading any single
+    object is O(1) and doesn't load the file.
+    
+    >>> pza = PzArchive('OUTPUT/photz.pzq')
+    >>> zgrid, pz = pza.getPz(100)
+    >>> zgrid, pz_matrix = pza.getPzs([1,5,100])  # [NZ, 3]
+    
+    """
+    index_dtype = np.dtype([('offset','<i8'), ('i0','<i4'), ('n','<i4'), ('lnpmax','<f8')])
+    
+    def __init__(self, file='OUTPUT/photz.pzq'):
+        self.file = file
+        fp = open(file,'rb')
+        magic = fp.read(4)
+        if magic != PZ_ARCHIVE_MAGIC:
+            fp.close()
+            raise IOError('%s is not a p(z) archive' %(file))
+            
+        self.NZ, self.NOBJ, self.bits = np.fromfile(fp, dtype='<i4', count=3)
+        self.lnrange = np.fromfile(fp, dtype='<f8', count=1)[0]
+        self.zgrid = np.fromfile(fp, dtype='<f8', count=self.NZ)
+        index_start = fp.tell()
+        fp.close()
+        
+        self.qmax = 2**self.bits-1
+        self.index = np.memmap(file, dtype=self.index_dtype, mode='r', offset=index_start, shape=(self.NOBJ,))
+        
+        data_start = index_start + self.NOBJ*self.index_dtype.itemsize
+        qtype = {8:'<u1', 16:'<u2'}[self.bits]
+        ndata = self.index['n'].sum() if self.NOBJ > 0 else 0
+        if ndata > 0:
+            self.data = np.memmap(file, dtype=qtype, mode='r', offset=data_start, shape=(ndata,))
+        else:
+            self.data = np.zeros(0, dtype=qtype)
+    
+    def _decode(self, q, lnpmax):
+        lnp = lnpmax - q*self.lnrange/(self.qmax-1.)
+        return np.exp(lnp)*(q < self.qmax)
+        
+    def getPz(self, idx):
+        """
+        Return zgrid, p(z) of object index `idx`, like `getEazyPz`.
+        """
+        ix = self.index[idx]
+        pz = np.zeros(self.NZ)
+        if ix['n'] > 0:
+            q = np.asarray(self.data[ix['offset']:ix['offset']+ix['n']], dtype=np.double)
+            pz[ix['i0']:ix['i0']+ix['n']] = self._decode(q, ix['lnpmax'])
+        
+        return self.zgrid, pz
+        
+    def getPzs(self, ids=None):
+        """
+        Decode the p(z) of many objects at once.  Returns zgrid and an 
+        [NZ, N(ids)] matrix (the layout of `getAllPz`), by default for all 
+        objects.
+        """
+        if ids is None:
+            ids = np.arange(self.NOBJ)
+        
+        ids = np.atleast_1d(ids)
+        ix = np.asarray(self.index[ids])
+        n = np.cast[np.int64](ix['n'])
+        
+        pz = np.zeros((len(ids), self.NZ))
+        if n.sum() == 0:
+            return self.zgrid, pz.T
+        
+        #### Flat indices of all of the stored values
+        obj = np.repeat(np.arange(len(ids)), n)
+        within = np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n)
+        q = np.asarray(self.data[ix['offset'][obj]+within], dtype=np.double)
+        pz[obj, ix['i0'][obj]+within] = self._decode(q, ix['lnpmax'][obj])
+        
+        return self.zgrid, pz.T
+        
 class TemplateError():
     """
     Make an easy (spline) interpolator for the template error function
@@ -764,13 +1152,61 @@ class Template():
         
 class TemplateInterpolator():
     """
-    Class to use scipy spline interpolator to interpolate pre-computed eazy template 
-    photometry at arbitrary redshift(s).
+    Class to interpolate pre-computed eazy template photometry at arbitrary 
+    redshift(s).
+    
+    The full `tempfilt` [NFILT, NTEMP, NZ] grid is stored as a single tensor of 
+    piecewise polynomial coefficients, `self.coeffs` [K+1, NZ-1, NFILT, NTEMP], 
+    so that all filters and templates are evaluated at an array of redshifts 
+    in one vectorized call.  `kind` can be 'cubic' (the not-a-knot 
+    interpolating spline, identical to `InterpolatedUnivariateSpline`) or 
+    'linear'.
+    
+    If `pickle_file` is specified and exists, the interpolator is read from 
+    that file rather than being computed from the EAZY binaries, as long as 
+    it was made with the same arguments and the binaries haven't changed 
+    since.  Otherwise the new interpolator is written there with `save`.
     """
-    def __init__(self, bands=None, MAIN_OUTPUT_FILE='photz', OUTPUT_DIRECTORY='./OUTPUT', CACHE_FILE='Same', zout=None, f_lambda=True):
+    def __init__(self, bands=None, MAIN_OUTPUT_FILE='photz', OUTPUT_DIRECTORY='./OUTPUT', CACHE_FILE='Same', zout=None, f_lambda=True, kind='cubic', pickle_file=None):
         from scipy import interpolate
         import threedhst.eazyPy as eazy
         
+        #### Arguments and the age of the EAZY binaries, to check that a 
+        #### pickled interpolator is still valid
+        if bands is not None:
+            bands = list(bands)
+            
+        root = OUTPUT_DIRECTORY+'/'+MAIN_OUTPUT_FILE
+        if CACHE_FILE == 'Same':
+            source_files = [root+'.tempfilt']
+        else:
+            source_files = [CACHE_FILE]
+        
+        source_files += [root+ext for ext in ['.coeff','.temp_sed','.pz']]
+        source_mtime = max([os.path.getmtime(file) for file in source_files
+                            if os.path.exists(file)] + [0])
+        
+        if zout is None:
+            zout_file = None
+        else:
+            zout_file = zout.filename
+            
+        self.pickle_args = {'bands':bands, 'MAIN_OUTPUT_FILE':MAIN_OUTPUT_FILE,
+                            'OUTPUT_DIRECTORY':OUTPUT_DIRECTORY,
+                            'CACHE_FILE':CACHE_FILE, 'zout':zout_file,
+                            'f_lambda':f_lambda, 'kind':kind,
+                            'source_mtime':source_mtime}
+        
+        if (pickle_file is not None) and os.path.exists(pickle_file):
+            pickle_args = self.pickle_args
+            self.load(pickle_file)
+            if getattr(self, 'pickle_args', None) == pickle_args:
+                return None
+            
+            print 'TemplateInterpolator: %s is out of date, rebuilding.' %(pickle_file)
+            self.__dict__.clear()
+            self.pickle_args = pickle_args
+            
         #### Read the files from the specified output
         tempfilt, coeffs, temp_seds, pz = eazy.readEazyBinary(MAIN_OUTPUT_FILE=MAIN_OUTPUT_FILE, OUTPUT_DIRECTORY=OUTPUT_DIRECTORY, CACHE_FILE = CACHE_FILE)
         
@@ -803,8 +1239,7 @@ class TemplateInterpolator():
         self.in_zgrid = tempfilt['zgrid']
         self.tempfilt = tempfilt['tempfilt'][self.bands, :, :]
         if f_lambda:
-            for i in range(self.NFILT):
-                self.tempfilt[i,:,:] /= (self.lc[i]/5500.)**2
+            self.tempfilt /= ((self.lc/5500.)**2).reshape((-1,1,1))
                 
         ###### IGM absorption
         self.igm_wave = []
@@ -815,15 +1250,44 @@ class TemplateInterpolator():
         self._spline_da = interpolate.InterpolatedUnivariateSpline(self.in_zgrid, temp_seds['da'])
         self._spline_db = interpolate.InterpolatedUnivariateSpline(self.in_zgrid, temp_seds['db'])
         
-        #### Make a 2D list of the spline interpolators
-        self._interpolators = [range(self.NTEMP) for i in range(self.NFILT)]                
-        for i in range(self.NFILT):
-            for j in range(self.NTEMP):
-                self._interpolators[i][j] = interpolate.InterpolatedUnivariateSpline(self.in_zgrid, self.tempfilt[i, j, :])
-        #
+        #### Piecewise polynomial coefficients of the full grid
+        self.kind = kind
+        self.coeffs = tempfilt_coefficients(self.tempfilt, self.in_zgrid, kind=kind)
+        
         self.output = None
         self.zout = None
+        
+        if pickle_file is not None:
+            self.save(pickle_file)
+    
+    def save(self, file='photz.interpolator.pkl'):
+        """
+        Pickle the interpolator to `file` so that it can be read back with 
+        `TemplateInterpolator(pickle_file=file)` without repeating the
+        construction.
+        """
+        import pickle
+        fp = open(file,'wb')
+        pickle.dump(self.__dict__, fp, 2)
+        fp.close()
     
+    def load(self, file='photz.interpolator.pkl'):
+        """
+        Read an interpolator written with `save`.
+        """
+        import pickle
+        fp = open(file,'rb')
+        self.__dict__.update(pickle.load(fp))
+        fp.close()
+        
+    def evaluate(self, z):
+        """
+        Evaluate the template photometry at the array of redshifts `z`.
+        
+        Returns an [N(z), NFILT, NTEMP] array.
+        """
+        return evaluate_tempfilt_coefficients(self.coeffs, self.in_zgrid, z)
+        
     def interpolate_photometry(self, zout):
         """
         Interpolate the EAZY template photometry at `zout`, which can be a number or an 
@@ -831,13 +1295,12 @@ class TemplateInterpolator():
         
         The result is returned from the function and also stored in `self.output`.
         """               
-        output = [range(self.NTEMP) for i in range(self.NFILT)]                
-        for i in range(self.NFILT):
-            for j in range(self.NTEMP):
-                output[i][j] = self._interpolators[i][j](zout)
-        
+        output = np.rollaxis(self.evaluate(zout), 0, 3)
+        if np.isscalar(zout):
+            output = output[:,:,0]
+            
         self.zgrid = np.array(zout)
-        self.output = np.array(output)
+        self.output = output
         return self.output
         
     def check_extrapolate(self):
@@ -868,7 +1331,7 @@ class TemplateInterpolator():
         igm_factor = np.ones(self.templam.shape[0])
         igm_factor[self.igm_wave[0]] = 0.
         igm_factor[self.igm_wave[1]] = 1. - self._spline_db(z)
-        igm_factor[self.igm_wave[1]] = 1. - self._spline_da(z)
+        igm_factor[self.igm_wave[2]] = 1. - self._spline_da(z)
         
         if matrix:
             self.igm_factor = np.dot(igm_factor.reshape(-1,1), np.ones((1, self.NTEMP)))
@@ -880,6 +1343,59 @@ class TemplateInterpolator():
         
         if not silent:
             return self.igm_lambda, self.igm_factor
+
+def tempfilt_coefficients(tempfilt, zgrid, kind='cubic'):
+    """
+    Compute piecewise polynomial coefficients that interpolate a [NFILT, NTEMP, NZ] 
+    "tempfilt" grid along the redshift axis.
+    
+    `kind` is 'cubic' for the not-a-knot interpolating spline (same as 
+    `scipy.interpolate.InterpolatedUnivariateSpline`, k=3) or 'linear'.
+    
+    Returns an array `coeffs` with shape [K+1, NZ-1, NFILT, NTEMP], where the 
+    value in interval `i` is 
+    
+        sum_k coeffs[k,i,:,:] * (z-zgrid[i])**(K-k)
+    
+    (the same convention as `scipy.interpolate.PPoly`).
+    """
+    from scipy import interpolate
+    
+    yz = np.rollaxis(np.asarray(tempfilt, dtype=np.double), 2, 0)
+    if kind == 'linear':
+        slope = np.diff(yz, axis=0)/np.diff(zgrid).reshape((-1,1,1))
+        return np.array([slope, yz[:-1]])
+    
+    if kind != 'cubic':
+        raise ValueError("`kind` must be 'cubic' or 'linear'")
+        
+    spl = interpolate.make_interp_spline(zgrid, yz, k=3, axis=0)
+    coeffs = np.zeros((4,)+yz[:-1].shape)
+    for k in range(4):
+        ### Taylor coefficients at the left side of each interval
+        coeffs[3-k] = spl(zgrid[:-1], nu=k)/[1., 1., 2., 6.][k]
+    
+    return coeffs
+
+def evaluate_tempfilt_coefficients(coeffs, zgrid, z):
+    """
+    Evaluate the piecewise polynomial `coeffs` from `tempfilt_coefficients`
+    at the array of redshifts `z` with Horner's rule.
+    
+    Returns an array with shape [N(z), NFILT, NTEMP].  Values outside of 
+    `zgrid` are extrapolated from the first/last interval.
+    """
+    z = np.atleast_1d(np.asarray(z, dtype=np.double))
+    iz = np.clip(np.searchsorted(zgrid, z, side='right')-1, 0, len(zgrid)-2)
+    dz = (z-zgrid[iz]).reshape((-1,1,1))
+    
+    output = coeffs[0][iz]
+    for k in range(1, coeffs.shape[0]):
+        output *= dz
+        output += coeffs[k][iz]
+    
+    return output
+
 #
 def interpolate_tempfilt_loop(tempfilt, zgrid, zi, output):
     """    
@@ -906,12 +1422,70 @@ def interpolate_tempfilt_loop(tempfilt, zgrid, zi, output):
     
     return output
 
+def _interpolate_tempfilt_kernel(tempfilt, zgrid, iz, fint, inside, output):
+    """
+    Loop kernel for `interpolate_tempfilt`, compiled with numba if available.
+    
+    `output` is [NZI, NFILT, NTEMP]
+    """
+    NF, NT = tempfilt.shape[0], tempfilt.shape[1]
+    for k in range(output.shape[0]):
+        if not inside[k]:
+            continue
+        
+        f2 = fint[k]
+        f1 = 1.-f2
+        for ifilt in range(NF):
+            for itemp in range(NT):
+                output[k, ifilt, itemp] = tempfilt[ifilt, itemp, iz[k]]*f1 + tempfilt[ifilt, itemp, iz[k]+1]*f2
+    
+    return output
+
 try:
-    from numba import double, jit
-    faster_interpolate_tempfilt = jit(double[:,:](double[:,:,:], double[:], double, double[:,:]))(interpolate_tempfilt_loop)
+    from numba import njit
+    _interpolate_tempfilt_kernel_jit = njit(_interpolate_tempfilt_kernel)
 except:
-    faster_interpolate_tempfilt = interpolate_tempfilt_loop
-    #pass
+    _interpolate_tempfilt_kernel_jit = None
+    
+def interpolate_tempfilt(tempfilt, zgrid, zi, use_numba=True):
+    """
+    Linear interpolate an Eazy "tempfilt" grid at many redshifts at once.
+    
+    `tempfilt` is [NFILT, NTEMP, NZ] integrated flux matrix
+    `zgrid` is [NZ] redshift grid
+    `zi` is a scalar or array of [NZI] redshifts, e.g., z_spec of each object
+    
+    The brackets are found with `np.searchsorted` and the output is a stacked
+    [NZI, NFILT, NTEMP] array.  Redshifts outside of `zgrid` return zeros, as 
+    in `interpolate_tempfilt_loop`.  If `use_numba` and numba is available, 
+    the gather and interpolation are done with a compiled kernel, 
+    otherwise with numpy fancy indexing.
+    """
+    zi = np.atleast_1d(np.asarray(zi, dtype=np.double))
+    NZ = len(zgrid)
+    
+    iz = np.clip(np.searchsorted(zgrid, zi, side='right')-1, 0, NZ-2)
+    fint = (zi-zgrid[iz])/(zgrid[iz+1]-zgrid[iz])
+    inside = (zi >= zgrid[0]) & (zi <= zgrid[-1])
+    
+    if use_numba & (_interpolate_tempfilt_kernel_jit is not None):
+        output = np.zeros((len(zi), tempfilt.shape[0], tempfilt.shape[1]))
+        return _interpolate_tempfilt_kernel_jit(np.ascontiguousarray(tempfilt, dtype=np.double), np.asarray(zgrid, dtype=np.double), iz, fint, inside, output)
+    
+    tz = np.rollaxis(tempfilt, 2, 0)
+    fint = fint.reshape((-1,1,1))
+    output = tz[iz]*(1-fint) + tz[iz+1]*fint
+    output[~inside] = 0.
+    
+    return output
+    
+def faster_interpolate_tempfilt(tempfilt, zgrid, zi, output):
+    """
+    Single-redshift wrapper around `interpolate_tempfilt` with the call 
+    signature of `interpolate_tempfilt_loop`.
+    """
+    output[:,:] = interpolate_tempfilt(tempfilt, zgrid, zi)[0]
+    return output
     
 def convert_chi_to_pdf(tempfilt, pz):
     """
@@ -919,23 +1493,19 @@ def convert_chi_to_pdf(tempfilt, pz):
     
     The `tempfilt` structure is needed to get the redshift grid.
     """
-    pdf = pz['chi2fit']*0.
-
-    for idx in range(pz['NOBJ']):
-        ###### Get p(z|m) from prior grid
-        kidx = pz['kidx'][idx]
-        #print kidx, pz['priorzk'].shape
-        if (kidx > 0) & (kidx < pz['priorzk'].shape[1]):
-            prior = pz['priorzk'][:,kidx]
-        else:
-            prior = np.ones(pz['NZ'])
-
-        ###### Convert Chi2 to p(z)
-        pzi = np.exp(-0.5*(pz['chi2fit'][:,idx]-min(pz['chi2fit'][:,idx])))*prior
-        if np.sum(pzi) > 0:
-            pzi/=np.trapz(pzi, tempfilt['zgrid'])
-            pdf[:,idx] = pzi
-            
+    ###### Convert Chi2 to p(z), in place to only allocate one [NZ, NOBJ] array
+    pdf = pz['chi2fit']-pz['chi2fit'].min(axis=0)
+    pdf *= -0.5
+    np.exp(pdf, out=pdf)
+    
+    ###### Multiply by p(z|m) from prior grid
+    kidx = pz['kidx']
+    has_prior = (kidx > 0) & (kidx < pz['priorzk'].shape[1])
+    pdf[:,has_prior] *= pz['priorzk'][:,kidx[has_prior]]
+    
+    norm = np.trapz(pdf, tempfilt['zgrid'], axis=0)
+    pdf *= (pdf.sum(axis=0) > 0)/np.where(norm != 0, norm, 1)
+    
     return tempfilt['zgrid']*1., pdf
     
 def plotExampleSED(idx=20, writePNG=True, MAIN_OUTPUT_FILE = 'photz', OUTPUT_DIRECTORY = 'OUTPUT', CACHE_FILE = 'Same', lrange=[3000,8.e4], axes=None, individual_templates=False, fnu=False, show_pz=True, snlim=2, scale_flambda=1.e-17, setrc=True):
@@ -1558,7 +2128,7 @@ def log_hist(z, r0=(0,4), dz=0.002, plot=False, *args, **kwargs):
     
     
     
-def loop_zeropoints(root='cosmos', tfile='zphot.translate.cosmos',  zfile='zphot.zeropoint.cosmos', fix_filter={}, ref_filter=None, init_filter={}, ignore_initial=[], ignore_all=[], toler=0.005, PATH='./OUTPUT/', fix_zspec=False, check_uvj=False, use_tweaked_templates=True, MAXITER=15, MIN_ITER=2, wclip=[1200, 3.e4]):
+def loop_zeropoints(root='cosmos', tfile='zphot.translate.cosmos',  zfile='zphot.zeropoint.cosmos', fix_filter={}, ref_filter=None, init_filter={}, ignore_initial=[], ignore_all=[], toler=0.005, PATH='./OUTPUT/', fix_zspec=False, check_uvj=False, use_tweaked_templates=True, MAXITER=15, MIN_ITER=2, wclip=[1200, 3.e4], fast=False, NSUB=5000, snlim=10, processes=1):
     """
     Wrapper around `show_fit_residuals` to allow iterative fitting
     of the zeropoint offsets.
@@ -1596,6 +2166,12 @@ def loop_zeropoints(root='cosmos', tfile='zphot.translate.cosmos',  zfile='zphot
     are not considered in the tolerance calculation, as those "wagging tail"
     bands at the wavelength extremes are typically less well constrained.
     
+     If `fast` is set, only the first iteration is run with the external
+    `eazy` binary.  The following iterations refit a subset of `NSUB` high
+    S/N objects in-process with `fast_zeropoint_iterations` and `eazy` is
+    run once more with the converged zeropoints.  The templates are not
+    tweaked in this mode.
+    
     Example: 
     ========
     
@@ -1705,6 +2281,15 @@ def loop_zeropoints(root='cosmos', tfile='zphot.translate.cosmos',  zfile='zphot
     param.params['GET_ZP_OFFSETS'] = True
     param.write('zphot.param.iter.%s' %(root))
     
+    if fast:
+        #### First full run with the initial errors restored, then iterate
+        #### in-process and rerun once after convergence
+        os.system('eazy -p zphot.param.iter.%s -t zphot.translate.iter.%s -z %s' %(root, root, zfile))
+        eazy.fast_zeropoint_iterations(root=root, zfile=zfile, PATH=PATH, fix_filter=fix_filter, ref_filter=ref_filter, toler=toler, MAXITER=MAXITER, MIN_ITER=MIN_ITER, wclip=wclip, NSUB=NSUB, snlim=snlim, fix_zspec=fix_zspec, processes=processes, fp=fp)
+        os.system('eazy -p zphot.param.iter.%s -t zphot.translate.iter.%s -z %s' %(root, root, zfile))
+        fp.close()
+        return True
+        
     for i in range(MAXITER):
         #### Use tweaked templates after two iterations
         if i == 0:
@@ -1749,6 +2334,177 @@ def loop_zeropoints(root='cosmos', tfile='zphot.translate.cosmos',  zfile='zphot
     
     pass
 
+def zeropoint_residual_offsets(fnu, efnu, obs_sed, lc, zi, wclip=[1200, 3.e4]):
+    """
+    Compute the multiplicative zeropoint offsets from the template fit 
+    residuals as in `show_fit_residuals`, but without any plotting or 
+    template tweaking.
+    
+    `fnu` and `efnu` are the [NFILT, NOBJ] fluxes with the current 
+    zeropoints applied, `obs_sed` is the best-fit template photometry and 
+    `zi` the [NOBJ] redshifts of the fits.
+    """
+    import threedhst
+    
+    resid = (obs_sed-fnu) / obs_sed + 1
+    signoise = fnu/np.sqrt(efnu**2+(0.01*fnu)**2)
+    
+    nfilt = ((efnu > 0) & (fnu > -90)).sum(axis=0)
+    keep = nfilt > (nfilt.max()-5)
+    
+    NFILT = len(lc)
+    medians = np.ones(NFILT)
+    for i in range(NFILT):
+        ok = keep & (resid[i,:] > 0) & (fnu[i,:] > 0)
+        if ok.sum() > 0:
+            medians[i] = np.median(resid[i,ok])
+    
+    #### Overall wiggles as a function of rest-frame wavelength
+    lc_rest = lc.reshape((-1,1))/(1+zi[keep].reshape((1,-1)))
+    lcfull = lc_rest.flatten()
+    residfull = (resid[:,keep]/medians.reshape((-1,1))).flatten()
+    
+    xmfull, ymfull, ysfull, nnfull = threedhst.utils.runmed(lcfull, residfull, NBIN=np.maximum(int(len(residfull)/2000.), 10))
+    ymfull[xmfull > wclip[1]] = 1.
+    ymfull[xmfull < wclip[0]] = 1.
+    
+    offsets = np.ones(NFILT)
+    for i in range(NFILT):
+        lcz = lc[i]/(1+zi)
+        yint = np.interp(lcz, xmfull, ymfull, left=-99, right=-99)
+        ok = keep & (yint > 0) & (resid[i,:] > 0) & (fnu[i,:] > 0)
+        #### ignore Lyman series absorption and IR
+        ok = ok & (lcz > 1500) & (lcz < 2.5e4)
+        if ok.sum() > 0:
+            offsets[i] = np.median(resid[i,ok]/yint[ok])
+    
+    return offsets
+    
+def fast_zeropoint_iterations(root='cosmos', zfile='zphot.zeropoint.cosmos', PATH='./OUTPUT/', fix_filter={}, ref_filter=None, toler=0.005, MAXITER=15, MIN_ITER=2, wclip=[1200, 3.e4], NSUB=5000, snlim=10, fix_zspec=False, processes=1, fp=None):
+    """
+    Iterate the zeropoint offsets in-process, starting from the EAZY 
+    binaries of a previous run in PATH/root.* and the zeropoints in `zfile`.
+    
+    The cached `tempfilt` grid is read once and only a representative 
+    subset of at most `NSUB` objects that have nearly all bands and S/N > 
+    `snlim` (in `ref_filter` if specified, otherwise the median over the 
+    bands) is refit with `fit_nonneg` at every iteration, or only at z_spec 
+    with `fit_nonneg_zfixed` if `fix_zspec`.  The residual 
+    offsets are computed with `zeropoint_residual_offsets`, i.e., without 
+    plotting.  Since the templates integrated in the cached grid can't 
+    change, the templates aren't tweaked between iterations.
+    
+    The converged zeropoints are written to `zfile`.  Offsets are logged to 
+    the open file `fp` if specified.
+    """
+    import threedhst.catIO as catIO
+    
+    if not PATH.endswith('/'):
+        PATH += '/'
+    
+    param = EazyParam('%s%s.param' %(PATH, root))
+    tempfilt, coeffs, temp_seds, pz = readEazyBinary(MAIN_OUTPUT_FILE=root, OUTPUT_DIRECTORY=PATH, CACHE_FILE='Same')
+    
+    fnumbers = np.array([f.fnumber for f in param.filters])
+    lc = tempfilt['lc']
+    zgrid = tempfilt['zgrid']
+    
+    zpfilt, zpval = np.loadtxt(zfile, dtype=np.str, unpack=True)
+    zpval = np.cast[float](zpval)
+    zpf = np.ones(tempfilt['NFILT'])
+    for i in range(len(zpfilt)):
+        zpf[fnumbers == int(zpfilt[i][1:])] = zpval[i]
+    
+    #### Select the subset
+    valid = (tempfilt['fnu'] > -90) & (tempfilt['efnu'] > 0)
+    nfilt = valid.sum(axis=0)
+    sn = tempfilt['fnu']/np.where(valid, tempfilt['efnu'], 1)*valid
+    if ref_filter is not None:
+        sn_sel = sn[fnumbers == ref_filter,:][0]
+    else:
+        sn_sel = np.median(sn, axis=0)
+    
+    sel = (nfilt > (nfilt.max()-5)) & (sn_sel > snlim)
+    if fix_zspec:
+        zout = catIO.Readfile('%s/%s.zout' %(PATH, root))
+        sel &= zout.z_spec > 0
+    
+    idx = np.where(sel)[0]
+    if len(idx) > NSUB:
+        idx = np.sort(np.random.RandomState(1).permutation(idx)[:NSUB])
+    
+    NSUB = len(idx)
+    print 'fast_zeropoint_iterations: fit %d/%d objects' %(NSUB, tempfilt['NOBJ'])
+    
+    sub = tempfilt.copy()
+    sub['NOBJ'] = NSUB
+    fnu, efnu, valid = tempfilt['fnu'][:,idx], tempfilt['efnu'][:,idx], valid[:,idx]
+    
+    #### Redshift prior or fixed redshifts
+    lnprior = np.zeros((tempfilt['NZ'], NSUB))
+    if pz is not None:
+        kidx = pz['kidx'][idx]
+        ok = (kidx > 0) & (kidx < pz['priorzk'].shape[1])
+        lnprior[:,ok] = np.log(np.maximum(pz['priorzk'][:,kidx[ok]], 1.e-300))
+        
+    if fix_zspec:
+        zspec = np.clip(zout.z_spec[idx], zgrid[0], zgrid[-1])
+    
+    #### Template error function and systematic error of the EAZY run
+    fit_args = {}
+    if 'TEMP_ERR_FILE' in param.param_names:
+        xte, yte = np.loadtxt(param['TEMP_ERR_FILE'], unpack=True)
+        fit_args['temp_err'] = (xte, yte*param['TEMP_ERR_A2'])
+    
+    if 'SYS_ERR' in param.param_names:
+        fit_args['sys_err'] = param['SYS_ERR']
+    
+    for it in range(MAXITER):
+        zpfactors = np.where(valid, zpf.reshape((-1,1)), 1.)
+        sub['fnu'] = fnu*zpfactors
+        sub['efnu'] = efnu*zpfactors
+        
+        if fix_zspec:
+            coeffs_best, chi2, tz = fit_nonneg_zfixed(sub, zspec, **fit_args)
+            obs_sed = np.einsum('jik,jk->ij', tz, coeffs_best)
+            zbest = zspec
+        else:
+            coeffs_fit, pz_fit = fit_nonneg(sub, full_coeffs=True, processes=processes, verbose=False, **fit_args)
+            izbest = np.argmin(pz_fit['chi2fit']-2*lnprior, axis=0)
+            coeffs_best = coeffs_fit['coeffs_grid'][izbest,:,np.arange(NSUB)]
+            obs_sed = np.einsum('ijk,kj->ik', tempfilt['tempfilt'][:,:,izbest], coeffs_best)
+            zbest = zgrid[izbest]
+        
+        offsets = zeropoint_residual_offsets(sub['fnu'], sub['efnu'], obs_sed, lc, zbest, wclip=wclip)
+        
+        if ref_filter is not None:
+            offsets /= offsets[fnumbers == ref_filter][0]
+        
+        fixed_bands = lc < 0
+        for fi in fix_filter.keys():
+            fixed_bands |= (fnumbers == fi)
+            offsets[fnumbers == fi] = 1.
+            zpf[fnumbers == fi] = fix_filter[fi]
+        
+        zpf *= offsets
+        
+        if fp is not None:
+            fp.write('\n\nFast iter #%d\n======\n' %(it))
+            log_offsets(fp, fnumbers, lc, offsets, toler)
+        
+        use_bands = (lc > 4500) & (lc < 2.5e4) & ~fixed_bands
+        if (np.abs(offsets[use_bands]-1).max() < toler) & (it >= MIN_ITER):
+            break
+    
+    fpz = open(zfile,'w')
+    for i in range(len(zpfilt)):
+        zpval[i] = zpf[fnumbers == int(zpfilt[i][1:])][0]
+        fpz.write('%s  %.4f\n' %(zpfilt[i], zpval[i]))
+    
+    fpz.close()
+    
+    return fnumbers, lc, zpf
+    
 #
 def log_offsets(fp, fnumbers, lc_i, delta_i, toler):
     so = np.argsort(lc_i)
@@ -1761,6 +2517,87 @@ def log_offsets(fp, fnumbers, lc_i, delta_i, toler):
         print log
         fp.write(log+'\n')
 
+class RestFrameFluxes():
+    """
+    Compute rest-frame fluxes, colors and mass-to-light ratios for a whole
+    catalog directly from the EAZY template coefficients.
+    
+    `temp_sed` is the structure returned by `readEazyBinary`.  The 
+    templates in `temp_sed['temp_seds']` are converted to f_nu as in 
+    `Template.set_fnu`, which is the normalization of the `tempfilt` 
+    grid, so the rest-frame fluxes are in the same units as the observed
+    `fnu` (i.e., like the "l153" columns of the EAZY .rf files).
+    
+    The integrals of all templates through each `FilterDefinition` are 
+    cached by filter name, so that adding a band only requires one 
+    [NFILT, NTEMP] x [NTEMP, NOBJ] matrix product.
+    
+    Example:
+    
+    >>> tempfilt, coeffs, temp_sed, pz = readEazyBinary(MAIN_OUTPUT_FILE='photz')
+    >>> res = FilterFile('FILTER.RES.latest')
+    >>> rf = RestFrameFluxes(temp_sed)
+    >>> UmV = rf.color(coeffs, res.filters[153-1], res.filters[155-1])
+    
+    """
+    def __init__(self, temp_sed):
+        self.templam = temp_sed['templam']
+        self.temp_fnu = temp_sed['temp_seds']*((self.templam/5500.)**2).reshape((-1,1))
+        self.NTEMP = temp_sed['NTEMP']
+        self.integrals = {}
+        
+    def template_integrals(self, filter):
+        """
+        Integrate all templates through a `FilterDefinition`, as in 
+        `Template.integrate_filter` with z=0.  Returns an [NTEMP] array, 
+        cached in `self.integrals[filter.name]`.
+        """
+        if filter.name in self.integrals:
+            return self.integrals[filter.name]
+        
+        wave, trans = filter.wavelength, filter.transmission
+        temp_filter = np.array([np.interp(wave, self.templam, self.temp_fnu[:,j]) for j in range(self.NTEMP)])
+        
+        norm = np.trapz(trans/wave, wave)
+        integrals = np.trapz(temp_filter*trans/wave, wave, axis=1)/norm
+        
+        self.integrals[filter.name] = integrals
+        return integrals
+        
+    def fluxes(self, coeffs, filters):
+        """
+        Rest-frame fluxes through a list of `FilterDefinition` objects for all
+        objects.  `coeffs` is the structure from `readEazyBinary` or 
+        `fit_nonneg`.
+        
+        Returns an [NFILT, NOBJ] array.
+        """
+        if isinstance(filters, FilterDefinition):
+            filters = [filters]
+            
+        tint = np.array([self.template_integrals(filter) for filter in filters])
+        return np.dot(tint, coeffs['coeffs'])
+    
+    def color(self, coeffs, filter1, filter2):
+        """
+        Rest-frame color, e.g., U-V, of all objects in AB magnitudes.
+        """
+        flux = self.fluxes(coeffs, [filter1, filter2])
+        return -2.5*np.log10(flux[0,:]/flux[1,:])
+    
+    def mass_to_light(self, coeffs, filter, ML_templates):
+        """
+        Mass-to-light ratio in `filter` of the template combination, where 
+        the M/L of each template, `ML_templates`, is weighted by the 
+        template's contribution to the rest-frame luminosity in that filter.
+        """
+        ML_templates = np.array(ML_templates)
+        if len(ML_templates) < self.NTEMP:
+            ML_templates = np.append(ML_templates, np.zeros(self.NTEMP-len(ML_templates)))
+        
+        contrib = coeffs['coeffs']*self.template_integrals(filter).reshape((-1,1))
+        return np.dot(ML_templates, contrib)/contrib.sum(axis=0)
+    
 def compute_taylor_mass(root='photz', PATH='OUTPUT', gi=[157,159], ABZP=25):
     """
     Compute stellar masses from Ned Taylor's g-i / Mi relation
@@ -1976,65 +2813,257 @@ def init_nmf(obj, iz, MAIN_OUTPUT_FILE='photz', OUTPUT_DIRECTORY='./OUTPUT', CAC
     plt.plot(lc[mask], obs_fit[mask]/(lc[mask]/5500.)**2)
     
 def nonneg_fact(toler = 1.e-4, verbose=False):
+    """
+    Non-negative fit for the single object / redshift set up by `init_nmf`
+    in the module globals `amatrix` and `bvector`.  See `nonneg_solve`.
+    """
     import threedhst.eazyPy as eazy
-    from scipy import weave
-    from scipy.weave import converters
     
-    out_coeffs = np.ones(eazy.NTEMP)
+    coeffs, itcount = nonneg_solve(eazy.amatrix[None,:,:], -eazy.bvector[None,:], toler=toler, MAXITER=100000)
+    
+    return itcount[0], coeffs[0]
+    
+def nonneg_solve(amatrix, bvector, toler=1.e-4, MAXITER=100000, init_coeffs=None):
+    """
+    Solve many non-negative least-squares problems at once with the EAZY 
+    multiplicative update.
+    
+    `amatrix` is the stack of [NPROB, NTEMP, NTEMP] "A^T A" matrices and 
+    `bvector` the stack of [NPROB, NTEMP] "A^T b" vectors (with the opposite
+    sign of the EAZY `bvector`).  
+    
+    The coefficients are updated in place one template at a time as in 
+    `eazy`, i.e., 
+    
+        coeffs[i] *= bvector[i] / sum_j(amatrix[i,j]*coeffs[j])
+    
+    but for all problems simultaneously.  Problems drop out of the 
+    iteration as they individually reach the fractional tolerance `toler`.
+    Negative `bvector` elements, which can only be satisfied by a zero 
+    coefficient, are clipped to zero.
+    
+    Returns the [NPROB, NTEMP] coefficients and the [NPROB] number of 
+    iterations.
+    """
+    NPROB, NTEMP = bvector.shape
+    bvector = np.maximum(bvector, 0)
+    
+    if init_coeffs is None:
+        coeffs = np.ones((NPROB, NTEMP))
+    else:
+        coeffs = np.cast[np.double](init_coeffs)*1
     
-    NTEMP = eazy.NTEMP
+    itcount = np.zeros(NPROB, dtype=np.int)
     
-    MAXITER=100000 # //// 1.e5
-    tol = 100
-    itcount=0
+    #### `active` are the indices of the problems in the working arrays, 
+    #### which are compressed when most of them have converged.
+    active = np.arange(NPROB)
+    running = np.ones(NPROB, dtype=bool)
     
-    while (tol > toler) & (itcount < MAXITER):
-        tolnum=0.
-        toldenom = 0.
-        tol=0
+    amat, bvec, cc = amatrix, bvector, coeffs*1
+    niter = 0
+    while (len(active) > 0) & (niter < MAXITER):
+        tolnum = np.zeros(len(active))
+        toldenom = np.zeros(len(active))
         for i in range(NTEMP):
-            vold = out_coeffs[i]
-            av = np.sum(eazy.amatrix[i,:]*out_coeffs)
-            #////// Update coeffs in place      
-            out_coeffs[i] *= -1.*eazy.bvector[i]/av
-            tolnum += np.abs(out_coeffs[i]-vold)
+            vold = cc[:,i]*1
+            av = np.einsum('ij,ij->i', amat[:,i,:], cc)
+            cnew = vold*bvec[:,i]/np.where(av > 0, av, 1)*(av > 0)
+            cc[:,i] = np.where(running, cnew, vold)
+            tolnum += np.abs(cc[:,i]-vold)
             toldenom += vold
-        #
-        tol = tolnum/toldenom
-        itcount += 1
-    
-    return itcount, out_coeffs
-    
-    c_code = """
-    long i,j;
-    long itcount,MAXITER,NTEMP;
-    double tolnum,toldenom,tol;
-    double vold,av;
-    //
-    NTEMP = 7;
-    MAXITER=100000; //// 1.e5
-    tol = 100;
-    itcount=0;
-    while (tol>toler && itcount<MAXITER) {
-        tolnum=0.;
-        toldenom = 0.;
-        tol=0;
-        for (i=0;i<NTEMP;++i) {
-            vold = coeffs[i];
-            av = 0.;
-            for (j=0;j<NTEMP;++j) av += amatrix[i][j]*coeffs[j];
-            ////// Update coeffs in place      
-            coeffs[i]*=-1.*bvector[i]/av;
-            tolnum+=fabs(coeffs[i]-vold);
-            toldenom+=vold;
-        }
-        tol = tolnum/toldenom;
-        ++itcount;
-    }
-    """ 
-    
-    #### Doesn't work with the matrix....
-    #result = weave.inline(c_code,['amatrix','bvector','coeffs','toler'], compiler = 'gcc', verbose=2)
+        
+        itcount[active[running]] += 1
+        niter += 1
+        running &= tolnum > toler*toldenom
+        
+        if running.sum() < 0.5*len(active):
+            coeffs[active] = cc
+            active = active[running]
+            amat, bvec, cc = amat[running], bvec[running], cc[running]
+            running = running[running]
+    
+    coeffs[active] = cc
+    return coeffs, itcount
+
+def _fit_nonneg_chunk(args):
+    """
+    Worker for `fit_nonneg`: fit a chunk of objects at all requested redshifts.
+    """
+    tempfilt_z, fnu, efnu, lc_rest, temp_err, sys_err, toler, MAXITER, full_coeffs = args
+    
+    NZ, NFILT, NTEMP = tempfilt_z.shape
+    NOBJ = fnu.shape[1]
+    
+    mask = (fnu > -99) & (efnu > 0)
+    fnu = fnu*mask
+    
+    #### Stacked A^T A and A^T b for all redshifts, 
+    #### [NZ, NOBJ, NTEMP, NTEMP] and [NZ, NOBJ, NTEMP]
+    amatrix = np.zeros((NZ, NOBJ, NTEMP, NTEMP))
+    bvector = np.zeros((NZ, NOBJ, NTEMP))
+    weight = np.zeros((NZ, NFILT, NOBJ))
+    for iz in range(NZ):
+        var = efnu**2 + (sys_err*fnu)**2
+        if temp_err is not None:
+            terr = np.interp(lc_rest[iz], temp_err[0], temp_err[1]).reshape((-1,1))
+            var += (terr*fnu)**2
+        
+        weight[iz] = mask/np.where(mask, var, 1)
+        tt = tempfilt_z[iz]
+        tprod = (tt[:,:,None]*tt[:,None,:]).reshape((NFILT, NTEMP*NTEMP))
+        amatrix[iz] = np.dot(weight[iz].T, tprod).reshape((NOBJ, NTEMP, NTEMP))
+        bvector[iz] = np.dot((fnu*weight[iz]).T, tt)
+    
+    coeffs, itcount = nonneg_solve(amatrix.reshape((-1, NTEMP, NTEMP)), bvector.reshape((-1, NTEMP)), toler=toler, MAXITER=MAXITER)
+    coeffs = np.swapaxes(coeffs.reshape((NZ, NOBJ, NTEMP)), 1, 2)
+    
+    chi2 = np.zeros((NZ, NOBJ))
+    for iz in range(NZ):
+        model = np.dot(tempfilt_z[iz], coeffs[iz])
+        chi2[iz,:] = np.sum((fnu-model)**2*weight[iz], axis=0)
+    
+    izbest = np.argmin(chi2, axis=0)
+    coeffs_best = coeffs[izbest, :, np.arange(NOBJ)].T
+    
+    if full_coeffs:
+        return chi2, izbest, coeffs_best, coeffs
+    else:
+        return chi2, izbest, coeffs_best, None
+    
+def fit_nonneg(tempfilt, idx=None, izgrid=None, sys_err=0., temp_err=None, toler=1.e-4, MAXITER=100000, chunk_size=256, processes=1, full_coeffs=False, verbose=True):
+    """
+    Fit non-negative template combinations to many objects at many redshifts
+    without running the external `eazy` binary.
+    
+    `tempfilt` is the structure returned by `readEazyBinary` (the `fnu` and 
+    `efnu` arrays can be modified, e.g., with updated zeropoints).
+    
+    `idx` optionally selects a subset of objects and `izgrid` a subset of 
+    indices of the redshift grid.
+    
+    The flux variance is computed as in EAZY, 
+    
+        var = efnu**2 + (sys_err*fnu)**2 + (temp_err(lc/(1+z))*fnu)**2
+    
+    where `temp_err` is an optional tuple of (rest wavelength, error) arrays 
+    of the template error function, already scaled by TEMP_ERR_A2 (see 
+    `fit_nonneg_param`).
+    
+    The objects are fit in chunks of `chunk_size` with `nonneg_solve` to 
+    bound the memory use, optionally distributed over `processes` worker 
+    processes.
+    
+    Returns `coeffs` and `pz` structures with the same layout as those of 
+    `readEazyBinary`, i.e., coeffs['coeffs'] [NTEMP, NOBJ] at 
+    coeffs['izbest'] [NOBJ] and pz['chi2fit'] [NZ, NOBJ].  If `full_coeffs`, 
+    coeffs['coeffs_grid'] has the coefficients at all redshifts, 
+    [NZ, NTEMP, NOBJ].
+    """
+    import time
+    
+    t0 = time.time()
+    
+    if idx is None:
+        idx = np.arange(tempfilt['NOBJ'])
+    
+    if izgrid is None:
+        izgrid = np.arange(tempfilt['NZ'])
+    
+    idx = np.atleast_1d(idx)
+    izgrid = np.atleast_1d(izgrid)
+    NOBJ, NZ = len(idx), len(izgrid)
+    NTEMP = tempfilt['NTEMP']
+    
+    tempfilt_z = np.ascontiguousarray(np.rollaxis(tempfilt['tempfilt'][:,:,izgrid], 2, 0))
+    lc_rest = tempfilt['lc']/(1+tempfilt['zgrid'][izgrid].reshape((-1,1)))
+    
+    chunks = []
+    for i in range(0, NOBJ, chunk_size):
+        sub = idx[i:i+chunk_size]
+        chunks.append((tempfilt_z, tempfilt['fnu'][:,sub], tempfilt['efnu'][:,sub], lc_rest, temp_err, sys_err, toler, MAXITER, full_coeffs))
+    
+    if processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=processes)
+        results = pool.map(_fit_nonneg_chunk, chunks)
+        pool.close()
+        pool.join()
+    else:
+        results = map(_fit_nonneg_chunk, chunks)
+    
+    chi2fit = np.hstack([r[0] for r in results])
+    izbest = izgrid[np.hstack([r[1] for r in results])]
+    coeffs_best = np.hstack([r[2] for r in results])
+    
+    coeffs = {'NFILT':tempfilt['NFILT'],'NTEMP':NTEMP,'NZ':NZ,'NOBJ':NOBJ,\
+              'coeffs':coeffs_best,'izbest':np.cast[np.int32](izbest),'tnorm':np.ones(NTEMP), 'idx':idx}
+    
+    if full_coeffs:
+        coeffs['coeffs_grid'] = np.concatenate([r[3] for r in results], axis=2)
+        
+    pz = {'NZ':NZ, 'NOBJ':NOBJ, 'chi2fit':chi2fit, 'izgrid':izgrid}
+    
+    if verbose:
+        print 'fit_nonneg: %d objects x %d redshifts (%.1f s)' %(NOBJ, NZ, time.time()-t0)
+        
+    return coeffs, pz
+
+def fit_nonneg_zfixed(tempfilt, z, sys_err=0., temp_err=None, toler=1.e-4, MAXITER=100000):
+    """
+    Fit non-negative template combinations to all objects in `tempfilt`, 
+    like `fit_nonneg` but only at a fixed redshift for each object, `z` 
+    [NOBJ], e.g., z_spec.  The template photometry is interpolated at each 
+    redshift with `interpolate_tempfilt`.
+    
+    Returns the [NOBJ, NTEMP] coefficients, the [NOBJ] chi-squared and the 
+    [NOBJ, NFILT, NTEMP] interpolated template photometry.
+    """
+    z = np.atleast_1d(z)
+    tz = interpolate_tempfilt(tempfilt['tempfilt'], tempfilt['zgrid'], z)
+    
+    fnu, efnu = tempfilt['fnu'], tempfilt['efnu']
+    mask = (fnu > -99) & (efnu > 0)
+    fnu = fnu*mask
+    
+    var = efnu**2 + (sys_err*fnu)**2
+    if temp_err is not None:
+        lc_rest = tempfilt['lc'].reshape((-1,1))/(1+z)
+        var += (np.interp(lc_rest, temp_err[0], temp_err[1])*fnu)**2
+    
+    weight = mask/np.where(mask, var, 1)
+    amatrix = np.einsum('ij,jik,jil->jkl', weight, tz, tz)
+    bvector = np.einsum('ij,jik->jk', fnu*weight, tz)
+    
+    coeffs, itcount = nonneg_solve(amatrix, bvector, toler=toler, MAXITER=MAXITER)
+    model = np.einsum('jik,jk->ij', tz, coeffs)
+    chi2 = np.sum((fnu-model)**2*weight, axis=0)
+    
+    return coeffs, chi2, tz
+    
+def fit_nonneg_param(MAIN_OUTPUT_FILE='photz', OUTPUT_DIRECTORY='./OUTPUT', CACHE_FILE='Same', binaries=None, **kwargs):
+    """
+    Run `fit_nonneg` with the SYS_ERR and template error function of 
+    an EAZY run, read from OUTPUT_DIRECTORY/MAIN_OUTPUT_FILE.param.
+    
+    To avoid re-reading the binary files, supply binaries = tempfilt.
+    """
+    param = EazyParam(PARAM_FILE=OUTPUT_DIRECTORY+'/'+MAIN_OUTPUT_FILE+'.param')
+    
+    if binaries is None:
+        tempfilt, coeffs, temp_seds, pz = readEazyBinary(MAIN_OUTPUT_FILE=MAIN_OUTPUT_FILE, OUTPUT_DIRECTORY=OUTPUT_DIRECTORY, CACHE_FILE=CACHE_FILE)
+    else:
+        tempfilt = binaries
+    
+    if 'TEMP_ERR_FILE' in param.param_names:
+        xte, yte = np.loadtxt(param['TEMP_ERR_FILE'], unpack=True)
+        yte *= param['TEMP_ERR_A2']
+        kwargs['temp_err'] = (xte, yte)
+    
+    if 'SYS_ERR' in param.param_names:
+        kwargs['sys_err'] = param['SYS_ERR']
+        
+    return fit_nonneg(tempfilt, **kwargs)
     
 def milkyway_extinction(lamb=None, Rv=3.1):
     """
@@ -2171,63 +3200,122 @@ def add_filters():
     #
     res.write('FILTER.RES.latest.mod')
 
-def quadri_pairs(zoutfile='OUTPUT/cdfs.zout', catfile=''):
-    pass
-    c = catIO.Readfile('../Cat2.2/uds.v0.0.15.a.cat.bright', force_lowercase=False)    
-    z = catIO.Readfile('OUTPUT/uds.zout')
-
-    c = catIO.Readfile('Catalog/cosmos.v0.10.7.a.cat.bright', force_lowercase=False)    
-    z = catIO.Readfile('OUTPUT/cosmos.zout')
-
-    c = catIO.Readfile('Catalog/cdfs.v0.4.8.a.cat.bright', force_lowercase=False)    
-    z = catIO.Readfile('OUTPUT/cdfs.zout')
-    kmag = 25-2.5*np.log10(c.Kstot)
+def find_close_pairs(ra, dec, rmax=30.):
+    """
+    Find all pairs of objects separated by less than `rmax` arcsec with a 
+    single KD-tree `query_pairs`.  The coordinates are projected as in
+    `catIO.CoordinateMatcher`.
     
-    c = catIO.Readfile('../Catalogs/goodss_3dhst.v4.0.nzpcat.fixconv.bright', force_lowercase=False)    
-    z = catIO.Readfile('OUTPUT/goodss.zout')
-
-    c = catIO.Readfile('../Catalogs/uds_3dhst.v4.0.nzpcat.HAWKI.bright', force_lowercase=False)    
-    z = catIO.Readfile('OUTPUT/uds.zout')
-
-    kmag = 25-2.5*np.log10(c.f_F160W)
+    Returns arrays `first`, `next` and the separations `dr` (arcsec), with 
+    each pair listed in both orders.
+    """
+    import scipy.spatial
+    
+    ra, dec = np.asarray(ra, dtype=np.double), np.asarray(dec, dtype=np.double)
+    xy = np.array([ra*np.cos(dec/360*2*np.pi), dec]).T
+    tree = scipy.spatial.cKDTree(xy, 10)
+    
+    try:
+        pairs = tree.query_pairs(rmax/3600., output_type='ndarray')
+    except TypeError:
+        pairs = np.array(list(tree.query_pairs(rmax/3600.)))
+    
+    pairs = np.reshape(pairs, (-1,2))
+    first = np.append(pairs[:,0], pairs[:,1])
+    next = np.append(pairs[:,1], pairs[:,0])
+    drs = np.sqrt(np.sum((xy[first]-xy[next])**2, axis=1))*3600.
     
-    m = catIO.CoordinateMatcher(c)
-    ## find pairs
-    first, next, drs = [], [], []
-    for i in range(c.N):
-        print unicorn.noNewLine+'%d/%d' %(i,c.N)
-        dr, idx = m.find_nearest(c.ra[i], c.dec[i], N=60, distance_upper_bound=30./3600.)
-        ok = (dr > 0) & (dr < 30.)
-        first.extend([i]*ok.sum())
-        next.extend(list(idx[ok]))
-        drs.extend(list(dr[ok]))
+    return first, next, drs
+    
+def _random_pair_histogram(args):
+    """
+    Worker for `pair_statistics`: histogram of dz/(1+z) of `N` random pairs 
+    drawn from `z` with random seed `seed`.
+    """
+    z, N, bins, range, seed = args
+    rs = np.random.RandomState(seed)
+    z1 = z[rs.randint(0, len(z), N)]
+    z2 = z[rs.randint(0, len(z), N)]
+    yh, xh = np.histogram((z1-z2)/(1+z1), bins=bins, range=range)
+    return yh
+    
+def pair_statistics(ra, dec, z, rmax=25., select=None, bins=200, range=(-0.3,0.3), NEXTRA=20, processes=1, seed=1):
+    """
+    Photo-z scatter statistics from close pairs (Quadri & Williams 2010).
+    
+    All pairs closer than `rmax` arcsec are found with `find_close_pairs`, 
+    optionally limited to those where both objects have `select` True.  
+    The histogram of dz = (z1-z2)/(1+z1) of the real pairs is compared to 
+    that of `NEXTRA` times as many random pairs drawn from the redshifts of 
+    the paired objects, which can be computed in `processes` worker 
+    processes.
+    
+    Returns a dictionary with the bin edges, `xh`, the pair and random 
+    histograms, `yh` and `yhr` (the latter normalized to the number of real 
+    pairs), and the pair index arrays.
+    """
+    first, next, drs = find_close_pairs(ra, dec, rmax=rmax)
+    z = np.asarray(z)
+    
+    ok = drs < rmax
+    if select is not None:
+        ok &= select[first] & select[next]
+    
+    first, next, drs = first[ok], next[ok], drs[ok]
+    
+    dz = (z[first]-z[next])/(1+z[first])
+    yh, xh = np.histogram(dz, bins=bins, range=range)
+    
+    #### Random pairs, split over the workers
+    NPAIR = len(first)
+    NPROC = np.maximum(processes, 1)
+    NRND = NPAIR*NEXTRA
+    nper = np.diff(np.linspace(0, NRND, NPROC+1).astype(int))
+    args = [(z[first], nper[i], bins, range, seed+i) for i in np.arange(NPROC)]
+    
+    if (NPROC > 1) & (NPAIR > 0):
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=NPROC)
+        results = pool.map(_random_pair_histogram, args)
+        pool.close()
+        pool.join()
+    elif NPAIR > 0:
+        results = map(_random_pair_histogram, args)
+    else:
+        results = [yh*0]
         
-    first = np.array(first)
-    next = np.array(next)
-    drs = np.array(drs)
+    yhr = np.sum(results, axis=0)*1./NEXTRA
     
-    mlim = (18,24)
-    zlim = (0.2,10)
-    ok = (drs < 25) & (kmag[first] > mlim[0]) & (kmag[next] > mlim[0]) & (kmag[first] < mlim[1]) & (kmag[next] < mlim[1]) & (z.z_peak[first] > zlim[0]) & (z.z_peak[next] > zlim[0]) & (z.z_peak[first] < zlim[1]) & (z.z_peak[next] < zlim[1])
+    return {'xh':xh, 'yh':yh, 'yhr':yhr, 'first':first, 'next':next, 'drs':drs, 'dz':dz}
     
-    dz = (z.z_peak[first]-z.z_peak[next])/(1+z.z_peak[first])
-
-    #plt.scatter(drs, dz, alpha=0.03)
-
-    yh, xh = np.histogram(dz[ok], bins=200, range=(-0.3,0.3))
+def quadri_pairs(zoutfile='OUTPUT/cdfs.zout', catfile='', mag_column='f_F160W', ABZP=25, rmax=25., mlim=(18,24), zlim=(0.2,10), NEXTRA=20, processes=1, plot=True):
+    """
+    Show the photo-z pair statistics of a catalog with `pair_statistics`,
+    for pairs where both objects are within the magnitude (of 
+    `mag_column`) and z_peak limits `mlim` and `zlim`.
+    
+    Example:
+    
+    >>> quadri_pairs(zoutfile='OUTPUT/uds.zout', catfile='../Catalogs/uds_3dhst.v4.0.nzpcat.HAWKI.bright')
+    
+    """
+    c = catIO.Readfile(catfile, force_lowercase=False)    
+    z = catIO.Readfile(zoutfile)
     
-    NEXTRA = 20
-    z_rnd1 = z.z_peak[first][ok][np.cast[int](np.random.rand(ok.sum()*NEXTRA)*ok.sum())]
-    z_rnd2 = z.z_peak[first][ok][np.cast[int](np.random.rand(ok.sum()*NEXTRA)*ok.sum())]
-    #next_rnd = np.cast[int](np.random.rand(len(next))*z.N)
-    dz_rnd = (z_rnd1-z_rnd2)/(1+z_rnd1)
-    yhr, xhr = np.histogram(dz_rnd, bins=200, range=(-0.3,0.3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        kmag = ABZP-2.5*np.log10(c[mag_column])
     
-    #plt.plot(xh[:-1], yh, linestyle='steps-mid', alpha=0.5)
-    #plt.plot(xhr[:-1], yhr*1./NEXTRA, linestyle='steps-mid', alpha=0.5)
-    plt.plot(xhr[1:], yh-yhr*1./NEXTRA, alpha=0.5, color='blue') # , linestyle='steps')
-    err = np.sqrt(yhr)
-    plt.fill_between(xhr[1:], yh-yhr*1./NEXTRA+err, yh-yhr*1./NEXTRA-err, color='blue', alpha=0.1)
+    select = (kmag > mlim[0]) & (kmag < mlim[1]) & (z.z_peak > zlim[0]) & (z.z_peak < zlim[1])
+    
+    pairs = pair_statistics(c.ra, c.dec, z.z_peak, rmax=rmax, select=select, NEXTRA=NEXTRA, processes=processes)
+    
+    if plot:
+        xh, yh, yhr = pairs['xh'], pairs['yh'], pairs['yhr']
+        plt.plot(xh[1:], yh-yhr, alpha=0.5, color='blue') # , linestyle='steps')
+        err = np.sqrt(yhr*NEXTRA)
+        plt.fill_between(xh[1:], yh-yhr+err, yh-yhr-err, color='blue', alpha=0.1)
+    
+    return pairs
     
 def show_uncertainties(root='cosmos', PATH='OUTPUT/', candels=False):
     
@@ -2310,9 +3398,137 @@ def show_uncertainties(root='cosmos', PATH='OUTPUT/', candels=False):
     fig.tight_layout(pad=0.1)
     fig.savefig('%s.rms.png' %(root))
     
-def spatial_offset(root='cosmos', PATH='OUTPUT/', apply=False, candels=False):
+class SpatialPolynomial():
+    """
+    Compact, picklable 2D polynomial surface of total degree `degree` in 
+    the catalog coordinates (x, y), used for the spatial zeropoint 
+    offsets.  
+    
+    The coordinates are normalized with the center `x0`, `y0` and 
+    `scale`, and `kind` is either 'chebyshev' (better conditioned at 
+    high degree) or 'polynomial'.  The surface is evaluated by calling 
+    the object, like the astropy `Polynomial2D` models that it replaces.
+    """
+    def __init__(self, degree=8, x0=0., y0=0., scale=1., kind='chebyshev', coeffs=None):
+        self.degree = degree
+        self.x0, self.y0, self.scale = x0, y0, scale
+        self.kind = kind
+        self.coeffs = coeffs
+        
+        #### Terms with i+j <= degree
+        ij = np.indices((degree+1, degree+1)).reshape((2,-1))
+        self.terms = ij[:, ij.sum(axis=0) <= degree]
+        self.NPARAM = self.terms.shape[1]
+        
+    def same_basis(self, other):
+        return ((self.degree == other.degree) & (self.x0 == other.x0) & 
+                (self.y0 == other.y0) & (self.scale == other.scale) & 
+                (self.kind == other.kind))
+        
+    def design_matrix(self, x, y):
+        """
+        [N, NPARAM] design matrix of the polynomial terms at (x,y)
+        """
+        xn = (np.asarray(x, dtype=np.double)-self.x0)/self.scale
+        yn = (np.asarray(y, dtype=np.double)-self.y0)/self.scale
+        if self.kind == 'chebyshev':
+            vx = np.polynomial.chebyshev.chebvander(xn, self.degree)
+            vy = np.polynomial.chebyshev.chebvander(yn, self.degree)
+        else:
+            vx = np.polynomial.polynomial.polyvander(xn, self.degree)
+            vy = np.polynomial.polynomial.polyvander(yn, self.degree)
+        
+        return vx[:,self.terms[0]]*vy[:,self.terms[1]]
+        
+    def __call__(self, x, y):
+        return np.dot(self.design_matrix(x, y), self.coeffs)
+    
+def fit_spatial_polynomials(x, y, values, mask, weights=None, degree=8, kind='chebyshev', clip=0., niter=3):
+    """
+    Fit `SpatialPolynomial` surfaces to many quantities sampled at the same 
+    positions at once.  The fit is linear in the parameters, so the 
+    design matrix is computed once and all of the [NFIT, N] `values` are 
+    fit by weighted least squares with stacked normal equations.
+    
+    `mask` [NFIT, N] selects the points used for each fit and `weights` are 
+    optional [NFIT, N] weights.  Clipping is off by default; if `clip` > 0, 
+    points deviating by more than `clip` times the NMAD of the residuals 
+    are rejected in `niter` iterations, each followed by a new fit.  Fits 
+    with NMAD = 0 aren't clipped.
+    
+    Returns a list of `SpatialPolynomial` objects.
+    """
+    x = np.asarray(x, dtype=np.double)
+    y = np.asarray(y, dtype=np.double)
+    x0, y0 = (x.max()+x.min())/2., (y.max()+y.min())/2.
+    scale = np.maximum(x.max()-x0, y.max()-y0)
+    
+    poly = SpatialPolynomial(degree=degree, x0=x0, y0=y0, scale=scale, kind=kind)
+    A = poly.design_matrix(x, y)
+    NP = poly.NPARAM
+    
+    values = np.atleast_2d(values)
+    mask = np.atleast_2d(mask) & np.isfinite(values)
+    values = np.where(mask, values, 0)
+    if weights is None:
+        weights = np.ones(values.shape)
+    
+    NFIT = values.shape[0]
+    use = mask.copy()
+    for it in range(np.maximum(niter, 0)+1):
+        w = weights*use
+        ata = np.einsum('np,fn,nq->fpq', A, w, A)
+        atb = np.dot(values*w, A)
+        
+        #### Small ridge term for terms not constrained by the data
+        ridge = 1.e-10*np.maximum(np.trace(ata, axis1=1, axis2=2), 1)/NP
+        ata += ridge.reshape((-1,1,1))*np.eye(NP)
+        coeffs = np.array([np.linalg.solve(ata[i], atb[i]) for i in range(NFIT)])
+        
+        if (clip <= 0) | (it == niter):
+            break
+        
+        resid = values-np.dot(coeffs, A.T)
+        for i in range(NFIT):
+            if use[i].sum() == 0:
+                continue
+            
+            rmed = np.median(resid[i, use[i]])
+            nmad = 1.48*np.median(np.abs(resid[i, use[i]]-rmed))
+            if nmad <= 0:
+                continue
+            
+            use[i] = mask[i] & (np.abs(resid[i]-rmed) < clip*nmad)
+    
+    surfaces = []
+    for i in range(NFIT):
+        surfaces.append(SpatialPolynomial(degree=degree, x0=x0, y0=y0, scale=scale, kind=kind, coeffs=coeffs[i]))
+    
+    return surfaces
+
+def evaluate_spatial_polynomials(surfaces, x, y):
+    """
+    Evaluate a list of surfaces at (x,y), in one matrix product if they 
+    share the same basis.  Returns an [NFIT, N] array.
+    """
+    if len(surfaces) == 0:
+        return np.zeros((0, len(x)))
+        
+    if isinstance(surfaces[0], SpatialPolynomial):
+        same = np.array([surfaces[0].same_basis(s) for s in surfaces if isinstance(s, SpatialPolynomial)])
+        if (len(same) == len(surfaces)) & same.all():
+            A = surfaces[0].design_matrix(x, y)
+            return np.dot(np.array([s.coeffs for s in surfaces]), A.T)
+    
+    return np.array([s(x, y) for s in surfaces])
+    
+def spatial_offset(root='cosmos', PATH='OUTPUT/', apply=False, candels=False, degree=8, clip=0.):
     """
     Make a figure showing the *spatial* zeropoint residuals for each filter in a catalog
+    
+    The residuals of all filters are fit at once with `SpatialPolynomial` 
+    surfaces of total degree `degree`.  Set `clip` > 0 to iteratively 
+    reject outliers (see `fit_spatial_polynomials`).
     """
     import threedhst.eazyPy as eazy
     from threedhst import catIO
@@ -2357,45 +3573,50 @@ def spatial_offset(root='cosmos', PATH='OUTPUT/', apply=False, candels=False):
     fitters = {}
     translate = {}
     
+    ### Interpolation
+    if 'x' not in c.colnames:
+        c['x'] = -(c['ra']-np.median(c['ra']))*60
+        c['y'] = (c['dec']-np.median(c['dec']))*60
+    
+    #### Fit the surfaces of all filters at once
+    ratio = fnu/obs_sed
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dmag = -2.5*np.log10(ratio)
+    
+    ok = np.isfinite(dmag) & (signoise > 3) & (np.abs(dmag) < 0.1)
+    fit_filters = np.array([(param.filters[i].lambda_c < 3.e4) & (ok[i,:].sum() > 0) for i in range(len(fnumbers))])
+    
+    surface = np.ones(ratio.shape)
+    if fit_filters.sum() > 0:
+        surfaces = eazy.fit_spatial_polynomials(c['x'], c['y'], ratio[fit_filters,:], ok[fit_filters,:], degree=degree, clip=clip)
+        surface[fit_filters,:] = eazy.evaluate_spatial_polynomials(surfaces, c['x'], c['y'])
+        for i, p in zip(np.arange(len(fnumbers))[fit_filters], surfaces):
+            fitters[cnames[i]] = p
+            translate[cnames[i]] = param.filters[i].fnumber
+        
     for i in range(len(fnumbers)):
         #print i, len(fnumbers), len(cnames)
         
         ax = fig.add_subplot(NY, NX, i+1)
         print param.filters[i].name, cnames[i]
-        dmag = -2.5*np.log10((fnu/obs_sed)[i,:])
-        ok = np.isfinite(dmag) & (signoise[i,:] > 3) & (np.abs(dmag) < 0.1)
-        ratio = (fnu/obs_sed)[i,:]
         
-        if ok.sum() == 0:
+        if ok[i,:].sum() == 0:
             ax.set_xticklabels([]); ax.set_yticklabels([])
             continue
-            
-        ### Interpolation
-        if 'x' not in c.colnames:
-            c['x'] = -(c['ra']-np.median(c['ra']))*60
-            c['y'] = (c['dec']-np.median(c['dec']))*60
-
-        if param.filters[i].lambda_c < 3.e4:
-            from astropy.modeling import models, fitting
-            p_init = models.Polynomial2D(degree=8)
-            #p_init = models.Polynomial2D(degree=12)
-            fit_p = fitting.LevMarLSQFitter()
-            #fit_p = fitting.LinearLSQFitter()
-            p = fit_p(p_init, c['x'][ok], c['y'][ok], ratio[ok]) #, weights=signoise[i,ok]**2)
-            dmag = -2.5*np.log10((fnu/p(c['x'], c['y'])/obs_sed)[i,:])
-        
-            ok = np.isfinite(dmag) & (signoise[i,:] > 3) & (np.abs(dmag) < 0.1)
+        
+        if fit_filters[i]:
+            dmag_i = -2.5*np.log10((fnu/surface/obs_sed)[i,:])
+            ok_i = np.isfinite(dmag_i) & (signoise[i,:] > 3) & (np.abs(dmag_i) < 0.1)
             if apply:
-                ok = c[cnames[i]] > -90
-                c[cnames[i]][ok] /= p(c['x'], c['y'])[ok]
-                c[cnames[i].replace('f_', 'e_')][ok] /= p(c['x'], c['y'])[ok]
-            
-            fitters[cnames[i]] = p
-            translate[cnames[i]] = param.filters[i].fnumber
+                ok_i = c[cnames[i]] > -90
+                c[cnames[i]][ok_i] /= surface[i,ok_i]
+                c[cnames[i].replace('f_', 'e_')][ok_i] /= surface[i,ok_i]
+        else:
+            dmag_i, ok_i = dmag[i,:], ok[i,:]
             
         ax.scatter(c['ra'], c['dec'], c='black', vmin=-0.08, vmax=0.08, alpha=0.1, s=1, marker='.', edgecolor='None')
-        ax.scatter(c['ra'][ok], c['dec'][ok], c=dmag[ok], vmin=-0.08, vmax=0.08, alpha=0.2, s=10, marker='s', edgecolor='None')
-        sc = ax.scatter(c['ra'][ok][0], c['dec'][ok][0], c=dmag[ok][0], vmin=-0.08, vmax=0.08, alpha=1, s=10, marker='s', edgecolor='None')
+        ax.scatter(c['ra'][ok_i], c['dec'][ok_i], c=dmag_i[ok_i], vmin=-0.08, vmax=0.08, alpha=0.2, s=10, marker='s', edgecolor='None')
+        sc = ax.scatter(c['ra'][ok_i][0], c['dec'][ok_i][0], c=dmag_i[ok_i][0], vmin=-0.08, vmax=0.08, alpha=1, s=10, marker='s', edgecolor='None')
         #ax.set_xlabel('RA'); ax.set_ylabel('Dec')
         ax.text(0.5, 0.95, '%s\n(%d)' %(param.filters[i].name, param.filters[i].fnumber), ha='center', va='top', fontsize=8, transform=ax.transAxes, color='red')
         
@@ -2435,13 +3656,16 @@ def apply_spatial_offsets(cat='cdfs.v1.3.1.nzp.cat', pfile='cdfs.v1.3.1.nzp.cat.
     fp.close()
     
     #### Fitter is a dictionary with keys equal to the column headings
-    #### and whose values are astropy.modeling.Polynomial2D models with 
-    #### coordinates 'x' and 'y' from the catalog
-    for col in fitter.keys():
+    #### and whose values are `SpatialPolynomial` (or older
+    #### astropy.modeling.Polynomial2D) models with coordinates 'x' and 'y'
+    #### from the catalog
+    cols = fitter.keys()
+    surface = evaluate_spatial_polynomials([fitter[col] for col in cols], c['x'], c['y'])
+    for i, col in enumerate(cols):
         print col, col in c.columns
         ok = c[col] > -90
-        c[col][ok] *= 1./fitter[col](c['x'], c['y'])[ok]
-        c[col.replace('f_', 'e_')][ok] *= 1./fitter[col](c['x'], c['y'])[ok]
+        c[col][ok] *= 1./surface[i,ok]
+        c[col.replace('f_', 'e_')][ok] *= 1./surface[i,ok]
         
         c[col].format='%.5e'
         c[col.replace('f_', 'e_')].format='%.5e'
@@ -2506,4 +3730,90 @@ def anneal_pz(zgrid, pz, level=0.68):
     ix_level = int(np.round(np.interp(level, out.sum(axis=0), np.arange(len(probs)))))
     z_level = zgrid[1:]*(out[:,ix_level] > 0) 
     
-    return out, z_level, np.min(z_level[z_level > 0]), np.max(z_level[z_level > 0])
\ No newline at end of file
+    return out, z_level, np.min(z_level[z_level > 0]), np.max(z_level[z_level > 0])
+
+def pz_statistics(zgrid, pz, percentiles=[2.5, 16, 50, 84, 97.5], hpd_levels=[0.68, 0.95], chunk_size=20000):
+    """
+    Compute summary statistics of the p(z) of a whole catalog at once.
+    
+    `pz` is the [NZ, NOBJ] matrix from, e.g., `getAllPz` or 
+    `convert_chi_to_pdf`, which doesn't have to be normalized.
+    
+    Returns an OrderedDict with [NOBJ] arrays:
+    
+        z_peak: redshift of the maximum of p(z)
+        z_mean: mean redshift
+        z_median: median redshift
+        z_pXXX: redshift at each cumulative probability in `percentiles`, 
+                e.g., 'z_p16', 'z_p2.5', from the cumulative trapezoid 
+                integral of p(z)
+        hpd_XX_lo, hpd_XX_hi: limits of the highest probability density
+                interval enclosing `hpd_levels` of the probability, e.g., 
+                'hpd_68_lo', as in `anneal_pz`
+    
+    Objects with zero total probability get -99 for all quantities.  The 
+    catalog is processed in chunks of `chunk_size` objects to bound the 
+    memory use.
+    """
+    from collections import OrderedDict
+    
+    NZ, NOBJ = pz.shape
+    zgrid = np.asarray(zgrid, dtype=np.double)
+    dz = np.diff(zgrid)
+    
+    pstr = ['z_p%s' %(('%.1f' %(p)).rstrip('0').rstrip('.')) for p in percentiles]
+    hstr = ['hpd_%s' %(('%.1f' %(100*l)).rstrip('0').rstrip('.')) for l in hpd_levels]
+    
+    out = OrderedDict()
+    for key in ['z_peak', 'z_mean', 'z_median'] + pstr:
+        out[key] = np.zeros(NOBJ)-99
+    
+    for key in hstr:
+        out[key+'_lo'] = np.zeros(NOBJ)-99
+        out[key+'_hi'] = np.zeros(NOBJ)-99
+        
+    for i0 in range(0, NOBJ, chunk_size):
+        sl = slice(i0, i0+chunk_size)
+        pzi = np.asarray(pz[:,sl], dtype=np.double)
+        N = pzi.shape[1]
+        
+        #### Cumulative trapezoid integral
+        cdf = np.zeros((NZ, N))
+        cdf[1:,:] = np.cumsum((pzi[1:,:]+pzi[:-1,:])/2.*dz.reshape((-1,1)), axis=0)
+        norm = cdf[-1,:]
+        ok = norm > 0
+        if ok.sum() == 0:
+            continue
+        
+        ix = np.arange(i0, i0+N)[ok]
+        pzi, cdf, norm = pzi[:,ok], cdf[:,ok], norm[ok]
+        pzi /= norm
+        cdf /= norm
+        N = ok.sum()
+        cols = np.arange(N)
+        
+        out['z_peak'][ix] = zgrid[np.argmax(pzi, axis=0)]
+        out['z_mean'][ix] = np.trapz(pzi*zgrid.reshape((-1,1)), zgrid, axis=0)
+        
+        #### Percentiles, interpolating within the bracketing bins
+        for p, key in zip([50]+list(percentiles), ['z_median']+pstr):
+            q = p/100.
+            k = np.clip((cdf < q).sum(axis=0), 1, NZ-1)
+            c0, c1 = cdf[k-1,cols], cdf[k,cols]
+            frac = (q-c0)/np.where(c1 > c0, c1-c0, 1)
+            out[key][ix] = zgrid[k-1]+np.clip(frac, 0, 1)*dz[k-1]
+        
+        #### HPD intervals: sort the bins by density and step down until 
+        #### the enclosed probability reaches the desired level
+        wbin = pzi[1:,:]*dz.reshape((-1,1))
+        so = np.argsort(-pzi[1:,:], axis=0)
+        csum = np.cumsum(wbin[so, cols], axis=0)
+        for level, key in zip(hpd_levels, hstr):
+            k = np.clip((csum < level*csum[-1,:]).sum(axis=0), 0, NZ-2)
+            thresh = pzi[1:,:][so[k,cols], cols]
+            inside = pzi[1:,:] >= thresh
+            zin = np.where(inside, zgrid[1:].reshape((-1,1)), np.nan)
+            out[key+'_lo'][ix] = np.nanmin(zin, axis=0)
+            out[key+'_hi'][ix] = np.nanmax(zin, axis=0)
+    
+    return out
@@ -9,6 +9,8 @@ __version__ = "$Rev$"
 
 import os
 import glob
+import time
+import hashlib
 
 try:
     import astropy.io.fits as pyfits
@@ -20,22 +22,41 @@ import numpy as np
 # Specifies the size of the map (in pixels).
 TILE_SIZE = 256
 MAP_SIZE = [TILE_SIZE,TILE_SIZE]    
+# Version of the tile rendering, part of the hashes in the tile manifests.
+# Increment when changes to the rendering change the output PNGs.
+TILE_RENDER_VERSION = 1
 # This is the Maps API key for running on localhost:8080
 MAP_KEY = 'ABQIAAAA1XbMiDxx_BTCY2_FkPh06RR20YmIEbERyaW5EQEiVNF0mpNGfBSRb' \
     '_rzgcy5bqzSaTV8cyi2Bgsx3g'
 
 def makeGMapTiles(fitsfile=None,outPath=None,tileroot='direct', extension=1,
                   zmin=-0.1, zmax=1, rgb_params=(5, 3, -0.05), verbose=False, 
-                  rgb_clip=True):
+                  rgb_clip=True, processes=1, skip_empty=True, 
+                  incremental=False):
     """
 makeGMapTiles(fitsfile=None,outPath=None,tileroot='direct', extension=1,
-              zmin=-0.1, zmax=1)
+              zmin=-0.1, zmax=1, processes=1, skip_empty=True, 
+              incremental=False)
     
     Make Google map tiles for an input FITS image, which is assumed to be
     North-up, East-left, like normal Multidrizzle output.
     
     "fitsfile" can be a single FITS image or a comma-separated list of three
     images (R,G,B) that will be used to generate a 3-color image.  
+    
+    The tiles are rendered and written by `processes` worker processes
+    that read them directly from the memory-mapped FITS images, in bands 
+    of tiles along the image rows.  The zero padding of the tiles at the 
+    image edges is only filled in the tile buffers.  Tiles that are 
+    entirely empty (zero) aren't written if `skip_empty` is set.
+    
+    If `incremental` is set, a hash of the source pixels and scaling 
+    parameters of each tile is stored in a manifest file in `outPath`,
+    "[tileroot]_[zoom].manifest", and only tiles whose hash differs 
+    from the previous run are rendered again.  Tiles from the previous run 
+    that are now empty or fall outside of the tile grid are removed.  The 
+    manifest is also rewritten by non-incremental runs, so that it always 
+    describes the tiles on disk.
     """
     import pywcs
     #import fitsimage
@@ -59,16 +80,10 @@ makeGMapTiles(fitsfile=None,outPath=None,tileroot='direct', extension=1,
         
     # print fitsfile, outPath
     
-    ### Read the FITS file
-    fi = pyfits.open(fitsfile[0])
-    head = fi[extension].header
-    data = [fi[extension].data]
-    if RGB:
-        for file in fitsfile[1:]:
-            fi = pyfits.open(file)
-            data.append(fi[extension].data)
-            
-    xsize, ysize = data[0].shape #[1]
+    ### Only need the header here, the tiles are read from the 
+    ### memory-mapped FITS data by the workers
+    head = pyfits.getheader(fitsfile[0], extension)
+    xsize, ysize = head['NAXIS2'], head['NAXIS1']
     
     ### Image corners in Lat/Lon
     wcs = pywcs.WCS(head)
@@ -174,61 +189,301 @@ makeGMapTiles(fitsfile=None,outPath=None,tileroot='direct', extension=1,
     
     #data_copy.resize((int(ysize*pixRatio),int(xsize*pixRatio)))
     #data_copy.resize((dy,dx))
-    fullx = padL+padR+dx
-    fully = padT+padB+dy
-    full_images = []
-    for ch in range(len(data)):
-        full_image = np.zeros((fully,fullx))    
-        if (np.int(padT) == 0) | (np.int(padR) == 0):
-            if (np.int(padT)+np.int(padR)) == 0:
-                full_image[padB:, padR:] = data[ch]*1
-            if (np.int(padT) == 0) & (np.int(padR) != 0):
-                full_image[padB:, padL:-padR] = data[ch]*1
-            if (np.int(padT) != 0) & (np.int(padR) == 0):
-                full_image[padB:-padT, padL:] = data[ch]*1
-        else:
-            full_image[padB:-padT, padL:-padR] = data[ch]*1
-        
-        full_images.append(full_image)
-        
+    fullx = int(padL+padR+dx)
+    fully = int(padT+padB+dy)
+    
     # print pixRatio, dx/xsize, fullx/256., fully/256.
     
-    NX = (padL+padR+dx)*1./TILE_SIZE
-    NY = (padT+padB+dy)*1./TILE_SIZE
+    NX = int(np.ceil(fullx*1./TILE_SIZE))
+    NY = int(np.ceil(fully*1./TILE_SIZE))
     
     tileX0 = int(pixSW.tilex)
     tileY0 = int(pixNE.tiley)
-        
-    for i in np.arange(NX):
-        for j in np.arange(NY):
-            #i,j = 0,0
-            subs = []
-            for ch in range(len(data)):
-                sub = full_images[ch][fully-(j+1)*TILE_SIZE:fully-j*TILE_SIZE,
-                             i*TILE_SIZE:(i+1)*TILE_SIZE]
-                subs.append(sub)
-                
-            if (sub.shape[0] == 0) | (sub.shape[1] == 0):
-                continue
-                
+    
+    render_params = {'zmin':zmin, 'zmax':zmax, 'rgb_params':rgb_params,
+                     'rgb_clip':rgb_clip, 'skip_empty':skip_empty,
+                     'incremental':incremental}
+    
+    #### Hashes of the previous run
+    manifest_file = outPath+'%s_%d.manifest' %(tileroot, zoomLevel)
+    manifest = {}
+    render_params['scale_key'] = str([TILE_RENDER_VERSION,
+                                      np.array(zmin).tolist(), 
+                                      np.array(zmax).tolist(),
+                                      rgb_params, rgb_clip])
+    if incremental and os.path.exists(manifest_file):
+        manifest = readTileManifest(manifest_file)
+    
+    #### Offset of the image in the padded tile grid
+    source = (fitsfile, extension, int(padB), int(padL))
+    
+    #### Tasks are bands of tiles along a row, read from the memory-mapped 
+    #### image one after the other so that only a band of the image 
+    #### needs to be paged in by each worker at a time
+    tasks = []
+    for j in range(NY):
+        band = []
+        for i in range(NX):
             outfile = outPath+'%s_%d_%d_%d.png' %(tileroot,
                             tileX0+i,tileY0+j,zoomLevel)
             
-            if len(subs) == 1:
-                subim = data2image(sub, zmin=zmin, zmax=zmax)
-                subim.save(outfile)
-            else:
-                if rgb_params is not None:
-                    luptonRGB(subs[0]*zmax[0], subs[1]*zmax[1], subs[2]*zmax[2], Q=rgb_params[0], alpha=rgb_params[1], m0=rgb_params[2], m1=1, shape=None, filename=outfile, ds9=None, verbose=False, rgb_clip=rgb_clip)
-                else:
-                    linearRGB(subs[0], subs[1], subs[2], shape=None, filename=outfile)
-                    
-            if verbose: 
-                print 'threedhst.gmap: %s' %(outfile)
-            #print outfile
+            band.append((fully-(j+1)*TILE_SIZE, i*TILE_SIZE, outfile,
+                         manifest.pop(os.path.basename(outfile), None)))
+        
+        tasks.append((band, render_params))
+    
+    t0 = time.time()
+    if processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=processes, 
+                        initializer=_init_tile_worker, initargs=(source,))
+        status = pool.imap(_render_tile_band, tasks)
+    else:
+        _init_tile_worker(source)
+        status = (_render_tile_band(task) for task in tasks)
+    
+    NWRITE, NEMPTY, NSAME = 0, 0, 0
+    hashes = {}
+    for task, band_status in zip(tasks, status):
+        for tile, (st, hash) in zip(task[0], band_status):
+            NWRITE += st == 1
+            NEMPTY += st == 0
+            NSAME += st == 2
+            if st > 0:
+                hashes[os.path.basename(tile[2])] = hash
             
+            if verbose & (st == 1):
+                print 'threedhst.gmap: %s' %(tile[2])
+    
+    if processes > 1:
+        pool.close()
+        pool.join()
+    else:
+        _init_tile_worker(None)
+    
+    #### Tiles left over from the previous run outside of the grid
+    for file in manifest.keys():
+        if os.path.exists(outPath+file):
+            os.remove(outPath+file)
+    
+    writeTileManifest(manifest_file, hashes)
+        
+    dt = np.maximum(time.time()-t0, 1.e-6)
+    print 'threedhst.gmap: %s, zoom %d, %d tiles (%d empty, %d unchanged) in %.1f s, %.1f tiles/s' %(tileroot, zoomLevel, NWRITE, NEMPTY, NSAME, dt, NWRITE/dt)
+    
     return params
 
+#### Memory-mapped tile source read by the `makeGMapTiles` workers
+_TILE_SOURCE = None
+
+def _init_tile_worker(source):
+    """
+    Open the memory-mapped FITS images that the tiles are cut from.  
+    `source` is a tuple of (files, extension, row offset, column offset) 
+    giving the offset of the image in the padded tile grid.  
+    `source` = None closes the images opened by a previous call.
+    """
+    global _TILE_SOURCE
+    if _TILE_SOURCE is not None:
+        data, y0, x0, hdulists = _TILE_SOURCE
+        _TILE_SOURCE = None
+        del data
+        for hdulist in hdulists:
+            hdulist.close()
+        
+    if source is None:
+        return None
+        
+    files, extension, y0, x0 = source
+    data, hdulists = [], []
+    for file in files:
+        hdulists.append(pyfits.open(file, memmap=True))
+        data.append(hdulists[-1][extension].data)
+    
+    _TILE_SOURCE = (data, y0, x0, hdulists)
+    
+def _read_tile(ty, tx):
+    """
+    Read the tile with lower left corner (`ty`, `tx`) in the padded tile 
+    grid.  Only the part of the tile that overlaps the image is read, the 
+    rest is left as zero padding.  Returns None for tiles entirely in 
+    the padding.
+    """
+    data, y0, x0, hdulists = _TILE_SOURCE
+    NY, NX = data[0].shape
+    
+    ### Image pixel range covered by the tile
+    ya, yb = np.maximum(ty-y0, 0), np.minimum(ty-y0+TILE_SIZE, NY)
+    xa, xb = np.maximum(tx-x0, 0), np.minimum(tx-x0+TILE_SIZE, NX)
+    if (ya >= yb) | (xa >= xb):
+        return None
+        
+    subs = np.zeros((len(data), TILE_SIZE, TILE_SIZE), dtype=np.float32)
+    for ch in range(len(data)):
+        subs[ch, ya-(ty-y0):yb-(ty-y0), xa-(tx-x0):xb-(tx-x0)] = \
+                                                   data[ch][ya:yb, xa:xb]
+    
+    return subs
+    
+def _render_tile_band(task):
+    """
+    Render and write a band of map tiles.  Returns a list of (status, hash)
+    with status 1 for tiles that were written, 0 for empty tiles and 2 
+    for tiles that were unchanged from the hash of the previous run.
+    """
+    band, params = task
+    status = []
+    for ty, tx, outfile, old_hash in band:
+        subs = _read_tile(ty, tx)
+        if subs is None:
+            subs = np.zeros((len(_TILE_SOURCE[0]), TILE_SIZE, TILE_SIZE),
+                            dtype=np.float32)
+        
+        if params['skip_empty'] and (not subs.any()):
+            if (old_hash is not None) and os.path.exists(outfile):
+                os.remove(outfile)
+                
+            status.append((0, None))
+            continue
+        
+        hash = hashlib.md5(subs.tostring()+params['scale_key']).hexdigest()
+        if (hash == old_hash) and os.path.exists(outfile):
+            status.append((2, hash))
+            continue
+            
+        if len(subs) == 1:
+            subim = data2image(subs[0], zmin=params['zmin'], 
+                               zmax=params['zmax'])
+            subim.save(outfile)
+        else:
+            zmax, rgb_params = params['zmax'], params['rgb_params']
+            if rgb_params is not None:
+                luptonRGB(subs[0]*zmax[0], subs[1]*zmax[1], subs[2]*zmax[2], Q=rgb_params[0], alpha=rgb_params[1], m0=rgb_params[2], m1=1, shape=None, filename=outfile, ds9=None, verbose=False, rgb_clip=params['rgb_clip'])
+            else:
+                linearRGB(subs[0], subs[1], subs[2], shape=None, filename=outfile)
+        
+        status.append((1, hash))
+    
+    return status
+
+def readTileManifest(manifest_file):
+    """
+manifest = readTileManifest(manifest_file)
+    
+    Read a manifest of tile filenames and hashes written by `makeGMapTiles`.
+    """
+    manifest = {}
+    for line in open(manifest_file).readlines():
+        sp = line.split()
+        if len(sp) == 2:
+            manifest[sp[0]] = sp[1]
+    
+    return manifest
+    
+def writeTileManifest(manifest_file, manifest):
+    """
+writeTileManifest(manifest_file, manifest)
+    
+    Write a dictionary of tile filenames and hashes.
+    """
+    fp = open(manifest_file,'w')
+    for file in sorted(manifest.keys()):
+        fp.write('%s %s\n' %(file, manifest[file]))
+    
+    fp.close()
+    
+def makeTilePyramid(fitsfile=None, outPath=None, tileroot='direct',
+                    extension=1, zoom_levels=range(13,17), scale={}, 
+                    conserve_flux=True, zmin=-0.1, zmax=1, 
+                    rgb_params=(5, 3, -0.05), verbose=False, rgb_clip=True,
+                    processes=1, skip_empty=True, incremental=False):
+    """
+mapParams = makeTilePyramid(fitsfile=None, outPath=None, tileroot='direct',
+                            extension=1, zoom_levels=range(13,17), scale={})
+    
+    Make map tiles for several zoom levels from a single image that has 
+    already been resampled to the pixel scale of the finest zoom level, 
+    rather than running SWarp for each level.  The coarser levels down to 
+    min(`zoom_levels`) are made by 2x2 block averaging of the level above,
+    and the tiles of each level in `zoom_levels` are made with 
+    `makeGMapTiles`.
+    
+    "fitsfile" can be a single FITS image or a comma-separated list of three
+    images (R,G,B), as in `makeGMapTiles`.
+    
+    If `conserve_flux` is set, the block averages are scaled by the ratio 
+    of the pixel areas, like the flux-conserving SWarp resampling.  `scale`
+    is a dictionary of additional scale factors applied to the image for 
+    a given zoom level, e.g. {13:0.5, 14:0.5}.  The scaling is 
+    applied through the z-limits.
+    
+    Returns the map parameters of the finest zoom level.
+    """
+    if outPath is None:
+        outPath = '/tmp/'
+    
+    files = fitsfile.split(',')
+    RGB = len(files) == 3
+    
+    #### Zoom level of the input image
+    m = MercatorProjection()
+    head = pyfits.getheader(files[0], extension)
+    pixScale = 1./np.array(m.pixels_per_lon_degree)-np.abs(head['CD2_2'])
+    zoom0 = np.argmin(np.abs(pixScale))
+    
+    mapParams = None
+    zoom = zoom0
+    level_files, ext = files, extension
+    while zoom >= np.min(zoom_levels):
+        if zoom in zoom_levels:
+            factor = scale.get(zoom, 1.)
+            if conserve_flux:
+                factor *= 4.**(zoom0-zoom)
+            
+            if RGB:
+                zmi, zma = zmin, np.array(zmax)*factor
+            else:
+                zmi, zma = zmin/factor, zmax/factor
+                
+            params = makeGMapTiles(fitsfile=','.join(level_files),
+                                   outPath=outPath, tileroot=tileroot,
+                                   extension=ext, zmin=zmi, zmax=zma, 
+                                   rgb_params=rgb_params, verbose=verbose,
+                                   rgb_clip=rgb_clip, processes=processes,
+                                   skip_empty=skip_empty,
+                                   incremental=incremental)
+            if mapParams is None:
+                mapParams = params
+        
+        #### Next level down
+        zoom -= 1
+        if zoom < np.min(zoom_levels):
+            break
+            
+        bin_files = []
+        for ch, file in enumerate(level_files):
+            im = pyfits.open(file, memmap=True)
+            bin_head = binHeader(im[ext].header, factor=2)
+            bin_data = blockAverage(im[ext].data, factor=2)
+            im.close()
+            
+            bin_file = outPath+'%s_pyramid_%d_%d.fits' %(tileroot, zoom, ch)
+            pyfits.PrimaryHDU(data=bin_data, 
+                              header=bin_head).writeto(bin_file, clobber=True)
+            bin_files.append(bin_file)
+        
+        if level_files != files:
+            for file in level_files:
+                os.remove(file)
+        
+        level_files, ext = bin_files, 0
+    
+    if level_files != files:
+        for file in level_files:
+            os.remove(file)
+    
+    return mapParams
+    
 def makeOtherTiles(reference_image='ib6o23020_drz.fits', 
                    reference_ext = 1,
       other_image='../../ECDFS_DR1.FITS', 
@@ -296,10 +551,13 @@ makeOtherTiles
         os.remove('scale.fits')
         
 def makeAllTiles(ROOT_DIRECT, ROOT_GRISM, zmin=-0.1, zmax=1, verbose=False,
-                 PARAM_ONLY=False):
+                 PARAM_ONLY=False, pyramid=False, processes=1):
     """
 mapParams = makeAllTiles(ROOT_DIRECT, ROOT_GRISM, zmin=-0.1, zmax=1, 
-                         PARAM_ONLY=False)
+                         PARAM_ONLY=False, pyramid=False, processes=1)
+    
+    If `pyramid` is set, the images are only swarped to the finest zoom 
+    level and the coarser levels are made with `makeTilePyramid`.
     """
     import threedhst
     
@@ -329,6 +587,33 @@ multiple times for each zoom level and image combination.
     aper_list = range(13,17)
     if PARAM_ONLY:
         aper_list = [16]
+    
+    if pyramid & (not PARAM_ONLY):
+        sw.options['IMAGE_SIZE']='0'
+        sw.options['PIXELSCALE_TYPE']='MANUAL'
+        sw.options['PIXEL_SCALE']='%10.6f' %aperpix[16]
+        
+        #### Same level scalings as for the individual SWarp runs below
+        images = [(threedhst.options['DIRECT_MOSAIC'], '_d', 
+                   {13:0.5, 14:0.5}),
+                  (ROOT_GRISM+'_drz.fits', '_g', {13:0.5, 14:0.5, 16:5.}),
+                  (ROOT_GRISM+'CONT_drz.fits', '_m', {13:0.5, 14:0.5, 16:5.})]
+        
+        for image, suffix, scale in images:
+            sw.swarpImage(image+'[1]', mode='wait')
+            mapParamsI = threedhst.gmap.makeTilePyramid(fitsfile='coadd.fits',
+                                                  outPath='../HTML/tiles/',
+                                                  tileroot=ROOT_GRISM+suffix,
+                                                  extension=0,
+                                                  zoom_levels=aper_list,
+                                                  scale=scale,
+                                                  zmin=zmin, zmax=zmax,
+                                                  verbose=verbose,
+                                                  processes=processes)
+            if suffix == '_d':
+                mapParams = mapParamsI.copy()
+        
+        aper_list = []
         
     for aper in aper_list:
         ### base image
@@ -356,7 +641,8 @@ multiple times for each zoom level and image combination.
                                                  tileroot=ROOT_GRISM+'_d',
                                                  extension=0,
                                                  zmin=zmi, zmax=zma,
-                                                 verbose=verbose)
+                                                 verbose=verbose,
+                                                 processes=processes)
         
         #### Get map parameters from high-resolution image
         if (aper == 16):
@@ -380,7 +666,8 @@ multiple times for each zoom level and image combination.
                                                  tileroot=ROOT_GRISM+'_g',
                                                  extension=0,
                                                  zmin=zmi, zmax=zma,
-                                                 verbose=verbose)
+                                                 verbose=verbose,
+                                                 processes=processes)
         
         #### Model
         sw.swarpImage(ROOT_GRISM+'CONT_drz.fits[1]', mode='wait')
@@ -394,7 +681,8 @@ multiple times for each zoom level and image combination.
                                                  tileroot=ROOT_GRISM+'_m',
                                                  extension=0,
                                                  zmin=zmi, zmax=zma,
-                                                 verbose=verbose)
+                                                 verbose=verbose,
+                                                 processes=processes)
         
     # #### direct tiles
     # mapParamsD = threedhst.gmap.makeGMapTiles(fitsfile=
@@ -474,16 +762,17 @@ data2image(data,zmin=-0.1,zmax=0.5)
     
     Parts taken from the `fitsimage` class in wcs2kml.
     
+    The scaling is done in place on a single float32 copy of the data.
     """ 
     from PIL import Image
     # array sizes
     xsize = data.shape[1]
     ysize = data.shape[0]
-    # copy of data
-    fits_data = data*1.
-    fits_data = np.where(fits_data > zmin, fits_data, zmin)
-    fits_data = np.where(fits_data < zmax, fits_data, zmax)
-    scaled_data = (fits_data - zmin) * (255.0 / (zmax - zmin)) + 0.5
+    # scaled float32 copy of data
+    scaled_data = np.subtract(data, zmin, dtype=np.float32)
+    scaled_data *= 255.0 / (zmax - zmin)
+    np.clip(scaled_data, 0, 255, out=scaled_data)
+    scaled_data += 0.5
     # convert to 8 bit unsigned int
     scaled_data = scaled_data.astype("B")
     # create the image
@@ -508,48 +797,118 @@ def linearRGB(R, G, B, filename='junk.png', shape=None):
     
     im.save(filename)
     
+#### Cache of the lookup tables of the asinh stretch
+_LUPTON_LUT = {}
+
+def luptonLUT(Q=5, alpha=3, m0=-0.05, max_error=0.25):
+    """
+step, lut = luptonLUT(Q=5, alpha=3, m0=-0.05, max_error=0.25)
+    
+    Lookup table of the asinh stretch factor of Lupton et al. (2004),
+    
+        f(I) = arcsinh(alpha*Q*I) / (Q*I),
+        
+    for the intensity I = (R+G+B)/3 - m0, tabulated in steps of `step` 
+    from I=0 up to the intensity that saturates at 1.  Element k of `lut` 
+    is f((k-0.5)*step) and the first element is zero for I < 0.  The step 
+    is chosen such that the error of the tabulated stretch of an 
+    unsaturated channel is less than `max_error` in the 8-bit output.
+    
+    The tables are cached for a given set of parameters.
+    """
+    key = (Q, alpha, m0, max_error)
+    if key in _LUPTON_LUT:
+        return _LUPTON_LUT[key]
+    
+    Imax = np.sinh(Q*1.)/(alpha*Q)
+    
+    #### Largest output change per unit intensity, |df/dI| * channel,
+    #### for unsaturated channels with channel*f < 1 and channel < 3*I
+    I = np.logspace(-4, 0, 4096)*Imax
+    f = np.arcsinh(alpha*Q*I)/(Q*I)
+    df = np.abs(alpha/np.sqrt(1+(alpha*Q*I)**2)-f)/I
+    dmax = (df*np.minimum(3*I, 1./f)).max()
+    
+    step = 2*max_error/(255*dmax)
+    NSTEP = int(np.ceil(Imax/step))
+    I = (np.arange(NSTEP+2)-0.5)*step
+    lut = np.arcsinh(alpha*Q*I)/(Q*I)
+    lut[0] = 0.
+    
+    _LUPTON_LUT[key] = (step, lut.astype(np.float32))
+    return _LUPTON_LUT[key]
+    
+def luptonScale(imr, img, imb, Q=5, alpha=3, m0=-0.05, rgb_clip=True, 
+                as_bytes=True):
+    """
+R, G, B = luptonScale(imr, img, imb, Q=5, alpha=3, m0=-0.05, rgb_clip=True,
+                      as_bytes=True)
+    
+    Asinh color scaling of Lupton et al. (2004) using the lookup table of 
+    the stretch factor from `luptonLUT`, computed in float32.  NaN pixels 
+    are black.  Returns uint8 images if `as_bytes`, otherwise float32 
+    images scaled 0..1.
+    """
+    step, lut = luptonLUT(Q=Q, alpha=alpha, m0=m0)
+    
+    I = np.add(imr, img, dtype=np.float32)
+    I += imb
+    I -= 3*m0
+    I *= 1./(3*step)
+    I += 1
+    #### NaN pixels, e.g. outside of the mosaic coverage, use the zero 
+    #### first element of the table
+    I[np.isnan(I)] = 0
+    np.clip(I, 0, len(lut)-1, out=I)
+    fI = lut[I.astype(np.int32)]
+    
+    #### Intensities beyond the table only matter without the color clipping
+    if not rgb_clip:
+        big = I == (len(lut)-1)
+        if big.any():
+            Ibig = (np.cast[np.float64](imr[big])+imb[big]+img[big]-3*m0)/3.
+            fI[big] = np.arcsinh(alpha*Q*Ibig)/(Q*Ibig)
+    
+    channels = []
+    for im in [imr, img, imb]:
+        ch = np.subtract(im, m0, dtype=np.float32)
+        np.maximum(ch, 0, out=ch)
+        ch *= fI
+        channels.append(ch)
+    
+    if rgb_clip:
+        max_RGB = np.maximum(np.maximum(channels[0], channels[1]), channels[2])
+        np.maximum(max_RGB, 1, out=max_RGB)
+        for ch in channels:
+            ch /= max_RGB
+    
+    for ch in channels:
+        ch[np.isnan(ch)] = 0
+        np.minimum(ch, 1, out=ch)
+        if as_bytes:
+            ch *= 255
+    
+    if as_bytes:
+        return [ch.astype(np.uint8) for ch in channels]
+    else:
+        return channels
+    
 def luptonRGB(imr, img, imb, Q=5, alpha=3, m0=-0.05, m1=1, shape=None, filename='junk.png', ds9=None, verbose=False, rgb_clip=True):
     """
     Make a 3 color image scaled with the color clipping and 
     asinh scaling from Lupton et al. (2004)
+    
+    The stretch is computed with `luptonScale`.
     """   
     import Image
     
-    I = (imr+img+imb-3*m0)/3.
-    fI = np.arcsinh(alpha*Q*I)/Q
     M = m0 + np.sinh(Q*1.)/(alpha*Q)
-    #ds9.v(fI, vmin=0, vmax=1)
     if verbose:
         print 'min, max = %f, %f' %(m0, M)
-        
-    fI[I < m0] = 0
-    R = np.maximum(imr-m0, 0)*fI/I
-    G = np.maximum(img-m0, 0)*fI/I
-    B = np.maximum(imb-m0, 0)*fI/I
-        
-    min_RGB = np.minimum(np.minimum(R,G),B)
-    zero = min_RGB < 0
-    zero = fI < 0
-    R[zero] = 0.
-    G[zero] = 0.
-    B[zero] = 0.
-    
-    R[R < 0] = 0
-    G[G < 0] = 0
-    B[B < 0] = 0
-    
-    max_RGB = np.maximum(np.maximum(R,G),B)
-    if rgb_clip:
-        clip = max_RGB > 1
-        R[clip] = R[clip]/max_RGB[clip]
-        G[clip] = G[clip]/max_RGB[clip]
-        B[clip] = B[clip]/max_RGB[clip]
-    else:
-        R[R > 1] = 1.
-        G[G > 1] = 1.
-        B[B > 1] = 1.
-
+    
     if ds9 is not None:
+        R, G, B = luptonScale(imr, img, imb, Q=Q, alpha=alpha, m0=m0,
+                              rgb_clip=rgb_clip, as_bytes=False)
         #ds9.set('rgb True')
         v1=1
         ds9.set('rgb lock colorbar')
@@ -557,10 +916,11 @@ def luptonRGB(imr, img, imb, Q=5, alpha=3, m0=-0.05, m1=1, shape=None, filename=
         ds9.set('rgb green'); ds9.v(G, vmin=0, vmax=v1); ds9.set('scale linear')
         ds9.set('rgb blue'); ds9.v(B, vmin=0, vmax=v1); ds9.set('scale linear')
         return True
+    
+    R, G, B = luptonScale(imr, img, imb, Q=Q, alpha=alpha, m0=m0,
+                          rgb_clip=rgb_clip, as_bytes=True)
         
-    #rgb = np.array([R,G,B]).T
-    #im = Image.merge('RGB', (Image.fromarray((R[::-1,:]*255).astype('uint8')), Image.fromarray((G[::-1,:]*255).astype('uint8')), Image.fromarray((B[::-1,:]*255).astype('uint8'))))
-    im = Image.merge('RGB', (Image.fromarray((R[::-1,:]*255).astype('int8'), mode='L'), Image.fromarray((G[::-1,:]*255).astype('int8'), mode='L'), Image.fromarray((B[::-1,:]*255).astype('int8'), mode='L')))
+    im = Image.merge('RGB', (Image.fromarray(R[::-1,:], mode='L'), Image.fromarray(G[::-1,:], mode='L'), Image.fromarray(B[::-1,:], mode='L')))
     
     if shape is not None:
         im = im.resize(shape)
@@ -582,7 +942,7 @@ radec2latlon(radec)
     
 def makeCatXML(catFile=None, xmlFile=None, SPCFile=None):
     """
-makeCatXML(catFile=None,xmlFile=None)
+makeCatXML(catFile=None,xmlFile=None, SPCFile=None)
     
     Make XML file suitable for reading into a Google map from 
     a SExtractor catalog
@@ -613,22 +973,24 @@ makeCatXML(catFile=None,xmlFile=None)
     mag = np.array(np.cast[float](colMag))
     sort_idx = mag.argsort()
     
-    ### Make XML string
-    xmlString = '<markers>'
-    for j in range(cat.nrows):
-        i = sort_idx[j]
-        if int(cat.NUMBER[i]) in spec_list:
-            xmlString+='<marker id="%s" ra="%s" dec="%s" mag="%s"/>' %(colID[i],
-                      colRA[i], colDEC[i], colMag[i])
-                      
-    xmlString+='</markers>'
-    ### Print to output file
-    if xmlFile:
-        fp = open(xmlFile,'w')
-        fp.write(xmlString)
-        fp.close()
+    ### Objects with spectra, in order of magnitude
+    has_spec = np.in1d(np.cast[int](cat.NUMBER), np.cast[int](spec_list))
+    sort_idx = sort_idx[has_spec[sort_idx]]
+    
+    if not xmlFile:
+        return None
+    
+    marker = '<marker id="%s" ra="%s" dec="%s" mag="%s"/>'
+    
+    ### Write the markers to the output file
+    fp = open(xmlFile,'w')
+    fp.write('<markers>')
+    for i in sort_idx:
+        fp.write(marker %(colID[i], colRA[i], colDEC[i], colMag[i]))
+    
+    fp.write('</markers>')
+    fp.close()
     
-
 class Point():
     """
 Stores a simple (x,y) point.  It is used for storing x/y pixels.
@@ -781,7 +1143,45 @@ def DegreesToRadians(deg):
     """
     return deg * (np.pi / 180)
 
-def congrid(a, newdims, method='linear', centre=False, minusone=False):
+def blockAverage(data, factor=2, NROW=256):
+    """
+binned = blockAverage(data, factor=2, NROW=256)
+    
+    Average a 2D image in `factor` x `factor` blocks, dropping leftover 
+    rows and columns at the top and right edges.  The image is read in
+    bands of `NROW` output rows, so `data` can be a memory-mapped array 
+    larger than the available memory.
+    """
+    ny, nx = data.shape[0]/factor, data.shape[1]/factor
+    dtype = np.result_type(data.dtype, np.float32)
+    binned = np.zeros((ny, nx), dtype=dtype)
+    for j0 in range(0, ny, NROW):
+        j1 = np.minimum(j0+NROW, ny)
+        band = np.cast[dtype](data[j0*factor:j1*factor, :nx*factor])
+        band = band.reshape((j1-j0, factor, nx, factor))
+        binned[j0:j1] = band.mean(axis=3).mean(axis=1)
+    
+    return binned
+
+def binHeader(header, factor=2):
+    """
+bin_header = binHeader(header, factor=2)
+    
+    Update the WCS of an image header for `factor` x `factor` binning with
+    `blockAverage`.
+    """
+    head = header.copy()
+    for i in [1,2]:
+        head['CRPIX%d' %(i)] = (head['CRPIX%d' %(i)]-0.5)/factor+0.5
+        
+    for key in ['CD1_1','CD1_2','CD2_1','CD2_2','CDELT1','CDELT2']:
+        if key in head:
+            head[key] *= factor
+    
+    return head
+    
+def congrid(a, newdims, method='linear', centre=False, minusone=False,
+            chunk_size=None, out=None):
     '''Arbitrary resampling of source array to new dimension sizes.
     Currently only supports maintaining the same number of dimensions.
     To use 1-D arrays, first promote them to shape (x,1).
@@ -791,11 +1191,14 @@ def congrid(a, newdims, method='linear', centre=False, minusone=False):
     routine of the same name.
 
     method:
-    neighbour - closest value from original data
-    nearest and linear - uses n x 1-D interpolations using
-                         scipy.interpolate.interp1d
+    neighbour - closest value from original data, clipped at the edges
+    nearest and linear - n x 1-D interpolations, points beyond the ends 
+                         of the input array take the edge values
     (see Numerical Recipes for validity of use of n 1-D interpolations)
-    spline - uses ndimage.map_coordinates
+    spline - n x 1-D cubic B-spline interpolations, equivalent to 
+             ndimage.map_coordinates
+    block - exact average of blocks of pixels, the old dimensions must 
+            be integer multiples of the new ones
 
     centre:
     True - interpolation points are at the centres of the bins
@@ -806,85 +1209,151 @@ def congrid(a, newdims, method='linear', centre=False, minusone=False):
     False - inarray is resampled by factors of (i/x) * (j/y)
     True - inarray is resampled by(i-1)/(x-1) * (j-1)/(y-1)
     This prevents extrapolation one element beyond bounds of input array.
+    
+    All methods work as separable passes along each axis.  float32 input 
+    is resampled in float32, anything else in float64.
+    
+    chunk_size:
+    If set, the array is processed in chunks of `chunk_size` rows (first 
+    index) and columns (second index), so that `a` can be a memory-mapped
+    array larger than the available memory.  The intermediate array is 
+    then also memory-mapped to a temporary file, and the result is 
+    written to `out` (e.g. an np.memmap) if specified.
     '''
-    import scipy.interpolate
-    import scipy.ndimage
+    if a.dtype == np.float32:
+        dtype = np.float32
+    else:
+        dtype = np.float64
     
-    if not a.dtype in [n.float64, n.float32]:
-        a = n.cast[float](a)
-
-    m1 = n.cast[int](minusone)
-    ofs = n.cast[int](centre) * 0.5
-    old = n.array( a.shape )
+    old = np.array( a.shape )
     ndims = len( a.shape )
     if len( newdims ) != ndims:
         print "[congrid] dimensions error. " \
               "This routine currently only support " \
               "rebinning to the same number of dimensions."
         return None
-    newdims = n.asarray( newdims, dtype=float )
-    dimlist = []
-
-    if method == 'neighbour':
-        for i in range( ndims ):
-            base = n.indices(newdims)[i]
-            dimlist.append( (old[i] - m1) / (newdims[i] - m1) \
-                            * (base + ofs) - ofs )
-        cd = n.array( dimlist ).round().astype(int)
-        newa = a[list( cd )]
-        return newa
-
-    elif method in ['nearest','linear']:
-        # calculate new dims
-        for i in range( ndims ):
-            base = n.arange( newdims[i] )
-            dimlist.append( (old[i] - m1) / (newdims[i] - m1) \
-                            * (base + ofs) - ofs )
-        # specify old dims
-        olddims = [n.arange(i, dtype = n.float) for i in list( a.shape )]
-
-        # first interpolation - for ndims = any
-        mint = scipy.interpolate.interp1d( olddims[-1], a, kind=method )
-        newa = mint( dimlist[-1] )
-
-        trorder = [ndims - 1] + range( ndims - 1 )
-        for i in range( ndims - 2, -1, -1 ):
-            newa = newa.transpose( trorder )
-
-            mint = scipy.interpolate.interp1d( olddims[i], newa, kind=method )
-            newa = mint( dimlist[i] )
-
-        if ndims > 1:
-            # need one more transpose to return to original dimensions
-            newa = newa.transpose( trorder )
-
-        return newa
-    elif method in ['spline']:
-        oslices = [ slice(0,j) for j in old ]
-        oldcoords = n.ogrid[oslices]
-        nslices = [ slice(0,j) for j in list(newdims) ]
-        newcoords = n.mgrid[nslices]
-
-        newcoords_dims = range(n.rank(newcoords))
-        #make first index last
-        newcoords_dims.append(newcoords_dims.pop(0))
-        newcoords_tr = newcoords.transpose(newcoords_dims)
-        # makes a view that affects newcoords
-
-        newcoords_tr += ofs
-
-        deltas = (n.asarray(old) - m1) / (newdims - m1)
-        newcoords_tr *= deltas
-
-        newcoords_tr -= ofs
-
-        newa = scipy.ndimage.map_coordinates(a, newcoords)
-        return newa
-    else:
+    
+    if method not in ['neighbour', 'nearest', 'linear', 'spline', 'block']:
         print "Congrid error: Unrecognized interpolation type.\n", \
               "Currently only \'neighbour\', \'nearest\',\'linear\',", \
-              "and \'spline\' are supported."
+              "\'spline\' and \'block\' are supported."
         return None
+    
+    newdims = np.cast[int](np.round(newdims))
+    if method == 'block':
+        if (old % newdims).sum() > 0:
+            print "[congrid] block averaging requires integer factors " \
+                  "between the old and new dimensions."
+            return None
+    
+    #### Co-ordinates of the new points along each axis
+    m1 = np.cast[int](minusone)
+    ofs = np.cast[int](centre) * 0.5
+    coords = []
+    for i in range( ndims ):
+        base = np.arange( newdims[i] )
+        coords.append( (old[i] - m1) * 1. / (newdims[i] - m1) \
+                       * (base + ofs) - ofs )
+    
+    if (chunk_size is None) | (ndims == 1):
+        newa = a
+        for i in range( ndims-1, -1, -1 ):
+            newa = _congrid_axis(newa, coords[i], i, method, dtype, 
+                                 newdims[i])
+        
+        if out is not None:
+            out[:] = newa
+            return out
+            
+        return newa
+    
+    #### Chunked: trailing axes in bands of rows, then the first axis 
+    #### in strips of columns
+    import tempfile
+    
+    shape = tuple([old[0]]+list(newdims[1:]))
+    if method == 'block':
+        step = np.maximum(chunk_size/(old[0]/newdims[0]), 1)*(old[0]/newdims[0])
+    else:
+        step = chunk_size
+    
+    tmp = np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', 
+                    shape=shape)
+    for r0 in range(0, old[0], step):
+        newa = np.asarray(a[r0:r0+step], dtype=dtype)
+        for i in range( ndims-1, 0, -1 ):
+            newa = _congrid_axis(newa, coords[i], i, method, dtype,
+                                 newdims[i])
+        
+        tmp[r0:r0+step] = newa
+    
+    if out is None:
+        out = np.zeros(newdims, dtype=dtype)
+    
+    for c0 in range(0, shape[1], chunk_size):
+        strip = np.asarray(tmp[:, c0:c0+chunk_size], dtype=dtype)
+        out[:, c0:c0+chunk_size] = _congrid_axis(strip, coords[0], 0, method,
+                                                 dtype, newdims[0])
+    
+    del(tmp)
+    return out
+
+def _congrid_axis(a, x, axis, method, dtype, newdim):
+    '''
+    Resample array `a` along a single `axis` at co-ordinates `x`, for
+    `congrid`.
+    '''
+    import scipy.ndimage
+    
+    a = np.asarray(a)
+    n = a.shape[axis]
+    
+    if method == 'block':
+        factor = n/newdim
+        shape = list(a.shape)
+        shape[axis:axis+1] = [newdim, factor]
+        return np.asarray(a, dtype=dtype).reshape(shape).mean(axis=axis+1,
+                                                             dtype=dtype)
+    
+    if method == 'neighbour':
+        return a.take(np.clip(np.cast[int](x.round()), 0, n-1), axis=axis)
+        
+    if method == 'nearest':
+        #### Nearest point, ties go to the lower index like interp1d
+        xm = np.arange(n-1)+0.5
+        return a.take(np.searchsorted(xm, x, side='left'), axis=axis)
+    
+    #### Taps and weights of the 1-D interpolation along the axis
+    wshape = [1]*a.ndim
+    wshape[axis] = len(x)
+    
+    if method == 'linear':
+        xc = np.clip(x, 0, n-1)
+        i0 = np.minimum(np.cast[int](np.floor(xc)), np.maximum(n-2, 0))
+        t = xc - i0
+        taps = [i0, np.minimum(i0+1, n-1)]
+        weights = [1-t, t]
+        data = a
+    else:
+        #### spline: cubic B-spline of the prefiltered coefficients, 
+        #### mirrored at the edges, zero outside of the input array
+        data = scipy.ndimage.spline_filter1d(a, order=3, axis=axis, 
+                                             output=dtype)
+        i1 = np.cast[int](np.floor(x))
+        t = x - i1
+        taps, weights = [], []
+        for k, w in zip(range(-1,3), [(1-t)**3/6., (3*t**3-6*t**2+4)/6., 
+                                      (-3*t**3+3*t**2+3*t+1)/6., t**3/6.]):
+            ik = np.abs(i1+k)
+            ik = np.where(ik > n-1, 2*(n-1)-ik, ik)
+            taps.append(np.clip(ik, 0, n-1))
+            weights.append(w*((x >= 0) & (x <= n-1)))
+    
+    newa = np.zeros(a.shape[:axis]+(len(x),)+a.shape[axis+1:], dtype=dtype)
+    for ik, w in zip(taps, weights):
+        newa += data.take(ik, axis=axis) * w.reshape(wshape).astype(dtype)
+    
+    return newa
         
 #
 def parseImageString(IMAGE_STRING="test.fits[1]*1.", default_extension=1):
@@ -915,7 +1384,8 @@ def parseImageString(IMAGE_STRING="test.fits[1]*1.", default_extension=1):
 def makeImageMap(FITS_IMAGES, extension=1, zmin=-0.1, zmax=1, verbose=True,
                  path=os.getenv('HOME')+'/Sites/FITS/', tileroot='tile',
                  aper_list=[15], polyregions=None, rgb_params=(5, 3, -0.05),
-                 invert=False, rgb_clip=True):
+                 invert=False, rgb_clip=True, processes=1, pyramid=False,
+                 incremental=False):
     """
     Make a google map viewer for a FITS image.
     
@@ -932,6 +1402,13 @@ def makeImageMap(FITS_IMAGES, extension=1, zmin=-0.1, zmax=1, verbose=True,
     Lupton et al. (2004):
     
         FITS_IMAGES = ['red.fits[1]*10,green.fits[0]*2,blue.fits[0]*1.']
+    
+    The map tiles are rendered with `processes` worker processes.  If 
+    `pyramid` is set, the images are only swarped to the finest zoom level
+    in `aper_list` and the tiles of the coarser levels are made from 2x2
+    block averages with `makeTilePyramid`.  With `incremental`, only the 
+    tiles whose pixels or scaling changed since the last run are 
+    regenerated (see `makeGMapTiles`).
       
     """
     import threedhst    
@@ -972,7 +1449,11 @@ def makeImageMap(FITS_IMAGES, extension=1, zmin=-0.1, zmax=1, verbose=True,
     NX, NY = int(NX), int(NY)
     NATIVE_SCALE = float(sw.options['PIXEL_SCALE'])
     
-    for aper in aper_list:
+    swarp_list = aper_list
+    if pyramid:
+        swarp_list = [np.max(aper_list)]
+        
+    for aper in swarp_list:
         ### base image
         
         threedhst.showMessage("Map tiles, zoom level: %10.6f arcsec/pix"
@@ -1009,6 +1490,10 @@ def makeImageMap(FITS_IMAGES, extension=1, zmin=-0.1, zmax=1, verbose=True,
                 zmi = None
                 zma = np.array(scalei)*(0.06/aperpix[aper])**1.5 ## soften a bit
                 
+                level_scale = {}
+                for level in aper_list:
+                    level_scale[level] = 4.**(level-aper) * (aperpix[aper]/aperpix[level])**1.5
+                    
             else:
                 sw.swarpImage(imi[0]+'[%0d]' %(exti[0]), mode='wait')
                 im = pyfits.open('coadd.fits')
@@ -1026,16 +1511,35 @@ def makeImageMap(FITS_IMAGES, extension=1, zmin=-0.1, zmax=1, verbose=True,
                 im.writeto('scale.fits', clobber=True)
                 fitsfile='scale.fits'
                 
-            mapParamsD = threedhst.gmap.makeGMapTiles(fitsfile=fitsfile,
+                level_scale = {}
+                for level in aper_list:
+                    level_scale[level] = (1., 4.)[aper <= 14] / (1., 4.)[level <= 14]
+                    
+            if pyramid:
+                mapParamsD = threedhst.gmap.makeTilePyramid(fitsfile=fitsfile,
+                                                     outPath=path+'tiles/',
+                                                     tileroot=tileroot[i],
+                                                     extension=0,
+                                                     zoom_levels=aper_list,
+                                                     scale=level_scale,
+                                                     zmin=zmi, zmax=zma,
+                                                     rgb_params=rgb_params, rgb_clip=rgb_clip,
+                                                     verbose=verbose,
+                                                     processes=processes,
+                                                     incremental=incremental)
+            else:
+                mapParamsD = threedhst.gmap.makeGMapTiles(fitsfile=fitsfile,
                                                      outPath=path+'tiles/',
                                                      tileroot=tileroot[i],
                                                      extension=0,
                                                      zmin=zmi, zmax=zma,
                                                      rgb_params=rgb_params, rgb_clip=rgb_clip,
-                                                     verbose=verbose)
+                                                     verbose=verbose,
+                                                     processes=processes,
+                                                     incremental=incremental)
         
         #### Get map parameters from high-resolution image
-        if (aper == aper_list[-1]):
+        if (aper == swarp_list[-1]):
             mapParams=mapParamsD.copy()
     
     mapParams['ZOOM_RANGE'] = [np.min(aper_list), np.max(aper_list)]
@@ -66,9 +66,17 @@ def redo_1dspec(ROOT_GRISM):
     SPC = threedhst.plotting.SPCFile(ROOT_GRISM+'_2_opt.SPC.fits',
                     axe_drizzle_dir=os.environ['AXE_DRIZZLE_PATH'])
     
-    threedhst.plotting.asciiSpec(SPC,root=ROOT_GRISM,path='../HTML/ascii')
+    #### Extract all of the 1D spectra at once for asciiSpec and plot1Dspec
+    threedhst.spec1d.clearExtract1DCache()
+    threedhst.spec1d.extract1DBatch(SPC._ext_map, root=ROOT_GRISM, 
+                                    path='../HTML')
+    
+    threedhst.plotting.asciiSpec(SPC,root=ROOT_GRISM,path='../HTML/ascii',
+                                 processes=threedhst.options['PROCESSES'])
     print ''
-    threedhst.plotting.makeSpec1dImages(SPC, path='../HTML/images/')
+    threedhst.plotting.makeSpec1dImages(SPC, path='../HTML/images/',
+                                processes=threedhst.options['PROCESSES'])
+    SPC.close()
 
 def make_data_products(ROOT_DIRECT, ROOT_GRISM):
     """
@@ -108,7 +116,8 @@ make_data_products()
     #############################################
     print '\nTHREEDHST.plotting.makeThumbs: Creating direct image ' + \
           'thumbnails...\n\n'
-    threedhst.plotting.makeThumbs(SPC, sexCat, path='../HTML/images/')
+    threedhst.plotting.makeThumbs(SPC, sexCat, path='../HTML/images/',
+                                  processes=threedhst.options['PROCESSES'])
     
     # 
     # fptar = tarfile.open('../HTML/images/'+ROOT_GRISM+'_thumbs.tar.gz','w|gz')
@@ -125,18 +134,30 @@ make_data_products()
     #############################################
     print '\nmakeSpec1dImages: Creating 2D spectra '+ \
           'thumbnails...\n\n'
-    threedhst.plotting.makeSpec2dImages(SPC, path='../HTML/images/')
+    threedhst.plotting.makeSpec2dImages(SPC, path='../HTML/images/',
+                                processes=threedhst.options['PROCESSES'])
 
+    #### Extract all of the 1D spectra at once from the mEF files, 
+    #### for asciiSpec and plot1Dspec
+    threedhst.spec1d.clearExtract1DCache()
+    threedhst.spec1d.extract1DBatch(SPC._ext_map, root=ROOT_GRISM,
+                    path='../HTML', mef_path='../'+threedhst.options['DRIZZLE_PATH'])
+    
     #### Make ASCII spectra from the SPC file
     print '\n Making ASCII spectra in ../HTML/ascii/\n'
-    threedhst.plotting.asciiSpec(SPC,root=ROOT_GRISM,path='../HTML/ascii')
+    threedhst.plotting.asciiSpec(SPC,root=ROOT_GRISM,path='../HTML/ascii',
+                                 processes=threedhst.options['PROCESSES'])
 
     #############################################
     #### 1D spectra images
     #############################################
     print '\nTHREEDHST.plotting.makeSpec1dImages: Creating 1D spectra '+ \
           'thumbnails...\n\n'
-    threedhst.plotting.makeSpec1dImages(SPC, path='../HTML/images/')
+    threedhst.plotting.makeSpec1dImages(SPC, path='../HTML/images/',
+                                processes=threedhst.options['PROCESSES'])
+    
+    #### Done reading spectra from the SPC file
+    SPC.close()
     
     # fptar = tarfile.open('../HTML/images/'+ROOT_GRISM+'_2D.tar.gz','w|gz')
     # oldwd = os.getcwd()
@@ -160,7 +181,8 @@ make_data_products()
     except:
         pass
     
-    mapParams = threedhst.gmap.makeAllTiles(ROOT_DIRECT, ROOT_GRISM)
+    mapParams = threedhst.gmap.makeAllTiles(ROOT_DIRECT, ROOT_GRISM,
+                                processes=threedhst.options['PROCESSES'])
                 
     #### Done making the map tiles
     threedhst.currentRun['step'] = 'MAKE_GMAP_TILES'
@@ -518,22 +540,26 @@ def plotThumbNew(object_number, mySexCat, SPCFile,
     
     #plt.show()
     
-def makeThumbs(SPCFile, mySexCat, path='./HTML/'):
+def makeThumbs(SPCFile, mySexCat, path='./HTML/', use_iraf=False, zoom=3,
+               processes=1):
     """
-    makeThumbs(SPCFile, mySexCat,path='./HTML')
+    makeThumbs(SPCFile, mySexCat,path='./HTML', use_iraf=False, zoom=3,
+               processes=1)
     
-    Run plotThumbs for each object in SPCFile
+    Make the direct image thumbnails for each object in SPCFile with 
+    `thumbnailBatch`, or run plotThumbNew for each object if `use_iraf`.
     """
     import os
-    import tarfile
     
-    # im = pyfits.open(mySexCat.filename.split('.cat')[0]+'.fits')
-    im = pyfits.open(threedhst.options['DIRECT_MOSAIC'])
-    
-    dat = im[1].data
     root = os.path.basename(SPCFile.filename).split('_2')[0]
     ids = SPCFile._ext_map+0
     ids.sort()
+    
+    if not use_iraf:
+        thumbnailBatch(ids, mySexCat, SPCFile, path=path, zoom=zoom,
+                       processes=processes)
+        return True
+        
     for id in ids:
         idstr = '%05d' %id
         print threedhst.noNewLine+'plotting.makeThumbs: %s_%s_thumb.png' %(root, idstr)
@@ -543,16 +569,199 @@ def makeThumbs(SPCFile, mySexCat, path='./HTML/'):
         # plotThumb(id, mySexCat, SPCFile,
         #           outfile=path+'/'+root+'_'+idstr+'_thumb.png',
         #           close_window=True)
+
+def thumbnailBatch(ids, mySexCat, SPCFile, path='./HTML/', zoom=3, 
+                   processes=1, chunk_size=200, verbose=True):
+    """
+thumbnailBatch(ids, mySexCat, SPCFile, path='./HTML/', zoom=3, 
+               processes=1, chunk_size=200, verbose=True)
+    
+    Make direct image thumbnails, [root]_[id]_thumb.png and 
+    [root]_[id]_thumb.fits.gz, of a list of objects without IRAF. 
+    
+    The cutouts are sliced from the memory-mapped DIRECT_MOSAIC and rotated
+    to the grism PA_APER with bilinear interpolation, with the size matched 
+    to the 2D spectrum as in `plotThumbNew`.  All thumbnails of a given 
+    size are rotated with a single vectorized transform.  The PNG files 
+    show the same inverted grayscale as plotThumbNew, written directly as 
+    8-bit images with the pixels enlarged by `zoom`, without matplotlib.
+    
+    The objects are processed in chunks of `chunk_size`, optionally 
+    distributed over `processes` worker processes.
+    """
+    import os
+    
+    root = os.path.basename(SPCFile.filename).split('_2')[0]
+    drz_image = threedhst.options['DIRECT_MOSAIC']
+    
+    drz_header = pyfits.getheader(drz_image, 'SCI')
+    orient = drz_header['PA_APER']
+    
+    #### Need to get orientation from *GRISM* images if a 
+    #### "prefab" direct image was supplied.
+    if threedhst.options['PREFAB_DIRECT_IMAGE'] is not None:
+        drz_grism = threedhst.options['ROOT_GRISM']+'_drz.fits'
+        grism_header = pyfits.getheader(drz_grism,'SCI')
+        orient = grism_header['PA_APER']
+    
+    #### Catalog rows of the objects
+    cat_idx = {}
+    for i, number in enumerate(mySexCat.NUMBER):
+        cat_idx[int(number)] = i
+    
+    objects = []
+    for id in ids:
+        if int(id) not in cat_idx:
+            print 'Object \'%s\' not found in SExtractor catalog, %s.\n' %(id,
+                             mySexCat.filename)
+            continue
+        
+        idx = cat_idx[int(id)]
         
+        #### Match thumbnail size to size of 2D spectrum
+        mef_file = '../'+threedhst.options['DRIZZLE_PATH']+'/'+root+ \
+                   '_mef_ID'+str(id)+'.fits'
+        if not os.path.exists(mef_file):
+            print 'plotting.thumbnailBatch: %s not found.' %(mef_file)
+            continue
+            
+        size = pyfits.getheader(mef_file, 'SCI')['NAXIS2']
+        
+        objects.append((id, np.float(mySexCat.X_IMAGE[idx])-1, 
+                        np.float(mySexCat.Y_IMAGE[idx])-1, 
+                        np.float(mySexCat.X_WORLD[idx]),
+                        np.float(mySexCat.Y_WORLD[idx]), size))
+    
+    outroot = path+'/'+root
+    tasks = []
+    for i in range(0, len(objects), chunk_size):
+        tasks.append((drz_image, objects[i:i+chunk_size], orient, outroot,
+                      zoom))
+    
+    if processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=processes)
+        counts = pool.map(_thumbnail_chunk, tasks)
+        pool.close()
+        pool.join()
+    else:
+        counts = map(_thumbnail_chunk, tasks)
+    
+    if verbose:
+        print 'plotting.thumbnailBatch: %d thumbnails in %s' %(np.sum(counts),
+                                                              path)
+    
+    return np.sum(counts)
+
+def _thumbnail_chunk(args):
+    """
+    Make the thumbnails for a list of objects, 
+    (id, x, y, ra, dec, size), for `thumbnailBatch`.
+    """
+    from PIL import Image
+    
+    drz_image, objects, orient, outroot, zoom = args
+    
+    drz = pyfits.open(drz_image, memmap=True)
+    data = drz['SCI'].data
+    head = drz['SCI'].header
+    NY, NX = data.shape
+    
+    #### Output pixels along the rotated axes, with the same scale
+    theta = orient/180.*np.pi
+    rot = np.array([[np.cos(theta), -np.sin(theta)],
+                    [np.sin(theta), np.cos(theta)]])
+    
+    cd = np.array([[head['CD1_1'], head.get('CD1_2', 0.)],
+                   [head.get('CD2_1', 0.), head['CD2_2']]])
+    cd_out = np.dot(cd, rot)
+    
+    sizes = np.array([obj[5] for obj in objects])
+    count = 0
+    for size in np.unique(sizes):
+        group = [objects[i] for i in np.where(sizes == size)[0]]
+        N = len(group)
+        x0 = np.array([obj[1] for obj in group])
+        y0 = np.array([obj[2] for obj in group])
+        
+        #### Cutouts large enough for the rotated thumbnail, zero padded 
+        #### at the edges of the mosaic
+        half = int(np.ceil(size/np.sqrt(2)))+2
+        B = 2*half+1
+        xc, yc = np.cast[int](np.round(x0)), np.cast[int](np.round(y0))
+        cutouts = np.zeros((N, B, B), dtype=np.float32)
+        for k in range(N):
+            ya, yb = np.maximum(yc[k]-half, 0), np.minimum(yc[k]+half+1, NY)
+            xa, xb = np.maximum(xc[k]-half, 0), np.minimum(xc[k]+half+1, NX)
+            if (ya >= yb) | (xa >= xb):
+                continue
+                
+            cutouts[k, ya-(yc[k]-half):yb-(yc[k]-half), 
+                    xa-(xc[k]-half):xb-(xc[k]-half)] = data[ya:yb, xa:xb]
+        
+        #### Rotated output grid, reference pixel size/2+0.5 like wdrizzle
+        ref = size/2+0.5-1
+        dv, du = np.indices((size, size))-ref
+        xin = du*rot[0,0]+dv*rot[0,1]
+        yin = du*rot[1,0]+dv*rot[1,1]
+        xin = xin[None,:,:] + (x0-xc+half)[:,None,None]
+        yin = yin[None,:,:] + (y0-yc+half)[:,None,None]
+        
+        #### Bilinear interpolation in all cutouts at once
+        ix = np.clip(np.cast[int](np.floor(xin)), 0, B-2)
+        iy = np.clip(np.cast[int](np.floor(yin)), 0, B-2)
+        tx, ty = xin-ix, yin-iy
+        flat = cutouts.reshape(-1)
+        base = (np.arange(N)*B*B)[:,None,None] + iy*B + ix
+        sub = (flat[base]*(1-tx)*(1-ty) + flat[base+1]*tx*(1-ty) + 
+               flat[base+B]*(1-tx)*ty + flat[base+B+1]*tx*ty)
+        
+        #### Inverted gray scale of plotThumbNew
+        sub_max = sub.reshape((N,-1)).max(axis=1)
+        vmin = np.where(sub_max > 0, -0.8*sub_max, -0.5*0.8)[:,None,None]
+        vmax = np.where(sub_max > 0, 0.08*sub_max, 0.1*0.8)[:,None,None]
+        scaled = np.clip(((0-sub)-vmin)/(vmax-vmin), 0, 1)
+        scaled = np.cast[np.uint8](scaled*255+0.5)
+        if zoom > 1:
+            scaled = scaled.repeat(zoom, axis=1).repeat(zoom, axis=2)
+        
+        for k, obj in enumerate(group):
+            outfile = outroot+'_%05d_thumb' %(obj[0])
+            Image.fromarray(scaled[k], mode='L').save(outfile+'.png')
+            
+            hdu = pyfits.PrimaryHDU(sub[k].astype(np.float32))
+            hdu.header['EXPTIME'] = head.get('EXPTIME')
+            hdu.header['CTYPE1'] = 'RA---TAN'
+            hdu.header['CTYPE2'] = 'DEC--TAN'
+            hdu.header['CRVAL1'] = obj[3]
+            hdu.header['CRVAL2'] = obj[4]
+            hdu.header['CRPIX1'] = size/2+0.5
+            hdu.header['CRPIX2'] = size/2+0.5
+            for i in range(2):
+                for j in range(2):
+                    hdu.header['CD%d_%d' %(i+1,j+1)] = cd_out[i,j]
+            
+            hdu.header['CDELT1'] = cd_out[0,0]
+            hdu.header['CDELT2'] = cd_out[1,1]
+            hdu.header['ORIENTAT'] = orient
+            hdu.writeto(outfile+'.fits.gz', clobber=True)
+            count += 1
+    
+    drz.close()
+    return count
+    
 def plot2Dspec(SPCFile, object_number, outfile='/tmp/spec2D.png',
-               close_window=False, clean=True):
+               close_window=False, clean=True, fig=None):
     """
 plot2Dspec(SPCFile, object_number, outfile='/tmp/spec2D.png', 
-    close_window=False, clean=True)
+    close_window=False, clean=True, fig=None)
     
     Make plot of 2D spectrum comparing observed, model and contamination 
     spectra.  If clean=True, then plot the cleaned-spectrum rather than the 
     contamination in the bottom panel.
+    
+    If an existing Agg `fig` is supplied, it is cleared and reused rather
+    than creating a new figure.
     """
     import os
     root = os.path.basename(SPCFile.filename).split('_2')[0]
@@ -577,7 +786,10 @@ plot2Dspec(SPCFile, object_number, outfile='/tmp/spec2D.png',
     
     defaultPlotParameters()
     
-    if USE_PLOT_GUI:
+    reuse = fig is not None
+    if reuse:
+        fig.clf()
+    elif USE_PLOT_GUI:
         fig = plt.figure(figsize=[6,4],dpi=100)
     else:
         fig = Figure(figsize=[6,4], dpi=100)
@@ -656,48 +868,35 @@ plot2Dspec(SPCFile, object_number, outfile='/tmp/spec2D.png',
     
     ### Save to PNG
     if outfile:
-        if USE_PLOT_GUI:
+        if USE_PLOT_GUI & (not reuse):
             fig.savefig(outfile,dpi=100,transparent=False)
         else:
             canvas = FigureCanvasAgg(fig)
             canvas.print_figure(outfile, dpi=100, transparent=False)
             
-    if close_window & USE_PLOT_GUI:
+    if close_window & USE_PLOT_GUI & (not reuse):
         status = plt.close()
 
-def makeSpec2dImages(SPCFile, path='./HTML/', add_FITS=True):
+def makeSpec2dImages(SPCFile, path='./HTML/', add_FITS=True, processes=1):
     """
-    makeSpec2dImages(SPCFile, path='./HTML')
+    makeSpec2dImages(SPCFile, path='./HTML', add_FITS=True, processes=1)
     
-    Run plotObject for each object in SPCFile
+    Run plot2Dspec for each object in SPCFile with `renderSpecImages`.
     """
-    import os
-    import shutil
-    
-    root = os.path.basename(SPCFile.filename).split('_2')[0]
     ids = SPCFile._ext_map+0
     ids.sort()
-    for id in ids:
-        idstr = '%05d' %id
-        print threedhst.noNewLine+'plotting.makeSpecImages: %s_%s_2D.png' %(root, idstr)
-        plot2Dspec(SPCFile, id, outfile=path+'/'+root+'_'+idstr+'_2D.png',
-                   close_window=True)
-        
-        if add_FITS:
-            mef_file = '../'+threedhst.options['DRIZZLE_PATH'] + \
-                       '/'+root+'_mef_ID'+str(id)+'.fits'
-            out_file = path+'/'+root+'_'+idstr+'_2D.fits'
-            shutil.copy(mef_file,out_file)
-            ### Gzip the result
-            if os.path.exists(out_file+'.gz'):
-                os.remove(out_file+'.gz')
-            os.system('gzip '+out_file)
-        
+    renderSpecImages(SPCFile, ids, kind='2D', path=path, add_FITS=add_FITS,
+                     processes=processes)
+    
 def plot1Dspec(SPCFile, object_number, outfile='/tmp/spec.png',
-               close_window=False, show_test_lines=False, own_extraction=True):
+               close_window=False, show_test_lines=False, own_extraction=True,
+               fig=None):
     """
     plot1Dspec(SPCFile, object_number, outfile='/tmp/spec.png', 
-               close_window=False, show_test_lines=False)
+               close_window=False, show_test_lines=False, fig=None)
+    
+    If an existing Agg `fig` is supplied, it is cleared and reused rather
+    than creating a new figure.
     """
     import os
     import scipy.optimize
@@ -759,7 +958,10 @@ def plot1Dspec(SPCFile, object_number, outfile='/tmp/spec.png',
     ymax = np.max((flux-0*contam)[sub])
     
     ### Initialize plot
-    if USE_PLOT_GUI:
+    reuse = fig is not None
+    if reuse:
+        fig.clf()
+    elif USE_PLOT_GUI:
         fig = plt.figure(figsize=[5,3.4],dpi=100)
     else:
         fig = Figure(figsize=[5,3.4], dpi=100)
@@ -906,13 +1108,13 @@ def plot1Dspec(SPCFile, object_number, outfile='/tmp/spec.png',
         
     ### Save to PNG
     if outfile:
-        if USE_PLOT_GUI:
+        if USE_PLOT_GUI & (not reuse):
             fig.savefig(outfile,dpi=80,transparent=False)
         else:
             canvas = FigureCanvasAgg(fig)
             canvas.print_figure(outfile, dpi=80, transparent=False)
         
-    if close_window & USE_PLOT_GUI:
+    if close_window & USE_PLOT_GUI & (not reuse):
         plt.close()
     
     return out_lines
@@ -962,42 +1164,199 @@ def gaussfit(x,y,p0):
     #print output
     return [yfit, eqwidth, output]
     
-def makeSpec1dImages(SPCFile, path='./HTML/'):
+def makeSpec1dImages(SPCFile, path='./HTML/', processes=1):
     """
-    makeSpec1dImages(SPCFile, path='./HTML')
+    makeSpec1dImages(SPCFile, path='./HTML', processes=1)
     
-    Run plotObject for each object in SPCFile
+    Run plot1Dspec for each object in SPCFile with `renderSpecImages` and 
+    write the fitted lines to [root]_1D_lines.dat.
     """
     import os
     root = os.path.basename(SPCFile.filename).split('_2')[0]
     ids = SPCFile._ext_map+0
     ids.sort()
     
+    line_strings = renderSpecImages(SPCFile, ids, kind='1D', path=path,
+                                    processes=processes)
+    
     fp = open(path+'/'+root+'_1D_lines.dat','w')
     fp.write('# id lambda sigma eqw snpeak\n# 4 parameters for each detected em. line\n')
+    for line_str in line_strings:
+        fp.write(line_str+'\n')
+    
+    fp.close()
+
+def renderSpecImages(SPCFile, ids, kind='1D', path='./HTML/', add_FITS=True,
+                     processes=1, chunk_size=50):
+    """
+renderSpecImages(SPCFile, ids, kind='1D', path='./HTML/', add_FITS=True,
+                 processes=1, chunk_size=50)
+    
+    Make the [root]_[id]_1D.png (kind='1D') or [root]_[id]_2D.png 
+    (kind='2D') spectrum figures for a list of object ids.
+    
+    The ids are split into chunks of `chunk_size` and optionally distributed
+    over `processes` worker processes.  Each worker draws all of its plots
+    on a single reused Agg figure.  For kind='2D' and `add_FITS`, the mEF 
+    files are copied to [root]_[id]_2D.fits.gz with the gzip module.
+    
+    Returns the list of fitted line strings for kind='1D', in the order of 
+    `ids`, and an empty list for kind='2D'.
+    """
+    tasks = []
+    for i in range(0, len(ids), chunk_size):
+        tasks.append((kind, ids[i:i+chunk_size], path, add_FITS))
+    
+    if processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=processes,
+                  initializer=_init_spec_worker,
+                  initargs=((SPCFile.filename, SPCFile.axe_drizzle_dir),))
+        results = pool.map(_spec_image_chunk, tasks)
+        pool.close()
+        pool.join()
+    else:
+        _init_spec_worker(SPCFile)
+        results = map(_spec_image_chunk, tasks)
+    
+    out = []
+    for result in results:
+        out.extend(result)
+    
+    return out
+
+#### Per-process state of the `renderSpecImages` workers
+_SPEC_WORKER = {}
+
+def _init_spec_worker(SPC):
+    """
+    Initialize a `renderSpecImages` worker with the SPC file, either an 
+    SPCFile object or (filename, axe_drizzle_dir), and the reused figures.
+    """
+    if not isinstance(SPC, SPCFile):
+        SPC = SPCFile(SPC[0], axe_drizzle_dir=SPC[1])
+    
+    _SPEC_WORKER['SPC'] = SPC
+    _SPEC_WORKER['1D'] = Figure(figsize=[5,3.4], dpi=100)
+    _SPEC_WORKER['2D'] = Figure(figsize=[6,4], dpi=100)
+
+def _spec_image_chunk(args):
+    """
+    Make the 1D or 2D figures for a chunk of object ids, 
+    (kind, ids, path, add_FITS), for `renderSpecImages`.
+    """
+    import os
+    import gzip
+    import shutil
+    
+    kind, ids, path, add_FITS = args
+    SPC = _SPEC_WORKER['SPC']
+    fig = _SPEC_WORKER[kind]
+    root = os.path.basename(SPC.filename).split('_2')[0]
+    
+    line_strings = []
     for id in ids:
         idstr = '%05d' %id
-        print threedhst.noNewLine+'plotting.makeSpec1dImages: %s_%s_1D.png' %(root, idstr)
-        lines = plot1Dspec(SPCFile, id,
-                   outfile=path+'/'+root+'_'+idstr+'_1D.png',
-                   close_window=True)
+        outfile = path+'/'+root+'_'+idstr+'_'+kind+'.png'
+        print threedhst.noNewLine+'plotting.renderSpecImages: %s' %(outfile)
+        
+        if kind == '2D':
+            plot2Dspec(SPC, id, outfile=outfile, fig=fig)
+            if add_FITS:
+                mef_file = '../'+threedhst.options['DRIZZLE_PATH'] + \
+                           '/'+root+'_mef_ID'+str(id)+'.fits'
+                out_file = path+'/'+root+'_'+idstr+'_2D.fits.gz'
+                fp_in = open(mef_file,'rb')
+                fp_out = gzip.open(out_file,'wb')
+                shutil.copyfileobj(fp_in, fp_out)
+                fp_out.close()
+                fp_in.close()
+            
+            continue
         
-        str = '%5d' %id
+        lines = plot1Dspec(SPC, id, outfile=outfile, fig=fig)
+        
+        line_str = '%5d' %id
         for line in lines:
             if line.type == 'emgauss':
-                str+='   %8.1f %8.1f %9.1e %7.1f' %(line.wave, line.sigma, line.ew, line.sn)
+                line_str += '   %8.1f %8.1f %9.1e %7.1f' %(line.wave, line.sigma, line.ew, line.sn)
             if line.type == 'abs':
-                str+='   %8.1f' %(-1*line.wave)
-                
-        fp.write(str+'\n')
+                line_str += '   %8.1f' %(-1*line.wave)
+        
+        line_strings.append(line_str)
     
+    return line_strings
+    
+def makeCatJSON(SPCFile, mySexCat, path='./HTML/', MAG_COLUMN=None,
+                page_size=500):
+    """
+makeCatJSON(SPCFile, mySexCat, path='./HTML/', MAG_COLUMN=None,
+            page_size=500)
+    
+    Write the catalog of objects with spectra, sorted by magnitude, for the 
+    catalog table and map markers of the HTML page.  
+    
+    The catalog is split into pages of `page_size` objects, 
+    [root]_cat_[page].json, with one array per column, "id", "ra", "dec" and 
+    "mag".  The number of objects and the list of pages are written to 
+    [root]_cat.json.  `plotJsonObjects` in threedhst.js reads the index and 
+    then all of the pages one after the other, adding the map markers of 
+    each page as it arrives.  The table is set up from the first page, so 
+    it is usable before the full catalog has been loaded.
+    
+    Returns the number of objects written.
+    """
+    import os
+    import json
+    
+    root = os.path.basename(SPCFile.filename).split('_2')[0]
+    
+    if MAG_COLUMN is None:
+        MAG_COLUMN = 'MAG_F1392W'
+        for col in mySexCat.column_names:
+            if col.startswith('MAG_F'):
+                MAG_COLUMN = col
+    
+    number = np.cast[int](mySexCat.NUMBER)
+    ra = np.cast[float](mySexCat.X_WORLD)
+    dec = np.cast[float](mySexCat.Y_WORLD)
+    mag = np.cast[float](mySexCat.getcol(mySexCat.searchcol(MAG_COLUMN)))
+    
+    #### Objects with spectra, in order of magnitude
+    sort_idx = mag.argsort()
+    has_spec = np.in1d(number, SPCFile._ext_map)
+    sort_idx = sort_idx[has_spec[sort_idx]]
+    
+    NOBJ = len(sort_idx)
+    pages = []
+    for i, start in enumerate(range(0, NOBJ, page_size)):
+        idx = sort_idx[start:start+page_size]
+        page_file = '%s_cat_%04d.json' %(root, i)
+        fp = open(path+'/'+page_file,'w')
+        json.dump({'id':number[idx].tolist(), 
+                   'ra':np.round(ra[idx],6).tolist(),
+                   'dec':np.round(dec[idx],6).tolist(), 
+                   'mag':np.round(mag[idx],3).tolist()}, fp, 
+                  separators=(',',':'))
+        fp.close()
+        pages.append(page_file)
+    
+    fp = open(path+'/'+root+'_cat.json','w')
+    json.dump({'n':NOBJ, 'page_size':page_size, 'pages':pages}, fp,
+              separators=(',',':'))
     fp.close()
     
+    return NOBJ
+    
 def makeHTML(SPCFile, mySexCat, mapParams,
-             output='./HTML/index.html', title=None):
+             output='./HTML/index.html', title=None, page_size=500):
     """
     makeHTML(SPCFile, mySexCat, mapParams,
-             output='./HTML/index.html', title=None)
+             output='./HTML/index.html', title=None, page_size=500)
+    
+    The page itself only contains the first object of the catalog table.  
+    The rest of the catalog is written with `makeCatJSON` and the table
+    rows and map markers are added by the javascript.
     """
     import os
     from socket import gethostname as hostname
@@ -1076,7 +1435,7 @@ def makeHTML(SPCFile, mySexCat, mapParams,
             });
             
             ///// Add the green circles around the catalog objects
-            plotXmlObjects();
+            plotJsonObjects();
         }
         initialize_SED_column();
     }
@@ -1156,11 +1515,15 @@ def makeHTML(SPCFile, mySexCat, mapParams,
     <tbody> 
     """ %(MAG_COLUMN.split('MAG_')[1]))
         
+    if not output:
+        output='HTML/index.html'
+    
+    NOBJ = makeCatJSON(SPCFile, mySexCat, path=os.path.dirname(output) or '.',
+                       MAG_COLUMN=MAG_COLUMN, page_size=page_size)
+    
     # for id in SPCFile._ext_map:
     for id in [SPCFile._ext_map[0]]:
-        for idx,num in enumerate(mySexCat.NUMBER):
-            if num == str(id):
-                break
+        idx = list(mySexCat.NUMBER).index(str(id))
         
         ra  = mySexCat.X_WORLD[idx]
         dec = mySexCat.Y_WORLD[idx]
@@ -1192,9 +1555,6 @@ def makeHTML(SPCFile, mySexCat, mapParams,
     </body>
     </html>""")
     
-    if not output:
-        output='HTML/index.html'
-    
     fp = open(output,'w')
     fp.writelines(lines)
     fp.close()
@@ -1377,15 +1737,33 @@ makeCSS(path="../HTML/scripts")
     fp.close()
     
     
-def asciiSpec(SPCFile, root="spec", path="../HTML/ascii"):
+def _ascii_extract1D(args):
+    """
+    Worker for `asciiSpec`: run `threedhst.spec1d.extract1D` for one object
+    and only return the columns that go into the ASCII spectrum.
+    """
+    id, root, path = args
+    sp1d = threedhst.spec1d.extract1D(id, root=root, path=path, show=False,
+                                      out2d=False)
+    return sp1d['flux'], sp1d['error'], sp1d['contam']
+    
+def asciiSpec(SPCFile, root="spec", path="../HTML/ascii", processes=1):
     """
-asciiSpec(SPCFile, root="spec", path="../HTML/ascii")
+asciiSpec(SPCFile, root="spec", path="../HTML/ascii", processes=1)
     
     Put ASCII spectra in HTML/ascii.
+    
+    Each spectrum is formatted as one block of text, written to 
+    [root]_[id].dat and added to [root]_spec.tar.gz from memory, with the 
+    file information of the .dat file.  Spectra already in the 
+    `spec1d.extract1D` cache, e.g. from `spec1d.extract1DBatch`, are taken
+    from it directly and only the others are extracted in a pool of 
+    `processes` workers.
     """
     import os
-    import gzip
     import tarfile
+    import cStringIO
+    import itertools
     
     try:
         os.mkdir(path)
@@ -1401,40 +1779,57 @@ asciiSpec(SPCFile, root="spec", path="../HTML/ascii")
     #ERROR_SCALE = np.float(threedhst.options['DRZSCALE'])/0.128254
     ########    ---- this was a bug fixed by M. Kuemmel 12/16/10  ----
     
-    for id in ids:
+    spec_root = SPCFile.filename.split('_2_opt')[0]
+    tasks = [(id, spec_root, '../HTML') for id in ids]
+    cached = [threedhst.spec1d.inExtract1DCache(id, root=spec_root, 
+                                                path='../HTML') for id in ids]
+    misses = [task for task, hit in zip(tasks, cached) if not hit]
+    if (processes > 1) & (len(misses) > 0):
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        extracted = pool.imap(_ascii_extract1D, misses, chunksize=8)
+    else:
+        pool = None
+        extracted = itertools.imap(_ascii_extract1D, misses)
+    
+    extractions = (_ascii_extract1D(task) if hit else extracted.next()
+                   for task, hit in itertools.izip(tasks, cached))
+    
+    line_format = '%11.5e %10.3e %10.3e %10.3e %10.3e %10.3e %10.3e\n'
+    
+    fptar = tarfile.open(path+'/'+root+'_spec.tar.gz','w|gz')
+    
+    for id, sp1d in itertools.izip(ids, extractions):
         spec = SPCFile.getSpec(id)
-        lam  = spec.field('LAMBDA')
-        flux = spec.field('FLUX')
-        ferr = spec.field('FERROR')
-        contam = spec.field('CONTAM')
+        NL = len(spec)
+        
+        #### Format all rows at once, column-interleaved
+        columns = np.zeros((NL, 7))
+        columns[:,0] = spec.field('LAMBDA')
+        columns[:,1] = spec.field('FLUX')
+        columns[:,2] = spec.field('FERROR')
+        columns[:,3] = spec.field('CONTAM')
+        for j in range(3):
+            columns[:,4+j] = sp1d[j][:NL]
         
-        sp1d = threedhst.spec1d.extract1D(id, root=SPCFile.filename.split('_2_opt')[0], path='../HTML', show=False, out2d=False)
-        lam2 = sp1d['lam']
-        flux2 = sp1d['flux']
-        ferr2 = sp1d['error']
-        contam2 = sp1d['contam']
+        text = '# lam flux error contam flux2 error2 contam2\n'
+        text += (line_format*NL) %tuple(columns.flatten())
         
         out = root+'_%05d.dat' %id
         print threedhst.noNewLine+out
         
-        # fp = gzip.open(path+'/'+out+'.gz','wb')
         fp = open(path+'/'+out,'w')
-        fp.write('# lam flux error contam flux2 error2 contam2\n')
-        
-        NL = len(lam)
-        for i in range(NL):
-            fp.write('%11.5e %10.3e %10.3e %10.3e %10.3e %10.3e %10.3e\n' %(lam[i],flux[i],ferr[i],contam[i], flux2[i], ferr2[i], contam2[i]))
+        fp.write(text)
         fp.close()
         
-    ### make a tarfile
-    oldwd = os.getcwd()
-    os.chdir(path)
-    fptar = tarfile.open(root+'_spec.tar.gz','w|gz')
-    for id in ids:
-        out = root+'_%05d.dat' %id
-        fptar.add(out)
+        info = fptar.gettarinfo(path+'/'+out, arcname=out)
+        fptar.addfile(info, cStringIO.StringIO(text))
+    
     fptar.close()
-    os.chdir(oldwd)
+    
+    if pool is not None:
+        pool.close()
+        pool.join()
     
 class SPCFile(object):
     """
@@ -1442,6 +1837,10 @@ class SPCFile(object):
     
     Class for reading and plotting spectra from an aXe
     
+    The object ids, extension numbers and file positions of the extensions
+    are stored in a sidecar index file, [filename].index, so that the 
+    extension headers only have to be scanned once.  The spectra are 
+    read lazily and memory-mapped when they are requested.
     """
     def _getPath(self):
         """
@@ -1462,36 +1861,174 @@ class SPCFile(object):
 _mapFitsExtensions()
         
     Figure out which object corresponds to which extension in the SPC.fits file
+    and where the extension headers start in the file.
         """
+        fits = pyfits.open(self.path+self.filename, memmap=True)
+        self.N_ext = len(fits)-1
+        self._ext_map = np.zeros(self.N_ext, dtype=int)
+        self._hdr_loc = np.zeros(self.N_ext, dtype=int)
         for i in range(self.N_ext):
             self._ext_map[i] = np.int(
-               self.fits[i+1].header['EXTNAME'].split('BEAM_')[1][:-1])
-            
+               fits[i+1].header['EXTNAME'].split('BEAM_')[1][:-1])
+            self._hdr_loc[i] = fits[i+1].fileinfo()['hdrLoc']
+        
+        fits.close()
+    
+    def _writeIndex(self, index_file):
+        """
+_writeIndex(index_file)
+        
+    Write the sidecar index: the size of the SPC file, then the object id, 
+    extension and header position of each extension.
+        """
+        import os
+        
+        fp = open(index_file,'w')
+        fp.write('# %d\n' %(os.path.getsize(self.path+self.filename)))
+        for i in range(self.N_ext):
+            fp.write('%d %d %d\n' %(self._ext_map[i], i+1, self._hdr_loc[i]))
+        
+        fp.close()
+        
+    def _readIndex(self, index_file):
+        """
+_readIndex(index_file)
+        
+    Read the sidecar index written by `_writeIndex`.
+        """
+        import os
+        
+        fp = open(index_file)
+        size = int(fp.readline().split()[1])
+        fp.close()
+        if size != os.path.getsize(self.path+self.filename):
+            raise IOError('%s is out of date' %(index_file))
+        
+        index = np.loadtxt(index_file, dtype=int, ndmin=2)
+        self.N_ext = len(index)
+        self._ext_map = index[:,0]
+        self._hdr_loc = index[:,2]
+        
     def __init__(self, filename='ib3721050_2_opt.SPC.fits',
-                 axe_drizzle_dir='DRIZZLE_G141'):
+                 axe_drizzle_dir='DRIZZLE_G141', use_index=True):
         """
 __init__(filename='ib3721050_2_opt.SPC.fits',
-         axe_drizzle_dir='DRIZZLE_G141')
+         axe_drizzle_dir='DRIZZLE_G141', use_index=True)
         """
+        import os
+        
         self.filename = filename
         self.axe_drizzle_dir = axe_drizzle_dir
         self._getPath()
-        self.fits = pyfits.open(self.path+filename)
         
-        self.N_ext = len(self.fits)-1
-        self._ext_map = np.arange(self.N_ext)*0
-        self._mapFitsExtensions()
+        index_file = self.path+filename+'.index'
+        self._ext_map = None
+        if use_index and os.path.exists(index_file):
+            if os.path.getmtime(index_file) >= os.path.getmtime(self.path+filename):
+                try:
+                    self._readIndex(index_file)
+                except:
+                    self._ext_map = None
+        
+        if self._ext_map is None:
+            self._mapFitsExtensions()
+            if use_index:
+                try:
+                    self._writeIndex(index_file)
+                except (IOError, OSError):
+                    pass
+        
+        #### id -> extension index
+        self._index = dict(zip(self._ext_map, range(self.N_ext)))
+        self._hdus = {}
+        self._fp = None
+        self._fits = None
+    
+    def _getFits(self):
+        """
+        Full HDUList of the SPC file, only opened (memory-mapped) when used.
+        """
+        if self._fits is None:
+            self._fits = pyfits.open(self.path+self.filename, memmap=True)
+        
+        return self._fits
+    
+    fits = property(_getFits)
+    
+    def _getHDU(self, idx):
+        """
+_getHDU(idx)
+        
+    Read extension `idx`+1 directly from its position in the file, with the
+    data memory-mapped.
+        """
+        if idx not in self._hdus:
+            if self._fp is None:
+                self._fp = open(self.path+self.filename, 'rb')
+            
+            self._fp.seek(self._hdr_loc[idx])
+            self._hdus[idx] = pyfits.BinTableHDU.readfrom(self._fp, 
+                                                          memmap=True)
+        
+        return self._hdus[idx]
+    
+    def close(self):
+        """
+close()
+        
+    Close the SPC file and drop the cached extensions.  They are opened 
+    again if more spectra are read afterwards.
+        """
+        self._hdus = {}
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        
+        if self._fits is not None:
+            self._fits.close()
+            self._fits = None
         
     def getSpec(self, object_number):
         """
         getSpec(self, object_number)
         """
-        if object_number in self._ext_map:
-            idx = np.where(self._ext_map == object_number)[0][0]
-            return self.fits[idx+1].data
+        if object_number in self._index:
+            return self._getHDU(self._index[object_number]).data
         else:
             print "Object #%d not found in %s." %(object_number, self.filename)
             return False
+    
+    def getSpecs(self, ids, columns=['LAMBDA','FLUX','FERROR','CONTAM']):
+        """
+specs = getSpecs(self, ids, columns=['LAMBDA','FLUX','FERROR','CONTAM'])
+        
+    Get the spectra of many objects at once.  Returns a dictionary with 
+    the object 'id' list, the number of points of each spectrum, 'N', and
+    [len(ids), max(N)] arrays of each column padded with NaN.  Objects not
+    in the file have N=0.
+        """
+        ids = np.atleast_1d(ids)
+        specs = []
+        N = np.zeros(len(ids), dtype=int)
+        for i, id in enumerate(ids):
+            if id in self._index:
+                specs.append(self._getHDU(self._index[id]).data)
+                N[i] = len(specs[-1])
+            else:
+                specs.append(None)
+        
+        out = {'id':ids, 'N':N}
+        for column in columns:
+            out[column] = np.zeros((len(ids), np.maximum(N.max(), 1)))+np.nan
+        
+        for i, spec in enumerate(specs):
+            if spec is None:
+                continue
+            
+            for column in columns:
+                out[column][i,:N[i]] = spec.field(column)
+        
+        return out
 
 def makeJavascript(path="../HTML/scripts"):
     """
@@ -1784,6 +2321,65 @@ make_Javascript(path="../HTML/scripts")
 	var NSHOW = 25;
 	
 	
+    ///// Add a marker for catalog object j
+    function addMarker(j) {
+        myIcon.image = "scripts/circle.png";
+        markerOptions = { icon:myIcon, title:ids[j]};
+        var marker = new GMarker(new GLatLng(lats[j],lngs[j]), markerOptions);
+        
+        GEvent.addListener(marker, "click", function(self) {
+            ROWSTART = j;
+            setFirstRow();
+            
+            if (layout == 1) {
+                clearRows();
+                addRowSet();
+            }
+        });
+        
+        marker_list.push(marker);
+        map.addOverlay(marker);
+    }
+    
+    ///// Read the catalog pages written by plotting.makeCatJSON one 
+    ///// at a time and plot the regions.  The table can be used as soon
+    ///// as the first page has been read.
+    function plotJsonObjects() {
+        $.getJSON(root+"_cat.json", function(cat) {
+            nObject = cat.n;
+            readJsonPage(cat.pages, 0);
+        });
+    }
+    
+    function readJsonPage(pages, ipage) {
+        if (ipage >= pages.length) return;
+        
+        $.getJSON(pages[ipage], function(page) {
+            for (var i = 0; i < page.id.length; i++) {
+                var j = ids.length;
+                //// Strings like the XML attributes, for the zero-padded
+                //// file names made in addRow
+                ids.push(String(page.id[i]));
+                ra_list.push(page.ra[i]);
+                de_list.push(page.dec[i]);
+                mag_list.push(page.mag[i]);
+                lats.push(page.dec[i]-centerLat);
+                lngs.push(((360-page.ra[i])-centerLng+offset)*Math.cos(centerLat/360.*2*3.14159));
+                addMarker(j);
+            }
+            
+            if (ipage == 0) {
+                setFirstRow();
+                if (layout == 1) {
+                    clearRows();
+                    addRowSet();
+                }
+            }
+            
+            readJsonPage(pages, ipage+1);
+        });
+    }
+    
     ///// Read objects from XML file and plot regions
     function plotXmlObjects() {
         GDownloadUrl(root+".xml", function(data) {
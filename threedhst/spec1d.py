@@ -23,6 +23,10 @@ import threedhst
 ### Random number seed so results are repeatable!!!
 SEED = 67
 
+#### 1D extractions from `extract1D` and `extract1DBatch`, keyed by 
+#### (root, path, ID, modification time of the 2D spectrum)
+EXTRACT1D_CACHE = {}
+
 def estimateRedshift(lines):
     """
 estimateRedshift(lines)
@@ -121,7 +125,10 @@ lines = findLines(SPCFile, idx=195, show=False, verbose=False, trim_abs=False)
     If `trim_abs` is set, only return emission lines.
     """
     
-    lines  = spWFindLines(SPCFile, idx=idx, show=show, check_contam=False)
+    #### Find lines in the spectrum and in the contamination spectrum at 
+    #### the same time
+    lines, contam = spWFindLinesMulti(SPCFile, idx=idx, show=show,
+                                      check_contam=[False, True])
     
     NLINE = len(lines)
     
@@ -159,7 +166,6 @@ lines = findLines(SPCFile, idx=195, show=False, verbose=False, trim_abs=False)
                     lines[i].flag = 'artifact'
     
     ## Check if emission lines are in contamination spectrum
-    contam = spWFindLines(SPCFile, idx=idx, check_contam=True, show=False)
     NCONTAM = len(contam)
     if NCONTAM > 0:
         if verbose:
@@ -197,11 +203,26 @@ lines = spWFindLines(SPCFile, idx=195, show=True, check_contam=False)
     Find emission lines with a wavelet transform. Translated from the SDSS DR7
     algorithm.
     
+    The transform is computed with `atrousWavelet` and the peaks are found 
+    with array operations, see `spWFindLinesMulti`.
+    """
+    return spWFindLinesMulti(SPCFile, idx=idx, show=show,
+                             check_contam=[check_contam])[0]
+
+def spWFindLinesMulti(SPCFile, idx=195, show=False, check_contam=[False,True]):
+    """
+lines_list = spWFindLinesMulti(SPCFile, idx=195, show=False, 
+                               check_contam=[False,True])
+    
+    Run `spWFindLines` on the same object for each value of `check_contam`,
+    with all of the spectra transformed together as a single 2D array.  
+    Returns a list of line lists.
+    
+    With `show`, only the first spectrum is plotted.
     """
     import threedhst.plotting
     
     debug = 0
-    iplot = 0
     
     ### input parameters
     wavemin = 1.1e4
@@ -230,221 +251,221 @@ lines = spWFindLines(SPCFile, idx=195, show=True, check_contam=False)
         
     ok = (lam > wavemin) & (lam < wavemax) 
     if ok.sum() < 3:
-        return []
+        return [[] for check in check_contam]
         
     flux = flux[ok]
     ferr = ferr[ok]
     contam = contam[ok]
     lam = (lam*1.)[ok]
-    npix = len(ok)
+    npix = len(lam)
     
-    corr = flux-contam
-            
-    if show: 
-        pl = pyplot.plot(lam,corr)
+    #### Spectrum (or "lines" in the contamination image) and errors of each
+    #### row of the transform
+    NSPEC = len(check_contam)
+    corr = np.zeros((NSPEC, npix))
+    err = np.zeros((NSPEC, npix))
+    for ispec, check in enumerate(check_contam):
+        if check:
+            nprand.seed(SEED)
+            corr[ispec] = contam+nprand.normal(0.,1.,(npix))*ferr/20.
+            err[ispec] = ferr/20.
+        else:
+            corr[ispec] = flux-contam
+            err[ispec] = ferr
     
-    mask = np.array([1.0, 4.0, 6.0, 4.0, 1.0])
+    if show: 
+        pl = pyplot.plot(lam,corr[0])
     
-    ## Allocate space ##
-    npix = len(lam)
-    x = np.zeros(npix)
-    t = np.zeros(npix)
-    value = np.zeros(npix)
-    origspec = np.zeros(npix)
-    err = np.zeros(npix)
-    ssmooth = np.zeros(npix)
-    esmooth = np.zeros(npix)
-    wave = np.zeros(npix)
-    gauss = np.zeros(npix)
-    gsmooth = np.zeros(npix)
-    
-    #### Search for "lines" in the contamination image
-    if check_contam:
-        nprand.seed(SEED)
-        corr = contam+nprand.normal(0.,1.,(npix))*ferr/20.
-        ferr /= 20.
-    
-    xmin = lam[0]
-    xmax = lam[-1]
-
     x = lam*1.
-    value = corr*1.
-    origspec = corr*1.
-    err = ferr*1.
     nprand.seed(SEED)
     gauss = nprand.normal(0.,1.,(npix))
-    smin = np.min(value)
-    smax = np.max(value)
-    ok = np.where((err > 0) & (lam > wavemin) & (lam < wavemax))
-    sn = np.median(value/err)
     
     if (debug > 0):
-        print ("spWFindLines: mean s/n = %f\n" %sn)
-    
-    emLines = []
-    
-    ## Loop over smoothing scales ##
-    scale = 1
-    ## Smooth at this scale ##
-    for ifilt in range(nfilt):
-        gmean = 0.0
-        grms = 0.0
-        wmean = 0.0
-        wrms = 0.0
-        wmin = 0
-        wmax = 0
-        for i in range(npix):
-            ssum = 0
-            esum = 0
-            gsum = 0
-            for j in range(5):
-                k = i + scale*(j-2)
-                if (k < 0): k = 0
-                if (k > npix-1): k = npix-1
-                ssum += value[k]*mask[j]
-                esum += err[k]*mask[j]
-                gsum += gauss[k]*mask[j]
-            
-            ssmooth[i] = ssum/16.0
-            esmooth[i] = esum/16.0
-            gsmooth[i] = gsum/16.0
-            
-            ## Wavelet at this scale is simply difference between previous 
-            ## and current smoothed spectra
-            wave[i] = value[i] - ssmooth[i]
-            gwave = gauss[i] - gsmooth[i]
-            gmean +=  gwave
-            grms +=  gwave*gwave
-            wmean +=  wave[i]
-            wrms +=  wave[i]*wave[i]
-            if (wave[i] < wmin): wmin = wave[i]
-            if (wave[i] > wmax): wmax = wave[i]
-        
-        gmean /= npix
-        grms = np.sqrt(grms/npix - gmean*gmean)
-        wmean /= npix
-        wrms = np.sqrt(wrms/npix - wmean*wmean)
-        if (debug > 0):
-            print ("mean, rms gaussian noise = %f %f\n" %(gmean, grms))
-            print ("mean, rms wavelet signal = %f %f\n" %(wmean, wrms))
-        
-        ## Copy smoothed spec etc and set threshold ##
-        value = ssmooth*1.
-        err = esmooth*1.
-        gauss = gsmooth*1.
-        t = gthresh*grms*esmooth
-        idx = np.where(wthresh*wrms > t)
-        if (idx[0].shape[0] > 0):
-            t[idx] = wthresh*wrms
-        
-        # #for (i = 0 i < npix i++) 
-        # for i in range(npix):
-        #     value[i] = ssmooth[i]
-        #     err[i] = esmooth[i]
-        #     gauss[i] = gsmooth[i]
-        #     t[i] = gthresh*grms*esmooth[i]
-        #     if (wthresh*wrms > t[i]): t[i] = wthresh*wrms
-        
-        ## Plot current wavelet ##
-        if (iplot > 0):
-            cpgsvp(xvmin, xvmax, yvmin + (ifilt+1)*dy, yvmin + (ifilt+2)*dy)
-            cpgswin(xmin, xmax, wmin, wmax)
-            cpgbox("BCST", 0.0, 0, "BCNSTV", 0.0, 0)
-            cpgline(npix, x, wave)
-            cpgsci(3)
-            cpgline(npix, x, t)
-            cpgsci(1)
-            #sprintf(label, "\\gs = %d", (int) pow(2,ifilt))
-            cpgmtxt("T", -1.5, 0.85, 0.0, label)
+        print ("spWFindLines: mean s/n = %f\n" %np.median(corr[0]/err[0]))
+    
+    wave, t = atrousWavelet(corr, err, np.tile(gauss, (NSPEC,1)), 
+                            nfilt=nfilt, gthresh=gthresh, wthresh=wthresh)
+    
+    # Do the line finding. Locate pixels above local threshold (t[i]). We
+    # require that adjacent pixels are also above threshold and that pixel
+    # higher than surrounding four. We could also require that the central
+    # pixel has mask value SP_MASK_OK, but this condition excludes too many
+    # genuine lines.
+    testRange = (x > wavemin) & (x < wavemax)
+    testPos = waveletPeaks(wave, t) & testRange
+    testNeg = waveletPeaks(-1*wave, t) & testRange
+    
+    ## Zero-crossings to estimate line width, last pixel at or before 
+    ## and first pixel at or after each pixel where the wavelet is <= 0
+    pix = np.arange(npix)
+    stop = ~(wave > 0.0)
+    stop[...,0] = True
+    ilo = np.maximum.accumulate(np.where(stop, pix, 0), axis=-1)
+    stop = ~(wave > 0.0)
+    stop[...,npix-2:] = True
+    ihi = np.minimum.accumulate(np.where(stop, pix, npix)[...,::-1],
+                                axis=-1)[...,::-1]
+    
+    out_lines = []
+    for ispec in range(NSPEC):
+        emLines = []
+        continuum = np.median(corr[ispec])
+        median_err = np.median(err[ispec])
         
-        if show: 
-            opl = pyplot.plot(x,wave)
-            pyplot.plot(x,t,color=opl[0]._color)
+        scale = 1
+        for ifilt in range(nfilt):
+            w = wave[ifilt, ispec]
+            tt = t[ifilt, ispec]
             
-        # Do the line finding. Locate pixels above local threshold (t[i]). We
-        # require that adjacent pixels are also above threshold and that pixel
-        # higher than surrounding four. We could also require that the central
-        # pixel has mask value SP_MASK_OK, but this condition excludes too many
-        # genuine lines.
-        #for (i = 2 i < npix-2 ++i) {
-        for i in range(2,npix-2):
-            ### Has to be within range
-            testRange = (x[i] > wavemin) & (x[i] < wavemax)
-            ### Emission
-            testPos = ( (wave[i] > t[i]) & (wave[i-1] > t[i-1]) & 
-                        (wave[i+1] > t[i+1]) & 
-                        (wave[i] >= wave[i-1]) & (wave[i] >= wave[i+1]) & 
-                        (wave[i] >= wave[i-2]) & (wave[i] >= wave[i+2]) )
+            if show & (ispec == 0): 
+                opl = pyplot.plot(x,w)
+                pyplot.plot(x,tt,color=opl[0]._color)
             
-            ### Absorption
-            nwave = -1*wave            
-            testNeg = ( (nwave[i] > t[i]) & (nwave[i-1] > t[i-1]) & 
-                        (nwave[i+1] > t[i+1]) & 
-                        (nwave[i] >= nwave[i-1]) & (nwave[i] >= nwave[i+1]) & 
-                        (nwave[i] >= nwave[i-2]) & (nwave[i] >= nwave[i+2]) )
-            
-            # if ( (x[i] > wavemin) & (x[i] < wavemax) & 
-            #     (wave[i] > t[i]) & (wave[i-1] > t[i-1]) & (wave[i+1] > t[i+1]) & 
-            #     (wave[i] >= wave[i-1]) & (wave[i] >= wave[i+1]) & 
-            #     (wave[i] >= wave[i-2]) & (wave[i] >= wave[i+2]) ):
-                # & spLineFound(spec->foundLines, x[i]) == 0
-            if (testRange & (testPos | testNeg)):
-                
-                ## Find zero-crossings to estimate line width ##
-                ilo = i
-                while( (ilo > 0) & (wave[ilo] > 0.0) ):
-                    ilo -= 1
+            for i in np.where(testPos[ifilt, ispec] | 
+                              testNeg[ifilt, ispec])[0]:
                 
-                ihi = i
-                while( (ihi < npix-2) & (wave[ihi] > 0.0) ):
-                    ihi += 1
-                    
                 ## Create a new line ##
                 line = spLineNew()
                 line.wave = x[i]
-                line.waveMin = x[ilo]
-                line.waveMax = x[ihi]
-                line.height = corr[i] #- ssmooth[i]
+                line.waveMin = x[ilo[ifilt, ispec, i]]
+                line.waveMax = x[ihi[ifilt, ispec, i]]
+                line.height = corr[ispec, i] #- ssmooth[i]
                 #line.sigma = 0.75*(x[ihi] - x[ilo])
                 line.sigmaMin = sigmaMin
                 line.ew = 0
                 line.ewMin = ewMin
-                line.continuum = np.median(corr)
-                line.sn = (line.height-line.continuum) / np.median(ferr)
+                line.continuum = continuum
+                line.sn = (line.height-line.continuum) / median_err
                 line.fcontam = contam[i]/flux[i]
                 
-                if (t[i] > 0):
-                  line.nsigma = wave[i]/t[i]
+                if (tt[i] > 0):
+                  line.nsigma = w[i]/tt[i]
                 else:
                   line.nsigma = 0.0
                 
                 line.restWave = 0
                 if (debug > 0):
                     print ("line centre %f, limits %f %f, height %f\n" 
-                              %(x[i], x[ilo], x[ihi], line.height))
+                              %(line.wave, line.waveMin, line.waveMax,
+                                line.height))
                 
-                if show: 
+                if show & (ispec == 0): 
                     pyplot.plot(line.wave*np.array([1,1]),np.array([-1,1]),
                         color=opl[0]._color)
                 
                 line.scale = scale
-                if testPos:
+                if testPos[ifilt, ispec, i]:
                     line.type = 'em'
                 else:
                     line.type = 'abs'
                     
                 emLines.append(line)
+            
+            scale *= 2
         
-        scale *= 2
+        out_lines.append(emLines)
     
     if show:
         pyplot.xlim(wavemin,wavemax)
         pyplot.ylim(-1.e-19,5.e-19)
     
-    # for line in emLines:
-    #     print line.wave, line.scale, line.sigma, line.type
+    return out_lines
+
+def atrousWavelet(value, err, gauss, nfilt=3, gthresh=1.5, wthresh=1.5):
+    """
+wave, t = atrousWavelet(value, err, gauss, nfilt=3, gthresh=1.5, wthresh=1.5)
+    
+    "A trous" wavelet transform of a spectrum, `value`, for `spWFindLines`.
+    At each of the `nfilt` scales, the spectrum, its error `err` and a 
+    gaussian noise spectrum `gauss` are smoothed with a [1,4,6,4,1]/16 
+    kernel with taps separated by 2**ifilt pixels.  The wavelet is the 
+    difference between the spectrum at the current and previous scales.
+    The line threshold is `gthresh` times the rms of the wavelet of the 
+    noise spectrum times the smoothed error, with a minimum of `wthresh` 
+    times the rms of the wavelet.
+    
+    The inputs can also be 2D arrays with one spectrum per row.  Returns the 
+    wavelet and threshold with shape [nfilt, ..., npix].
+    """
+    value = np.array(value, dtype=float)
+    err = np.array(err, dtype=float)
+    gauss = np.array(gauss, dtype=float)
+    npix = value.shape[-1]
+    
+    mask = np.array([1.0, 4.0, 6.0, 4.0, 1.0])
+    pix = np.arange(npix)
+    
+    wave = np.zeros((nfilt,)+value.shape)
+    t = np.zeros((nfilt,)+value.shape)
+    
+    scale = 1
+    for ifilt in range(nfilt):
+        ssmooth = 0.
+        esmooth = 0.
+        gsmooth = 0.
+        for j in range(5):
+            k = np.clip(pix + scale*(j-2), 0, npix-1)
+            ssmooth = ssmooth + value[...,k]*mask[j]
+            esmooth = esmooth + err[...,k]*mask[j]
+            gsmooth = gsmooth + gauss[...,k]*mask[j]
+        
+        ssmooth /= 16.0
+        esmooth /= 16.0
+        gsmooth /= 16.0
+        
+        ## Wavelet at this scale is simply difference between previous 
+        ## and current smoothed spectra
+        wave[ifilt] = value - ssmooth
+        gwave = gauss - gsmooth
         
-    return emLines
+        ## Running sums add the pixels in order, so the thresholds are 
+        ## identical to those of the original pixel loop
+        gmean = _sequentialSum(gwave)/npix
+        grms = np.sqrt(_sequentialSum(gwave*gwave)/npix - gmean*gmean)
+        wmean = _sequentialSum(wave[ifilt])/npix
+        wrms = np.sqrt(_sequentialSum(wave[ifilt]*wave[ifilt])/npix - 
+                       wmean*wmean)
+        
+        ## Copy smoothed spec etc and set threshold ##
+        value = ssmooth
+        err = esmooth
+        gauss = gsmooth
+        tt = gthresh*grms*esmooth
+        t[ifilt] = np.where(wthresh*wrms > tt, wthresh*wrms, tt)
+        
+        scale *= 2
+    
+    return wave, t
+
+def _sequentialSum(a):
+    """
+    Sum along the last axis, keeping the dimension, adding the elements in 
+    order.
+    """
+    return np.add.accumulate(a, axis=-1)[...,-1:]
+
+def waveletPeaks(wave, t):
+    """
+peak = waveletPeaks(wave, t)
+    
+    Pixels where the wavelet, `wave`, and both neighboring pixels are above 
+    the threshold `t` and where the wavelet is at least as high as the two 
+    pixels on either side.  Works along the last axis of `wave`.
+    """
+    npix = wave.shape[-1]
+    peak = np.zeros(wave.shape, dtype=bool)
+    if npix < 5:
+        return peak
+    
+    n = npix-4
+    w = lambda offset: wave[...,2+offset:2+offset+n]
+    th = lambda offset: t[...,2+offset:2+offset+n]
+    
+    peak[...,2:2+n] = ((w(0) > th(0)) & (w(-1) > th(-1)) & (w(1) > th(1)) & 
+                        (w(0) >= w(-1)) & (w(0) >= w(1)) & 
+                        (w(0) >= w(-2)) & (w(0) >= w(2)))
+    
+    return peak
 
 class spLineNew:
     wave = 0.
@@ -513,7 +534,11 @@ def extract1D(ID, root='orient1', path='../HTML', show=False, out2d=False):
     
     Include background estimate.
     
+    The 1D spectra are stored in EXTRACT1D_CACHE and objects that have 
+    already been extracted, here or with `extract1DBatch`, aren't extracted
+    again.
     """
+    import os
     import matplotlib.pyplot as plt
 
     import threedhst
@@ -522,6 +547,10 @@ def extract1D(ID, root='orient1', path='../HTML', show=False, out2d=False):
     
     from scipy import polyfit, polyval
     
+    cache_key = _extract1DKey(ID, root=root, path=path)
+    if (not show) & (not out2d) & (cache_key in EXTRACT1D_CACHE):
+        return _copySpec(EXTRACT1D_CACHE[cache_key])
+        
     twod = pyfits.open('%s/images/%s_%05d_2D.fits.gz' %(path, root, ID))
     
     head = twod[1].header
@@ -702,8 +731,238 @@ def extract1D(ID, root='orient1', path='../HTML', show=False, out2d=False):
         out['error'] = oned_flux_err
         out['contam'] = oned_flux_cont
         out['background'] = oned_flux_bg_fit
-        return out
+        EXTRACT1D_CACHE[cache_key] = out
+        return _copySpec(out)
 
+def _extract1DKey(ID, root='orient1', path='../HTML'):
+    """
+    EXTRACT1D_CACHE key of an object.  It includes the modification time of
+    the 2D spectrum, [path]/images/[root]_[ID]_2D.fits.gz, so that the 
+    spectrum is extracted again when the file is replaced.
+    """
+    import os
+    
+    file = '%s/images/%s_%05d_2D.fits.gz' %(path, root, ID)
+    if os.path.exists(file):
+        mtime = os.path.getmtime(file)
+    else:
+        mtime = None
+    
+    return (root, os.path.normpath(path), int(ID), mtime)
+
+def inExtract1DCache(ID, root='orient1', path='../HTML'):
+    """
+inExtract1DCache(ID, root='orient1', path='../HTML')
+    
+    True if the `extract1D` spectrum of object `ID` is in EXTRACT1D_CACHE.
+    """
+    return _extract1DKey(ID, root=root, path=path) in EXTRACT1D_CACHE
+    
+def clearExtract1DCache():
+    """
+clearExtract1DCache()
+    
+    Remove all of the 1D spectra stored in EXTRACT1D_CACHE.
+    """
+    EXTRACT1D_CACHE.clear()
+    
+def _copySpec(spec):
+    """
+    Copy of an `extract1D` output dictionary, so that the cached arrays 
+    can't be changed by the caller.
+    """
+    out = {}
+    for key in spec.keys():
+        out[key] = spec[key].copy()
+    
+    return out
+    
+def _extract1DStamps(stamps, dtype, sens, GAIN=1):
+    """
+    Do the `extract1DBatch` extraction for a list of 2D spectra, 
+    (id, header, data, contamination, model), padded to a common size in 
+    arrays of type `dtype`.  Returns a dictionary of the extract1D outputs 
+    keyed by id.
+    """
+    import threedhst
+    
+    from scipy import polyfit, polyval
+    
+    NOBJ = len(stamps)
+    spectra = {}
+    
+    shapes = np.array([stamp[2].shape for stamp in stamps])
+    NY, NX = shapes.max(axis=0)
+    
+    data = np.zeros((NOBJ, NY, NX), dtype=dtype)
+    cont = np.zeros((NOBJ, NY, NX), dtype=dtype)
+    model = np.zeros((NOBJ, NY, NX), dtype=dtype)
+    valid = np.zeros((NOBJ, NY, NX), dtype=bool)
+    for i, stamp in enumerate(stamps):
+        ny, nx = shapes[i]
+        data[i,:ny,:nx] = stamp[2]
+        cont[i,:ny,:nx] = stamp[3]
+        model[i,:ny,:nx] = stamp[4]
+        valid[i,:ny,:nx] = True
+    
+    yi = np.arange(NY).reshape((1,NY,1))
+    
+    ### Mask where the 2D flux is less than 0.5% of the maximum
+    flux_limit = np.max(np.where(valid, model, -np.inf), axis=2)
+    flux_limit = flux_limit.max(axis=1).reshape((NOBJ,1,1))*5.e-3
+    mask = (model < flux_limit) & (cont < flux_limit) & (data != 0)
+    
+    #### Extract rows where the model profile is within 0.2 of its peak
+    model_profile = np.sum(model, axis=2)
+    model_profile /= np.sum(model_profile, axis=1).reshape((NOBJ,1))
+    rows_valid = yi[:,:,0] < shapes[:,0:1]
+    profile_max = np.max(np.where(rows_valid, model_profile, -np.inf),
+                         axis=1).reshape((NOBJ,1))
+    use = (model_profile > 0.2*profile_max) & rows_valid
+    
+    ymin = np.zeros(NOBJ, dtype=int)
+    ymax = shapes[:,0]-1
+    has_use = use.sum(axis=1) > 0
+    ymin[has_use] = np.argmax(use, axis=1)[has_use]
+    ymax[has_use] = (NY-1-np.argmax(use[:,::-1], axis=1))[has_use]
+    
+    profile_mask = ((yi >= ymin.reshape((NOBJ,1,1))) & 
+                    (yi <= ymax.reshape((NOBJ,1,1))) & valid)
+    
+    masked = np.where(profile_mask, data, 0)
+    masked_cont = np.where(profile_mask, cont, 0)
+    background = np.where(mask, data, 0)
+    Nbg = np.where(mask, 1, data*0)
+    N = np.where(profile_mask, 1, data*0)
+    
+    #### Do the sums
+    sumN = np.sum(N, axis=1)
+    oned_dn = np.sum(masked, axis=1) / sumN
+    oned_dn_cont = np.sum(masked_cont*N, axis=1) / sumN
+    oned_dn_bg = np.sum(background, axis=1) / np.sum(Nbg, axis=1)
+    
+    for i, stamp in enumerate(stamps):
+        ID, head = stamp[0], stamp[1]
+        nx = shapes[i][1]
+        
+        ### S/N
+        rms = threedhst.utils.biweight(data[i][mask[i]])
+        
+        poisson_var = oned_dn[i,:nx]*head['EXPTIME']*GAIN
+        poisson_var[poisson_var < 0] = 0
+        oned_dn_var = (rms*GAIN)**2 / sumN[i,:nx]*head['EXPTIME']**2 + \
+                      poisson_var
+        oned_dn_err = np.sqrt(oned_dn_var)/head['EXPTIME']
+        
+        lam = (np.arange(nx)-head['CRPIX1']+1)*head['CDELT1']+ \
+               head['CRVAL1']
+        
+        #### Fit a polygon to the background
+        bg = oned_dn_bg[i,:nx]
+        xfit = np.arange(nx*1.)/nx
+        xfit_use = (lam > 1.08e4) & (lam < 1.68e4) & (np.isfinite(bg)) & \
+                   (bg != 0)
+        oned_dn_bg_fit = oned_dn[i,:nx]*0.
+        if xfit[xfit_use].size > 0:
+            if (lam[xfit_use].min() < 1.1e4) & (lam[xfit_use].max() > 1.6e4):
+                polycoeffs = polyfit(xfit[xfit_use], bg[xfit_use], 5)
+                oned_dn_bg_fit = polyval(polycoeffs, xfit)
+        
+        yint = np.interp(lam, sens.WAVELENGTH, sens.SENSITIVITY)
+        yint_err = np.interp(lam, sens.WAVELENGTH, sens.ERROR)
+        
+        ### Final fluxed spectra
+        oned_flux = oned_dn[i,:nx] * GAIN / yint
+        oned_flux_var = (oned_dn_err / yint)**2 + \
+                        (oned_flux * yint_err / yint)**2
+        
+        out = {}
+        out['lam'] = lam
+        out['flux'] = oned_flux
+        out['error'] = np.sqrt(oned_flux_var)
+        out['contam'] = oned_dn_cont[i,:nx] * GAIN / yint
+        out['background'] = oned_dn_bg_fit * GAIN / yint
+        
+        spectra[ID] = out
+    
+    return spectra
+    
+def extract1DBatch(ids, root='orient1', path='../HTML', mef_path=None, 
+                   chunk_size=100, verbose=True):
+    """
+spectra = extract1DBatch(ids, root='orient1', path='../HTML', mef_path=None,
+                         chunk_size=100, verbose=True)
+    
+    Run the `extract1D` extraction for a list of objects at once and store 
+    the results in EXTRACT1D_CACHE, so that later calls to extract1D with 
+    the same `root` and `path` don't extract them again, as long as the
+    [path]/images/[root]_[id]_2D.fits.gz files aren't changed.
+    
+    The 2D spectra are read from the uncompressed, memory-mapped aXe mEF 
+    files, [mef_path]/[root]_mef_ID[id].fits, if `mef_path` is set, or 
+    otherwise from [path]/images/[root]_[id]_2D.fits.gz.  They are padded 
+    to a common size and the masks, profiles and sums are computed for 
+    `chunk_size` objects at a time as 3D arrays, separately for the 2D 
+    spectra of each data type so that they are computed in the same 
+    precision as in extract1D.  The sensitivity curve is only read once.
+    
+    Returns a dictionary of the extract1D outputs keyed by id.
+    """
+    import os
+    import threedhst
+    
+    ### sensitivity
+    if threedhst.options['GRISM_NAME'] == 'G800L':
+        sens = pyfits.open('../CONF/ACS.WFC.1st.sens.7.fits')[1].data
+
+    if threedhst.options['GRISM_NAME'] == 'G141':
+        sens = pyfits.open('../CONF/WFC3.IR.G141.1st.sens.2.fits')[1].data
+    
+    GAIN = 1 # WFC3 FLT images already in e-
+    
+    spectra = {}
+    for ic in range(0, len(ids), chunk_size):
+        #### Read the 2D spectra, data, contamination and model
+        stamps = []
+        for ID in ids[ic:ic+chunk_size]:
+            if mef_path is not None:
+                file = '%s/%s_mef_ID%d.fits' %(mef_path, root, ID)
+            else:
+                file = '%s/images/%s_%05d_2D.fits.gz' %(path, root, ID)
+            
+            if not os.path.exists(file):
+                print 'spec1d.extract1DBatch: %s not found.' %(file)
+                continue
+            
+            twod = pyfits.open(file, memmap=(mef_path is not None))
+            stamps.append((int(ID), twod[1].header, twod[1].data, 
+                           twod[4].data, twod[5].data))
+            twod.close()
+        
+        #### Stamps are padded and extracted together with the others of the
+        #### same precision, which gives the same results as extract1D
+        groups = {}
+        for stamp in stamps:
+            dtype = np.result_type(stamp[2].dtype, stamp[3].dtype, 
+                                   stamp[4].dtype).newbyteorder('=')
+            if dtype not in groups:
+                groups[dtype] = []
+            
+            groups[dtype].append(stamp)
+        
+        for dtype in groups:
+            out = _extract1DStamps(groups[dtype], dtype, sens, GAIN=GAIN)
+            for ID in out:
+                EXTRACT1D_CACHE[_extract1DKey(ID, root=root, path=path)] = out[ID]
+            
+            spectra.update(out)
+        
+        if verbose:
+            print threedhst.noNewLine+'spec1d.extract1DBatch: %d/%d' %(
+                  np.minimum(ic+chunk_size, len(ids)), len(ids))
+    
+    return spectra
+    
 def show_extract1D():
     import os
     